@@ -2,17 +2,49 @@
 #!/usr/bin/env python
 from flask import Flask
 from flask_login import LoginManager
-from flask_sqlalchemy import SQLAlchemy
+from app.dbpool import SQLAlchemy, pool_stats
+from app.replicas import replicas
+from app.shards import PostShards
 
 
 app = Flask(__name__)
 app.config.from_object('config')
 db = SQLAlchemy(app)
+pool_stats.init_app(app)
+replicas.init_app(app, db)
+shards = PostShards(app, db)
+
+from app.profiler import RequestProfiler
+profiler = RequestProfiler(app)
 
 lm = LoginManager()
 lm.init_app(app)
 lm.login_view = 'login'
 
+from app.lastseen import LastSeenTracker
+last_seen_tracker = LastSeenTracker(app)
+
+from app.timeline import Timelines
+timelines = Timelines(app)
+
+from app.followgraph import FollowGraphCache
+follow_graph = FollowGraphCache(app)
+
+from app.search import SearchIndex
+search_index = SearchIndex(app)
+
+from app.fragments import FragmentCache
+fragments = FragmentCache(app)
+
+from app.jobs import JobQueue
+jobs = JobQueue(app)
+
+from app.passwords import PasswordHasher
+passwords = PasswordHasher(app)
+
+from app.templating import compile_templates, use_bytecode_cache
+use_bytecode_cache(app)
+
 if not app.debug:
     import logging
     from logging.handlers import RotatingFileHandler
@@ -30,4 +62,30 @@ if not app.debug:
     app.logger.addHandler(file_handler)
     app.logger.info('microblog startup')
 
-from app import views, models
+from app import models, tasks
+
+
+def create_app(warm: bool=False) -> Flask:
+    """The app with its views registered, ready to serve requests.
+
+    Not an application factory: there is one app per process, and every
+    call returns it. Importing the package only builds the app and its
+    extensions, which is all scripts and job workers need; the views,
+    forms and API are imported here, on first call. With warm, every
+    template is compiled and a database connection tried too, so a
+    server that preloads the app before forking workers hands them all of
+    that to share. The pool is emptied again afterwards: connections must
+    not cross a fork.
+    """
+    if 'api' not in app.blueprints:
+        from app import identity, views
+        from app.api import api
+        app.register_blueprint(api, url_prefix='/api/v1')
+    if warm:
+        use_bytecode_cache(app, create=True)
+        compile_templates(app)
+        search_index.warm()
+        with app.app_context():
+            db.engine.connect().close()
+            db.engine.dispose()
+    return app
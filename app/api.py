@@ -0,0 +1,163 @@
+# -*- coding: utf-8 -*-
+#!/usr/bin/env python
+"""Versioned JSON API over timelines, profiles and posts."""
+from app import app, db, last_seen_tracker, shards
+from app.models import User, Post
+from app.pagination import CursorPage, paginate_posts
+from flask import (
+    Blueprint, Response, abort, g, jsonify, request, stream_with_context
+)
+from functools import partial, wraps
+from typing import Callable, Iterator
+import json
+
+
+api = Blueprint('api', __name__)
+
+# everything a post is serialized from, selected instead of whole objects
+POST_COLUMNS = (
+    Post.id, Post.title, Post.body, Post.timestamp,
+    User.username.label('author'),
+)
+
+
+def login_required(view: Callable) -> Callable:
+    """Like flask_login's, but answer 401 instead of redirecting."""
+    @wraps(view)
+    def wrapped(*args, **kwargs):
+        if not g.user.is_authenticated:
+            abort(401)
+        return view(*args, **kwargs)
+    return wrapped
+
+
+def post_json(row) -> dict:
+    """The API representation of a POST_COLUMNS row."""
+    return {
+        'id': row.id,
+        'title': row.title,
+        'body': row.body,
+        'timestamp': row.timestamp.isoformat(),
+        'author': row.author,
+    }
+
+
+def page_size() -> int:
+    """The requested page size, within API_MAX_PAGE_SIZE."""
+    limit = request.args.get(
+        'limit', app.config.get('API_PAGE_SIZE', 20), type=int
+    )
+    if not 1 <= limit <= app.config.get('API_MAX_PAGE_SIZE', 100):
+        abort(400)
+    return limit
+
+
+def post_page(query, shard_page: Callable, cursor: str,
+              per_page: int) -> CursorPage:
+    """A cursor page of POST_COLUMNS rows from query, or from the shards.
+
+    With post shards on, the primary's post table is empty, so the page
+    comes from shard_page(cursor, per_page) instead.
+    """
+    if shards.enabled:
+        page = shard_page(cursor, per_page)
+        page.items = [post.as_row() for post in page.items]
+        return page
+    return paginate_posts(
+        query.join(User, User.id == Post.user_id), cursor, per_page,
+        POST_COLUMNS
+    )
+
+
+def stream_posts(query, shard_page: Callable) -> Response:
+    """One cursor page of a post query, serialized as it is written out."""
+    try:
+        page = post_page(
+            query, shard_page, request.args.get('cursor'), page_size()
+        )
+    except ValueError:
+        abort(400)
+
+    def generate() -> Iterator[str]:
+        yield '{"items": ['
+        for number, row in enumerate(page.items):
+            yield (',' if number else '') + json.dumps(post_json(row))
+        yield '], "prev_cursor": %s, "next_cursor": %s}' % (
+            json.dumps(page.prev_cursor), json.dumps(page.next_cursor)
+        )
+    return Response(generate(), mimetype='application/json')
+
+
+@api.route('/timeline')
+@login_required
+def timeline() -> Response:
+    """The logged-in user's home timeline, newest first."""
+    return stream_posts(
+        g.user.followed_posts(), partial(shards.timeline_page, g.user)
+    )
+
+
+@api.route('/users/<username>')
+@login_required
+def user(username: str) -> Response:
+    """A user's profile."""
+    row = db.session.query(
+        User.id, User.username, User.about_me, User.last_seen,
+        User.follower_count, User.following_count, User.post_count
+    ).filter(User.username == username).first()
+    if row is None:
+        abort(404)
+    last_seen = last_seen_tracker.last_seen(row)
+    return jsonify({
+        'id': row.id,
+        'username': row.username,
+        'about_me': row.about_me,
+        'last_seen': last_seen.isoformat() if last_seen else None,
+        'followers': row.follower_count,
+        'following': row.following_count,
+        'posts': row.post_count,
+    })
+
+
+@api.route('/users/<username>/posts')
+@login_required
+def user_posts(username: str) -> Response:
+    """One page of a user's posts, newest first."""
+    author = User.query.filter_by(username=username).first_or_404()
+    return stream_posts(author.posts, partial(shards.user_page, author))
+
+
+@api.route('/users/<username>/posts/export')
+@login_required
+def export_user_posts(username: str) -> Response:
+    """Every post by a user as JSON Lines, streamed in constant memory.
+
+    Posts are read API_EXPORT_CHUNK at a time by cursor, so neither the
+    database nor this process ever holds the whole list.
+    """
+    author = User.query.filter_by(username=username).first_or_404()
+    shard_page = partial(shards.user_page, author)
+    chunk = app.config.get('API_EXPORT_CHUNK', 1000)
+
+    def generate() -> Iterator[str]:
+        cursor = None
+        while True:
+            page = post_page(author.posts, shard_page, cursor, chunk)
+            for row in page.items:
+                yield json.dumps(post_json(row)) + '\n'
+            if not page.has_next:
+                return
+            cursor = page.next_cursor
+    return Response(
+        stream_with_context(generate()), mimetype='application/x-ndjson'
+    )
+
+
+@api.errorhandler(400)
+@api.errorhandler(401)
+@api.errorhandler(404)
+def error(error) -> Response:
+    """Errors as JSON rather than HTML pages."""
+    response = jsonify({'error': error.name})
+    response.status_code = error.code
+    return response
@@ -0,0 +1,57 @@
+# -*- coding: utf-8 -*-
+#!/usr/bin/env python
+"""Set-at-a-time inserts and lookups shared by bulk follows and imports."""
+from app import db
+from sqlalchemy import or_
+from sqlalchemy.dialects import postgresql
+from typing import Dict, Iterable, List, Optional, Union
+
+
+def insert_ignore(table, rows: List[dict], returning=None,
+                  connection=None) -> Optional[list]:
+    """Insert rows in one statement, skipping those that already exist.
+
+    Postgres uses ``INSERT ... ON CONFLICT DO NOTHING`` and, given a
+    returning column, answers its values for the rows actually inserted.
+    SQLite uses ``INSERT OR IGNORE`` and always answers None. Rows go
+    through the session unless another connection is given.
+    """
+    executor = connection if connection is not None else db.session
+    dialect = connection.dialect if connection is not None else \
+        db.engine.dialect
+    answers = dialect.name == 'postgresql' and returning is not None
+    if not rows:
+        return [] if answers else None
+    if dialect.name == 'postgresql':
+        statement = postgresql.insert(table).values(rows)
+        statement = statement.on_conflict_do_nothing()
+        if returning is not None:
+            statement = statement.returning(returning)
+            return [row[0] for row in executor.execute(statement)]
+        executor.execute(statement)
+        return None
+    executor.execute(table.insert().prefix_with('OR IGNORE'), rows)
+    return None
+
+
+def user_ids(refs: Iterable[Union[int, str]]) -> Dict[Union[int, str], int]:
+    """Map ids and usernames to user ids in one query, dropping unknowns."""
+    from app.models import User
+    refs = list(refs)
+    ids = {ref for ref in refs if isinstance(ref, int)}
+    names = {ref for ref in refs if isinstance(ref, str)}
+    matches = []
+    if ids:
+        matches.append(User.id.in_(ids))
+    if names:
+        matches.append(User.username.in_(names))
+    if not matches:
+        return {}
+    found = {}
+    rows = db.session.query(User.id, User.username).filter(or_(*matches))
+    for user_id, username in rows:
+        if user_id in ids:
+            found[user_id] = user_id
+        if username in names:
+            found[username] = user_id
+    return found
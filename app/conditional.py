@@ -0,0 +1,89 @@
+# -*- coding: utf-8 -*-
+#!/usr/bin/env python
+"""Weak ETags for the timeline and profile pages, checked before rendering."""
+from app import app, db, follow_graph, shards
+from flask import request, session
+from sqlalchemy import func
+from hashlib import sha1
+from werkzeug.wrappers import Response
+import time
+
+
+def _tag(*parts) -> str:
+    """Hash the inputs of a page into an ETag value.
+
+    None while flashed messages are waiting: that page is a one-off.
+    """
+    if session.get('_flashes'):
+        return None
+    return sha1(repr(parts).encode()).hexdigest()
+
+
+def _form_epoch() -> int:
+    """Changes often enough that a reused page's CSRF token stays valid."""
+    limit = app.config.get('WTF_CSRF_TIME_LIMIT') or 3600
+    return int(time.time() // (limit / 2))
+
+
+def timeline_etag(user, cursor: str=None) -> str:
+    """ETag of a home timeline page, from one query.
+
+    Covers the viewer, the page asked for, the newest followed post, the
+    viewer's follows_version and the sum of the followed authors'
+    profile_version, plus the age of the post form's CSRF token. All of
+    it is read from the database, so every server process agrees on it.
+    """
+    from app.models import Post, User, followers
+    follows = db.session.query(User.follows_version).filter(
+        User.id == user.id
+    ).as_scalar()
+    profiles = db.session.query(
+        func.coalesce(func.sum(User.profile_version), 0)
+    ).join(
+        followers, followers.c.followed_id == User.id
+    ).filter(followers.c.follower_id == user.id).as_scalar()
+    if shards.enabled:
+        newest = tuple(shards.newest_followed(user) or ())
+        versions = tuple(db.session.query(follows, profiles).one())
+    else:
+        newest_id = user.followed_posts().with_entities(
+            Post.id
+        ).order_by(None).order_by(
+            Post.timestamp.desc(), Post.id.desc()
+        ).limit(1).as_scalar()
+        newest, *versions = db.session.query(
+            newest_id, follows, profiles
+        ).one()
+    return _tag(
+        'home', user.id, user.username, cursor, newest, tuple(versions),
+        _form_epoch()
+    )
+
+
+def profile_etag(viewer, user, cursor: str=None, last_seen=None) -> str:
+    """ETag of a profile page, from the already loaded profile user.
+
+    Posts are never deleted, so post_count versions the post list.
+    """
+    return _tag(
+        'profile', viewer.id, viewer.username, user.id, user.username,
+        user.about_me, user.follower_count, user.following_count,
+        user.post_count, cursor, last_seen,
+        user.id != viewer.id and user.id in follow_graph.following(viewer.id)
+    )
+
+
+def not_modified(etag: str) -> Response:
+    """A 304 if the client already has this version, otherwise None."""
+    if etag is None or not request.if_none_match.contains_weak(etag):
+        return None
+    return tag(Response(status=304), etag)
+
+
+def tag(response, etag: str) -> Response:
+    """Mark a page response with its ETag and ask clients to revalidate."""
+    response = app.make_response(response)
+    if etag is not None:
+        response.set_etag(etag, weak=True)
+        response.headers['Cache-Control'] = 'private, no-cache'
+    return response
@@ -0,0 +1,166 @@
+# -*- coding: utf-8 -*-
+#!/usr/bin/env python
+"""Connection pool settings and pool instrumentation."""
+from bisect import bisect_left
+from app.replicas import replica_uris, sessionmaker
+from flask_sqlalchemy import SQLAlchemy as BaseSQLAlchemy
+from sqlalchemy import event, exc
+from sqlalchemy.pool import QueuePool
+import threading
+import time
+import weakref
+
+
+# upper bounds, in milliseconds, of the checkout latency histogram buckets
+LATENCY_BUCKETS = (1, 5, 10, 25, 50, 100, 250, 500, 1000, 5000)
+
+
+class PoolStats(object):
+    """Counters describing every instrumented pool in the process."""
+
+    def __init__(self) -> None:
+        """Start with empty counters."""
+        self._lock = threading.Lock()
+        self._pools = weakref.WeakSet()
+        self.reset()
+        self._last_logged = time.monotonic()
+
+    def reset(self) -> None:
+        """Zero the checkout counters."""
+        with self._lock:
+            self.checkouts = 0
+            self.timeouts = 0
+            self.wait_total = 0.0
+            self.wait_max = 0.0
+            self.histogram = [0] * (len(LATENCY_BUCKETS) + 1)
+
+    def register(self, pool) -> None:
+        """Include a pool in the checked-out and overflow totals."""
+        self._pools.add(pool)
+
+    def record_checkout(self, seconds: float) -> None:
+        """Count one checkout that waited for the given time."""
+        millis = seconds * 1000
+        with self._lock:
+            self.checkouts += 1
+            self.wait_total += millis
+            self.wait_max = max(self.wait_max, millis)
+            self.histogram[bisect_left(LATENCY_BUCKETS, millis)] += 1
+
+    def record_timeout(self) -> None:
+        """Count one checkout that gave up waiting for a connection."""
+        with self._lock:
+            self.timeouts += 1
+
+    def snapshot(self) -> dict:
+        """Current pool occupancy and checkout latency, JSON-ready."""
+        pools = list(self._pools)
+        labels = [f'<={b}ms' for b in LATENCY_BUCKETS]
+        labels.append(f'>{LATENCY_BUCKETS[-1]}ms')
+        with self._lock:
+            return {
+                'pools': len(pools),
+                'size': sum(p.size() for p in pools),
+                'checked_out': sum(p.checkedout() for p in pools),
+                'overflow': sum(max(p.overflow(), 0) for p in pools),
+                'checkouts': self.checkouts,
+                'timeouts': self.timeouts,
+                'wait_ms_total': round(self.wait_total, 3),
+                'wait_ms_max': round(self.wait_max, 3),
+                'wait_ms_avg': round(
+                    self.wait_total / self.checkouts, 3
+                ) if self.checkouts else 0.0,
+                'checkout_latency': dict(zip(labels, self.histogram)),
+            }
+
+    def init_app(self, app) -> None:
+        """Log a snapshot to the app log every POOL_STATS_LOG_INTERVAL s."""
+        interval = app.config.get('POOL_STATS_LOG_INTERVAL', 300)
+
+        @app.after_request
+        def log_pool_stats(response):
+            now = time.monotonic()
+            if interval and now - self._last_logged >= interval:
+                self._last_logged = now
+                app.logger.info('db pool stats: %s', self.snapshot())
+            return response
+
+
+pool_stats = PoolStats()
+
+
+def ping_connection(dbapi_connection, connection_record, proxy) -> None:
+    """Check a pooled connection is alive before handing it out.
+
+    Raising DisconnectionError makes the pool discard the connection and
+    retry with a fresh one, so requests after an idle period or a database
+    restart don't fail on a dead socket.
+    """
+    cursor = dbapi_connection.cursor()
+    try:
+        cursor.execute('SELECT 1')
+    except Exception:
+        raise exc.DisconnectionError()
+    finally:
+        try:
+            cursor.close()
+        except Exception:
+            pass
+
+
+class InstrumentedQueuePool(QueuePool):
+    """QueuePool that reports checkout waits to pool_stats."""
+
+    #: set from DATABASE_POOL_PRE_PING when the engine is configured
+    pre_ping = False
+
+    def __init__(self, *args, **kwargs) -> None:
+        """Create the pool and register it with the stats collector."""
+        super(InstrumentedQueuePool, self).__init__(*args, **kwargs)
+        pool_stats.register(self)
+        if self.pre_ping:
+            event.listen(self, 'checkout', ping_connection)
+
+    def _do_get(self):
+        """Take a connection from the queue, timing how long it took."""
+        started = time.perf_counter()
+        try:
+            record = super(InstrumentedQueuePool, self)._do_get()
+        except exc.TimeoutError:
+            pool_stats.record_timeout()
+            raise
+        pool_stats.record_checkout(time.perf_counter() - started)
+        return record
+
+
+class SQLAlchemy(BaseSQLAlchemy):
+    """Flask-SQLAlchemy with this app's pool and session settings."""
+
+    def create_session(self, options):
+        """Sessions that route safe reads to the read replicas."""
+        return sessionmaker(self, **options)
+
+    def apply_driver_hacks(self, app, info, options) -> None:
+        """Use the instrumented pool and server-side timeouts on Postgres.
+
+        Replica binds also get a connect timeout, so a replica that has
+        gone away fails its health check quickly instead of stalling it.
+        """
+        super(SQLAlchemy, self).apply_driver_hacks(app, info, options)
+        if not info.drivername.startswith('postgresql'):
+            # the pool sizing settings describe the Postgres QueuePool
+            for key in ('pool_size', 'max_overflow', 'pool_timeout'):
+                options.pop(key, None)
+            return
+        InstrumentedQueuePool.pre_ping = app.config.get(
+            'DATABASE_POOL_PRE_PING', False
+        )
+        options['poolclass'] = InstrumentedQueuePool
+        timeout = app.config.get('DATABASE_STATEMENT_TIMEOUT')
+        if timeout:
+            connect_args = options.setdefault('connect_args', {})
+            connect_args['options'] = f'-c statement_timeout={timeout}'
+        connect_timeout = app.config.get('REPLICA_CONNECT_TIMEOUT')
+        if connect_timeout and str(info) in replica_uris(app):
+            connect_args = options.setdefault('connect_args', {})
+            connect_args['connect_timeout'] = connect_timeout
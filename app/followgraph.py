@@ -0,0 +1,117 @@
+# -*- coding: utf-8 -*-
+#!/usr/bin/env python
+"""In-process cache of who follows whom."""
+from app import db
+from collections import OrderedDict
+from sqlalchemy import event
+from typing import FrozenSet
+import threading
+import time
+
+
+FOLLOWING = 'following'
+FOLLOWERS = 'followers'
+
+# session.info key of the users whose sets go stale when it commits
+STALE_KEY = 'follow_graph_stale'
+
+
+class FollowGraphCache(object):
+    """LRU cache of each user's followed-id and follower-id sets.
+
+    Each set is loaded with one id-only SELECT the first time it is needed
+    and then answers ``is_following`` and the follow counts without going
+    back to the database. ``User.follow`` and ``User.unfollow`` invalidate
+    both ends of the edge they change, once when they change it and again
+    when the transaction ends, so a set another request reloaded before
+    the commit is not kept. ``FOLLOW_CACHE_TTL`` bounds how long an edge
+    changed by another process can go unnoticed.
+    """
+
+    def __init__(self, app=None) -> None:
+        """Create an empty cache, optionally bound to an app."""
+        self.capacity = 10000
+        self.ttl = 30
+        self._sets = OrderedDict()
+        self._lock = threading.Lock()
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app) -> None:
+        """Read the cache size and time-to-live from the app config."""
+        self.capacity = app.config.get('FOLLOW_CACHE_SIZE', 10000)
+        self.ttl = app.config.get('FOLLOW_CACHE_TTL', 30)
+        if not event.contains(db.session, 'after_commit', self._ended):
+            event.listen(db.session, 'after_commit', self._ended)
+            event.listen(db.session, 'after_rollback', self._ended)
+
+    def following(self, user_id: int) -> FrozenSet[int]:
+        """Ids of the users this user follows."""
+        return self._get(FOLLOWING, user_id)
+
+    def followers(self, user_id: int) -> FrozenSet[int]:
+        """Ids of the users following this user."""
+        return self._get(FOLLOWERS, user_id)
+
+    def following_count(self, user_id: int) -> int:
+        """How many users this user follows."""
+        return len(self.following(user_id))
+
+    def follower_count(self, user_id: int) -> int:
+        """How many users follow this user."""
+        return len(self.followers(user_id))
+
+    def invalidate(self, *user_ids: int) -> None:
+        """Forget both cached sets of every given user."""
+        with self._lock:
+            for user_id in user_ids:
+                self._sets.pop((FOLLOWING, user_id), None)
+                self._sets.pop((FOLLOWERS, user_id), None)
+
+    def invalidate_on_commit(self, session, *user_ids: int) -> None:
+        """Forget these users' sets now and when session's transaction ends.
+
+        Sets reloaded before then may hold the edges as they were before
+        the change, or the change itself if it is rolled back.
+        """
+        self.invalidate(*user_ids)
+        session.info.setdefault(STALE_KEY, set()).update(user_ids)
+
+    def clear(self) -> None:
+        """Forget everything."""
+        with self._lock:
+            self._sets = OrderedDict()
+
+    def _ended(self, session) -> None:
+        """Forget the sets a finished transaction may have made stale."""
+        stale = session.info.pop(STALE_KEY, None)
+        if stale:
+            self.invalidate(*stale)
+
+    def _get(self, kind: str, user_id: int) -> FrozenSet[int]:
+        """Serve a set from the cache, loading it on a miss or expiry."""
+        key = (kind, user_id)
+        now = time.monotonic()
+        with self._lock:
+            cached = self._sets.get(key)
+            if cached is not None and now - cached[0] < self.ttl:
+                self._sets.move_to_end(key)
+                return cached[1]
+
+        ids = self._load(kind, user_id)
+        with self._lock:
+            self._sets[key] = (now, ids)
+            self._sets.move_to_end(key)
+            while len(self._sets) > self.capacity:
+                self._sets.popitem(last=False)
+        return ids
+
+    def _load(self, kind: str, user_id: int) -> FrozenSet[int]:
+        """Read one side of a user's follow edges from the database."""
+        from app.models import followers
+        if kind == FOLLOWING:
+            column, match = followers.c.followed_id, followers.c.follower_id
+        else:
+            column, match = followers.c.follower_id, followers.c.followed_id
+        rows = db.session.query(column).filter(match == user_id)
+        return frozenset(row[0] for row in rows)
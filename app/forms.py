@@ -1,5 +1,6 @@
 # -*- coding: utf-8 -*-
 #!/usr/bin/env python
+from app import db, passwords
 from app.models import User
 from flask_wtf import FlaskForm
 from wtforms import StringField, PasswordField, BooleanField, TextAreaField
@@ -14,12 +15,20 @@ class LoginForm(FlaskForm):
     remember_me = BooleanField('remember_me', default=False)
 
     def check_credentials(self) -> bool:
-        """Check credentials for a username/password set."""
-        user = User.query.filter_by(
+        """Check credentials for a username/password set.
+
+        The matching user is kept as ``self.user``; a password stored with
+        outdated parameters (or not hashed at all) is rehashed on the way.
+        """
+        self.user = User.query.filter_by(
             username=self.username.data
         ).first()
-        if not user or not self.password.data or user.password != self.password.data:
+        if not self.user or not passwords.verify(
+                self.user.password, self.password.data):
             return False
+        if passwords.needs_rehash(self.user.password):
+            self.user.password = passwords.hash(self.password.data)
+            db.session.commit()
         return True
 
 
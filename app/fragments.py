@@ -0,0 +1,231 @@
+# -*- coding: utf-8 -*-
+#!/usr/bin/env python
+"""Cache of rendered post rows and post lists."""
+from collections import OrderedDict
+from hashlib import sha1
+from jinja2 import Markup
+from typing import Callable, Iterable, List, Tuple
+import sys
+import threading
+import time
+import uuid
+
+
+class MemoryBackend(object):
+    """In-process LRU store bounded by the approximate size of its values.
+
+    Speaks the same get/set/get_many/set_many/delete/clear interface as the
+    werkzeug ``contrib.cache`` clients, so a shared cache can replace it.
+    A timeout of 0 means an entry never expires.
+    """
+
+    def __init__(self, max_bytes: int=32 * 1024 * 1024,
+                 default_timeout: int=0) -> None:
+        """Create an empty store holding at most max_bytes."""
+        self.max_bytes = max_bytes
+        self.default_timeout = default_timeout
+        self.size = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key: str):
+        """The value stored under key, or None."""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            expires, value, _ = entry
+            if expires and expires < time.monotonic():
+                self._pop(key)
+                return None
+            self._entries.move_to_end(key)
+            return value
+
+    def get_many(self, *keys: str) -> list:
+        """The values stored under each key, None where missing."""
+        return [self.get(key) for key in keys]
+
+    def set(self, key: str, value, timeout: int=None) -> bool:
+        """Store a value, evicting the least recently used to make room."""
+        if timeout is None:
+            timeout = self.default_timeout
+        expires = time.monotonic() + timeout if timeout else 0
+        size = sys.getsizeof(key) + sys.getsizeof(value)
+        with self._lock:
+            self._pop(key)
+            self._entries[key] = (expires, value, size)
+            self.size += size
+            while self.size > self.max_bytes and self._entries:
+                self._pop(next(iter(self._entries)))
+        return True
+
+    def set_many(self, mapping: dict, timeout: int=None) -> bool:
+        """Store several values."""
+        for key, value in mapping.items():
+            self.set(key, value, timeout)
+        return True
+
+    def delete(self, key: str) -> bool:
+        """Forget one key."""
+        with self._lock:
+            return self._pop(key)
+
+    def clear(self) -> bool:
+        """Forget everything."""
+        with self._lock:
+            self._entries = OrderedDict()
+            self.size = 0
+        return True
+
+    def _pop(self, key: str) -> bool:
+        """Drop a key and its size; the caller holds the lock."""
+        entry = self._entries.pop(key, None)
+        if entry is None:
+            return False
+        self.size -= entry[2]
+        return True
+
+
+class FragmentCache(object):
+    """Rendered ``post.html`` rows and, optionally, whole post lists.
+
+    A post row is keyed by the post id and everything it displays that can
+    change (its timestamp and the author's username), so a profile edit
+    simply stops matching the old rows instead of needing a purge.
+
+    Post lists are keyed by (scope, owner, cursor, generation). The owner's
+    generation is replaced whenever their list changes: their own follows,
+    a new post or profile edit by an account they follow. Authors with
+    more than ``TIMELINE_FANOUT_LIMIT`` followers don't bump every
+    follower; ``FRAGMENT_PAGE_TTL`` bounds how stale those lists get.
+    Generations are only kept while page caching is on.
+
+    ``FRAGMENT_CACHE_BACKEND`` is ``memory`` (per process, bounded by
+    ``FRAGMENT_CACHE_MAX_BYTES``) or ``memcached`` (shared, using
+    ``FRAGMENT_CACHE_SERVERS``); any object with the werkzeug cache
+    interface can also be assigned to ``backend`` directly.
+    """
+
+    def __init__(self, app=None) -> None:
+        """Create a disabled cache, optionally bound to an app."""
+        self.app = None
+        self.enabled = False
+        self.pages = False
+        self.page_ttl = 60
+        self.fanout_limit = 10000
+        self.backend = MemoryBackend()
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app) -> None:
+        """Pick the backend from the config and expose render_posts."""
+        self.app = app
+        self.enabled = app.config.get('FRAGMENT_CACHE_ENABLED', True)
+        self.pages = app.config.get('FRAGMENT_PAGE_CACHE', False)
+        self.page_ttl = app.config.get('FRAGMENT_PAGE_TTL', 60)
+        self.fanout_limit = app.config.get('TIMELINE_FANOUT_LIMIT', 10000)
+        if app.config.get('FRAGMENT_CACHE_BACKEND', 'memory') == 'memcached':
+            from werkzeug.contrib.cache import MemcachedCache
+            self.backend = MemcachedCache(
+                app.config['FRAGMENT_CACHE_SERVERS'], key_prefix='microblog:'
+            )
+        else:
+            self.backend = MemoryBackend(
+                app.config.get('FRAGMENT_CACHE_MAX_BYTES', 32 * 1024 * 1024)
+            )
+        app.add_template_global(self.render_posts, 'render_posts')
+
+    def render_posts(self, posts: Iterable) -> List[Markup]:
+        """The post.html row for each post, rendering only the misses.
+
+        Rows are rendered by calling the template's macro, which skips the
+        fresh template context a full render would set up for every row.
+        """
+        posts = list(posts)
+        post_row = self.app.jinja_env.get_template('post.html').module.post_row
+        if not self.enabled or not posts:
+            return [Markup(post_row(post)) for post in posts]
+
+        keys = [self._post_key(post) for post in posts]
+        cached = self.backend.get_many(*keys)
+        rendered, missing = [], {}
+        for post, key, html in zip(posts, keys, cached):
+            if html is None:
+                html = missing[key] = str(post_row(post))
+            rendered.append(Markup(html))
+        if missing:
+            self.backend.set_many(missing)
+        return rendered
+
+    def page(self, scope: str, owner_id: int, cursor: str,
+             render: Callable[[], str]) -> Tuple[Markup, bool]:
+        """A rendered post list and whether it came from the cache.
+
+        A cached list can be older than the database (a large author's
+        post, or an invalidation made in another process's memory), so
+        callers must not validate it against live state.
+        """
+        if not (self.enabled and self.pages):
+            return Markup(render()), False
+        key = ':'.join([
+            'page', scope, str(owner_id), cursor or '',
+            self._generation(scope, owner_id)
+        ])
+        html = self.backend.get(key)
+        if html is not None:
+            return Markup(html), True
+        html = render()
+        self.backend.set(key, html, self.page_ttl)
+        return Markup(html), False
+
+    def invalidate_home(self, *user_ids: int) -> None:
+        """Retire the cached home timelines of these users."""
+        if self.enabled and self.pages:
+            self.backend.set_many({
+                self._generation_key('home', user_id): uuid.uuid4().hex
+                for user_id in user_ids
+            }, 0)
+
+    def invalidate_author(self, user_id: int) -> None:
+        """Retire every cached list showing this author's posts."""
+        if not (self.enabled and self.pages):
+            return
+        from app import db, follow_graph
+        from app.models import User
+        self.backend.set(
+            self._generation_key('profile', user_id), uuid.uuid4().hex, 0
+        )
+        # the stored counter, so a large account's followers are never loaded
+        follower_count = db.session.query(User.follower_count).filter(
+            User.id == user_id
+        ).scalar()
+        if (follower_count or 0) <= self.fanout_limit:
+            self.invalidate_home(*follow_graph.followers(user_id))
+
+    def clear(self) -> None:
+        """Forget every cached fragment."""
+        self.backend.clear()
+
+    def _post_key(self, post) -> str:
+        """Key for a post row; changes whenever its rendering would."""
+        version = sha1(
+            f'{post.timestamp}|{post.author.username}'.encode()
+        ).hexdigest()[:16]
+        return f'post:{post.id}:{version}'
+
+    def _generation_key(self, scope: str, owner_id: int) -> str:
+        """Where the current generation of an owner's lists is kept."""
+        return f'gen:{scope}:{owner_id}'
+
+    def _generation(self, scope: str, owner_id: int) -> str:
+        """The current generation of an owner's lists, starting one if lost.
+
+        A fresh random value rather than a counter, so an evicted
+        generation can never bring back lists cached under an older one.
+        """
+        key = self._generation_key(scope, owner_id)
+        generation = self.backend.get(key)
+        if generation is None:
+            generation = uuid.uuid4().hex
+            self.backend.set(key, generation, 0)
+        return generation
@@ -0,0 +1,117 @@
+# -*- coding: utf-8 -*-
+#!/usr/bin/env python
+"""The logged-in user's identity, kept in the signed session cookie."""
+from app import app
+from app.models import User
+from flask import session
+import time
+
+
+SESSION_KEY = 'identity'
+
+
+class SessionUser(object):
+    """The logged-in user as recorded in the session.
+
+    Answers ``id``, ``username`` and the id-only lookups (``is_following``,
+    ``followed_posts``, ``new_posts_count``) without touching the database.
+    Anything else, and ``row`` itself, loads the full ``User`` once per
+    request.
+    """
+
+    followed_posts = User.followed_posts
+    is_following = User.is_following
+    new_posts_count = User.new_posts_count
+
+    def __init__(self, user_id: int, username: str, row: User=None) -> None:
+        """Identify a user, optionally with their already loaded row."""
+        self.id = user_id
+        self.username = username
+        self._row = row
+
+    def __repr__(self) -> str:
+        """String representation of the session user."""
+        return f'<SessionUser {self.username} | id: {self.id}>'
+
+    def __eq__(self, other) -> bool:
+        """Equal to any user or session user with the same id."""
+        if isinstance(other, (User, SessionUser)):
+            return self.id == other.id
+        return NotImplemented
+
+    def __ne__(self, other) -> bool:
+        """Not equal to users with another id."""
+        equal = self.__eq__(other)
+        return equal if equal is NotImplemented else not equal
+
+    def __hash__(self) -> int:
+        """Hash by id."""
+        return hash(self.id)
+
+    @property
+    def is_authenticated(self) -> bool:
+        """Whether or not the user is authenticated."""
+        return True
+
+    @property
+    def is_active(self) -> bool:
+        """Whether or not the user is active."""
+        return True
+
+    @property
+    def is_anonymous(self) -> bool:
+        """Whether or not the user is anonymous."""
+        return False
+
+    def get_id(self) -> str:
+        """Retrieve the ID for this user."""
+        return str(self.id)
+
+    @property
+    def row(self) -> User:
+        """The full User, loaded on first use."""
+        if self._row is None:
+            self._row = User.query.get(self.id)
+        return self._row
+
+    def __getattr__(self, name: str):
+        """Fall back to the full row for everything else."""
+        if name.startswith('_'):
+            raise AttributeError(name)
+        return getattr(self.row, name)
+
+
+def remember(user: User) -> None:
+    """Record a user's identity in the session, e.g. after login or edits."""
+    session[SESSION_KEY] = {
+        'id': user.id,
+        'username': user.username,
+        'issued': int(time.time()),
+    }
+
+
+def forget() -> None:
+    """Drop the recorded identity, e.g. on logout."""
+    session.pop(SESSION_KEY, None)
+
+
+def load(user_id: str) -> SessionUser:
+    """The user for a Flask-Login id, from the session while it is fresh.
+
+    An identity older than ``IDENTITY_TTL`` seconds, or one recorded for
+    a different id (a remember-me login), is reloaded from the database
+    so renames and deletions made elsewhere are noticed.
+    """
+    user_id = int(user_id)
+    identity = session.get(SESSION_KEY)
+    ttl = app.config.get('IDENTITY_TTL', 300)
+    if (identity and identity.get('id') == user_id and
+            time.time() - identity.get('issued', 0) < ttl):
+        return SessionUser(identity['id'], identity['username'])
+
+    row = User.query.get(user_id)
+    if row is None:
+        forget()
+        return None
+    remember(row)
+    return SessionUser(row.id, row.username, row)
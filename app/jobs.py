@@ -0,0 +1,218 @@
+# -*- coding: utf-8 -*-
+#!/usr/bin/env python
+"""Durable background jobs for work that can wait until after the commit."""
+from app import db
+from collections import OrderedDict
+from datetime import datetime, timedelta
+from sqlalchemy import and_, event, or_
+from typing import Callable, List
+import atexit
+import json
+import threading
+
+
+QUEUED = 'queued'
+RUNNING = 'running'
+FAILED = 'failed'
+
+
+class JobQueue(object):
+    """Jobs stored in the ``job`` table and run by a pool of worker threads.
+
+    ``enqueue`` adds the job to the current session, so it commits or rolls
+    back together with the change that caused it. Workers claim due jobs in
+    batches (``FOR UPDATE SKIP LOCKED`` on Postgres, so several worker
+    processes can share the table), hand every claimed job of one kind to
+    a batch handler in a single call, and delete them on success. A failed
+    job is retried with exponential backoff until ``JOBS_MAX_ATTEMPTS``,
+    then left in the table as ``failed``. A job claimed by a worker that
+    died is picked up again after ``JOBS_LEASE`` seconds, so handlers must
+    be safe to run twice.
+
+    Web processes start ``JOBS_LOCAL_WORKERS`` threads on the first commit
+    that queues a job; ``worker.py`` runs a dedicated pool instead.
+    """
+
+    def __init__(self, app=None) -> None:
+        """Create a queue with no handlers, optionally bound to an app."""
+        self.app = None
+        self.handlers = {}
+        self.workers = 0
+        self.batch_size = 100
+        self.max_attempts = 5
+        self.retry_delay = 2
+        self.lease = 300
+        self.poll_interval = 1.0
+        self._threads = []
+        self._wake = threading.Event()
+        self._stop = threading.Event()
+        self._lock = threading.Lock()
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app) -> None:
+        """Read the worker settings and wake workers after commits."""
+        self.app = app
+        self.workers = app.config.get('JOBS_LOCAL_WORKERS', 0)
+        self.batch_size = app.config.get('JOBS_BATCH_SIZE', 100)
+        self.max_attempts = app.config.get('JOBS_MAX_ATTEMPTS', 5)
+        self.retry_delay = app.config.get('JOBS_RETRY_DELAY', 2)
+        self.lease = app.config.get('JOBS_LEASE', 300)
+        self.poll_interval = app.config.get('JOBS_POLL_INTERVAL', 1.0)
+        event.listen(db.session, 'after_commit', self._after_commit)
+        atexit.register(self.stop)
+
+    def handler(self, kind: str, batch: bool=False) -> Callable:
+        """Register the function that runs jobs of a kind.
+
+        A plain handler is called once per job with the payload as keyword
+        arguments; a batch handler is called once per claimed batch with
+        the list of payloads.
+        """
+        def register(func: Callable) -> Callable:
+            self.handlers[kind] = (func, batch)
+            return func
+        return register
+
+    def enqueue(self, kind: str, **payload):
+        """Queue a job in the current session; it runs after the commit."""
+        from app.models import Job
+        job = Job(
+            kind=kind,
+            payload=json.dumps(payload, sort_keys=True),
+            state=QUEUED,
+            attempts=0,
+            run_at=datetime.utcnow()
+        )
+        db.session.add(job)
+        db.session.info['jobs_queued'] = True
+        return job
+
+    def run_pending(self, limit: int=None) -> int:
+        """Claim and run one batch of due jobs; return how many were run."""
+        claimed = self._claim(limit or self.batch_size)
+        groups = OrderedDict()
+        for job in claimed:
+            groups.setdefault(job[1], []).append(job)
+        for kind, jobs in groups.items():
+            func, batch = self.handlers.get(kind, (None, False))
+            units = [jobs] if batch else [[job] for job in jobs]
+            for unit in units:
+                self._run(kind, func, batch, unit)
+        return len(claimed)
+
+    def drain(self) -> int:
+        """Run due jobs until none are left; return how many were run."""
+        total = 0
+        while True:
+            done = self.run_pending()
+            if not done:
+                return total
+            total += done
+
+    def start(self, workers: int=None) -> None:
+        """Start the worker threads if they aren't running yet."""
+        with self._lock:
+            if self._threads:
+                return
+            self._stop.clear()
+            for number in range(workers or self.workers):
+                thread = threading.Thread(
+                    target=self._work, name=f'job-worker-{number}',
+                    daemon=True
+                )
+                thread.start()
+                self._threads.append(thread)
+
+    def stop(self, timeout: float=5) -> None:
+        """Ask the worker threads to finish their batch and exit."""
+        with self._lock:
+            threads, self._threads = self._threads, []
+        self._stop.set()
+        self._wake.set()
+        for thread in threads:
+            thread.join(timeout)
+
+    def _after_commit(self, session) -> None:
+        """Wake the local workers when a commit queued jobs."""
+        if session.info.pop('jobs_queued', False) and self.workers:
+            self.start()
+            self._wake.set()
+
+    def _work(self) -> None:
+        """Worker thread loop: run batches, sleep when the queue is empty."""
+        with self.app.app_context():
+            while not self._stop.is_set():
+                try:
+                    done = self.run_pending()
+                except Exception:
+                    self.app.logger.exception('job worker failed')
+                    done = 0
+                finally:
+                    db.session.remove()
+                if not done:
+                    self._wake.wait(self.poll_interval)
+                    self._wake.clear()
+
+    def _claim(self, limit: int) -> List[tuple]:
+        """Mark up to limit due jobs as running; return their details."""
+        from app.models import Job
+        now = datetime.utcnow()
+        query = Job.query.filter(or_(
+            and_(Job.state == QUEUED, Job.run_at <= now),
+            and_(
+                Job.state == RUNNING,
+                Job.locked_at < now - timedelta(seconds=self.lease)
+            ),
+        )).order_by(Job.id).limit(limit)
+        if db.engine.dialect.name == 'postgresql':
+            query = query.with_for_update(skip_locked=True)
+        claimed = []
+        for job in query:
+            job.state = RUNNING
+            job.locked_at = now
+            job.attempts += 1
+            claimed.append(
+                (job.id, job.kind, json.loads(job.payload), job.attempts)
+            )
+        db.session.commit()
+        return claimed
+
+    def _run(self, kind: str, func: Callable, batch: bool,
+             unit: List[tuple]) -> None:
+        """Run one handler call and delete or reschedule its jobs."""
+        from app.models import Job
+        ids = [job[0] for job in unit]
+        try:
+            if func is None:
+                raise LookupError(f'no handler for {kind!r} jobs')
+            if batch:
+                func([job[2] for job in unit])
+            else:
+                func(**unit[0][2])
+            Job.query.filter(Job.id.in_(ids)).delete(
+                synchronize_session=False
+            )
+            db.session.commit()
+        except Exception as error:
+            db.session.rollback()
+            self.app.logger.exception('%s job(s) %s failed', kind, ids)
+            self._retry(unit, error)
+
+    def _retry(self, unit: List[tuple], error: Exception) -> None:
+        """Reschedule failed jobs with backoff, or give up on them."""
+        from app.models import Job
+        now = datetime.utcnow()
+        for job_id, _, _, attempts in unit:
+            values = {'locked_at': None, 'last_error': repr(error)[:2000]}
+            if attempts >= self.max_attempts:
+                values['state'] = FAILED
+            else:
+                values['state'] = QUEUED
+                values['run_at'] = now + timedelta(
+                    seconds=self.retry_delay * 2 ** (attempts - 1)
+                )
+            Job.query.filter(Job.id == job_id).update(
+                values, synchronize_session=False
+            )
+        db.session.commit()
@@ -0,0 +1,159 @@
+# -*- coding: utf-8 -*-
+#!/usr/bin/env python
+"""Write-behind buffer for the User.last_seen column."""
+from app import db
+from datetime import datetime, timedelta
+from sqlalchemy import case
+import atexit
+import threading
+import time
+
+
+class LastSeenTracker(object):
+    """Merge last_seen updates in memory and write them out in batches.
+
+    Every authenticated request records a timestamp here instead of
+    committing to the ``user`` table. Pending timestamps are merged per user
+    (newest wins) and written with a single UPDATE once the batch grows past
+    ``LAST_SEEN_BATCH_SIZE`` or the oldest pending entry is older than
+    ``LAST_SEEN_STALENESS`` seconds, and once more at interpreter shutdown.
+    A timer started with the first pending entry flushes it on time even
+    when no further requests come in; any other flush cancels it.
+
+    A batch that fails to write is logged and kept, and writing is not
+    tried again for another ``LAST_SEEN_STALENESS`` seconds, so a database
+    problem never fails the requests that record visits.
+    """
+
+    def __init__(self, app=None) -> None:
+        """Set up an empty buffer, optionally bound to an app."""
+        self.app = None
+        self.staleness = timedelta(seconds=60)
+        self.batch_size = 500
+        self._pending = {}
+        self._oldest = None
+        self._retry_at = 0.0
+        self._timer = None
+        self._lock = threading.Lock()
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app) -> None:
+        """Read the flush thresholds from the app config."""
+        self.app = app
+        self.staleness = timedelta(
+            seconds=app.config.get('LAST_SEEN_STALENESS', 60)
+        )
+        self.batch_size = app.config.get('LAST_SEEN_BATCH_SIZE', 500)
+        atexit.register(self.flush_on_shutdown)
+
+    def record(self, user_id: int, when: datetime=None) -> None:
+        """Remember that a user was seen, flushing if a threshold is hit."""
+        when = when or datetime.utcnow()
+        with self._lock:
+            current = self._pending.get(user_id)
+            if current is None or when > current:
+                self._pending[user_id] = when
+            if self._oldest is None:
+                self._oldest = when
+                self._schedule()
+            due = time.monotonic() >= self._retry_at and (
+                len(self._pending) >= self.batch_size or
+                when - self._oldest >= self.staleness
+            )
+        if due:
+            self.flush()
+
+    def last_seen(self, user) -> datetime:
+        """The freshest known last_seen for a user, pending or stored."""
+        pending = self._pending.get(user.id)
+        if pending is None:
+            return user.last_seen
+        if user.last_seen is None or pending > user.last_seen:
+            return pending
+        return user.last_seen
+
+    def flush(self) -> int:
+        """Write every pending timestamp in one UPDATE; return rows written.
+
+        On failure the batch is put back and 0 returned.
+        """
+        with self._lock:
+            batch, self._pending = self._pending, {}
+            self._oldest = None
+            if self._timer is not None:
+                self._timer.cancel()
+                self._timer = None
+        if not batch:
+            return 0
+
+        from app.models import User
+        statement = User.__table__.update().where(
+            User.id.in_(batch.keys())
+        ).values(
+            last_seen=case(batch, value=User.id)
+        )
+        try:
+            with db.engine.begin() as connection:
+                connection.execute(statement)
+        except Exception:
+            if self.app is not None:
+                self.app.logger.exception(
+                    'Could not flush %d last_seen timestamps', len(batch)
+                )
+            self._restore(batch)
+            return 0
+        return len(batch)
+
+    def flush_on_shutdown(self) -> None:
+        """Flush whatever is left when the process exits."""
+        if not self._pending or self.app is None:
+            return
+        with self.app.app_context():
+            self.flush()
+
+    def clear(self) -> None:
+        """Drop every pending timestamp without writing it."""
+        with self._lock:
+            self._pending = {}
+            self._oldest = None
+            self._retry_at = 0.0
+            if self._timer is not None:
+                self._timer.cancel()
+                self._timer = None
+
+    def _schedule(self) -> None:
+        """Start the staleness timer unless one is running; needs the lock.
+
+        It is started lazily, by whichever process records first, so a
+        forked server worker gets a timer of its own.
+        """
+        if self._timer is None and self.app is not None:
+            self._timer = threading.Timer(
+                self.staleness.total_seconds(), self._flush_when_due
+            )
+            self._timer.daemon = True
+            self._timer.start()
+
+    def _flush_when_due(self) -> None:
+        """Flush from the timer thread."""
+        with self._lock:
+            self._timer = None
+        with self.app.app_context():
+            self.flush()
+
+    def _restore(self, batch: dict) -> None:
+        """Put a failed batch back, keeping anything newer recorded since.
+
+        The next attempt waits for the staleness timer, however full the
+        buffer gets meanwhile.
+        """
+        with self._lock:
+            for user_id, when in batch.items():
+                current = self._pending.get(user_id)
+                if current is None or when > current:
+                    self._pending[user_id] = when
+            if self._oldest is None:
+                self._oldest = min(self._pending.values())
+            self._retry_at = time.monotonic() + self.staleness.total_seconds()
+            self._schedule()
@@ -0,0 +1,444 @@
+# -*- coding: utf-8 -*-
+#!/usr/bin/env python
+"""Online schema migrations: concurrent indexes and throttled backfills."""
+from abc import ABC, abstractmethod
+from app import app, db
+from app.models import schema_migration
+from datetime import datetime
+from sqlalchemy import text
+from sqlalchemy.exc import OperationalError
+from typing import Callable, Dict, List, Sequence
+import importlib.util
+import json
+import os
+import re
+import time
+
+
+RUNNING = 'running'
+DONE = 'done'
+FILENAME = re.compile(r'^(\d{3})_(\w+)\.py$')
+
+
+def quote(name: str) -> str:
+    """A table or column name, quoted if the database needs it."""
+    return db.engine.dialect.identifier_preparer.quote(name)
+
+
+def estimate_rows(connection, sql: str, params: dict=None) -> int:
+    """Rows a SELECT would return: the planner's guess on Postgres.
+
+    Elsewhere the rows are counted, which is exact but reads them all.
+    """
+    params = params or {}
+    if connection.dialect.name == 'postgresql':
+        plan = connection.execute(
+            text('EXPLAIN (FORMAT JSON) ' + sql), params
+        ).scalar()
+        if isinstance(plan, str):
+            plan = json.loads(plan)
+        return int(plan[0]['Plan']['Plan Rows'])
+    return connection.execute(
+        text(f'SELECT count(*) FROM ({sql}) AS counted'), params
+    ).scalar()
+
+
+def lift_statement_timeout(connection, local: bool=True) -> None:
+    """Let long migration statements outlive DATABASE_STATEMENT_TIMEOUT.
+
+    A LOCAL setting ends with the transaction; otherwise the caller must
+    RESET it before the connection goes back to the pool.
+    """
+    if connection.dialect.name == 'postgresql':
+        connection.execute(text(
+            'SET %sstatement_timeout = 0' % ('LOCAL ' if local else '')
+        ))
+
+
+class Progress(object):
+    """Where one step of a migration got to, saved as it goes."""
+
+    def __init__(self, version: int, step: int, name: str,
+                 last_key: int=None, row_count: int=0) -> None:
+        """Progress of a step, resumed from a saved position if any."""
+        self.version = version
+        self.step = step
+        self.name = name
+        self.last_key = last_key
+        self.row_count = row_count
+
+    def save(self, connection, last_key: int=None, rows: int=0,
+             state: str=RUNNING) -> None:
+        """Record progress in connection's transaction."""
+        self.last_key = last_key if last_key is not None else self.last_key
+        self.row_count += rows
+        connection.execute(schema_migration.delete().where(
+            (schema_migration.c.version == self.version) &
+            (schema_migration.c.step == self.step)
+        ))
+        connection.execute(schema_migration.insert().values(
+            version=self.version, step=self.step, name=self.name,
+            state=state, last_key=self.last_key, row_count=self.row_count,
+            updated_at=datetime.utcnow()
+        ))
+
+    def finish(self, connection) -> None:
+        """Record the step as done in connection's transaction."""
+        self.save(connection, state=DONE)
+
+
+class Step(ABC):
+    """One resumable unit of a migration."""
+
+    @abstractmethod
+    def describe(self) -> str:
+        """A one-line summary for status and dry-run output."""
+
+    def estimate(self, connection, progress: Progress) -> int:
+        """Roughly how many rows running the step would touch."""
+        return 0
+
+    @abstractmethod
+    def run(self, migrator: 'Migrator', progress: Progress) -> None:
+        """Apply the step, recording its progress."""
+
+
+class SQL(Step):
+    """A quick DDL or data statement, e.g. adding a nullable column.
+
+    On Postgres the statement waits at most ``MIGRATION_LOCK_TIMEOUT``
+    seconds for its locks, so it never queues the site's queries behind a
+    long transaction; it is retried ``MIGRATION_LOCK_RETRIES`` times.
+    """
+
+    def __init__(self, statement: str) -> None:
+        """A step running statement in one short transaction."""
+        self.statement = statement
+
+    def describe(self) -> str:
+        """The statement itself."""
+        return ' '.join(self.statement.split())
+
+    def run(self, migrator: 'Migrator', progress: Progress) -> None:
+        """Run the statement, retrying when it can't get its locks."""
+        for attempt in range(migrator.lock_retries + 1):
+            try:
+                with db.engine.begin() as connection:
+                    if connection.dialect.name == 'postgresql':
+                        connection.execute(text(
+                            "SET LOCAL lock_timeout = '%dms'"
+                            % (migrator.lock_timeout * 1000)
+                        ))
+                    connection.execute(text(self.statement))
+                    progress.finish(connection)
+                return
+            except OperationalError as error:
+                if ('lock' not in str(error).lower() or
+                        attempt == migrator.lock_retries):
+                    raise
+                migrator.report(f'  lock not granted, retry {attempt + 1}')
+                time.sleep(2 ** attempt)
+
+
+class CreateIndex(Step):
+    """Build an index without blocking writes to its table.
+
+    Postgres builds it ``CONCURRENTLY``, outside any transaction. A build
+    interrupted half way leaves an invalid index behind; it is dropped and
+    built again on the next run.
+    """
+
+    def __init__(self, name: str, table: str, columns: Sequence[str],
+                 unique: bool=False, where: str=None) -> None:
+        """An index over columns (SQL expressions such as ``id DESC``)."""
+        self.name = name
+        self.table = table
+        self.columns = list(columns)
+        self.unique = unique
+        self.where = where
+
+    def describe(self) -> str:
+        """Name and shape of the index."""
+        return f"create index {self.name} on {self.table} " \
+            f"({', '.join(self.columns)})"
+
+    def estimate(self, connection, progress: Progress) -> int:
+        """Every row of the table is read to build the index."""
+        return estimate_rows(connection, f'SELECT 1 FROM {quote(self.table)}')
+
+    def sql(self, concurrently: bool) -> str:
+        """The CREATE INDEX statement."""
+        statement = 'CREATE %sINDEX %sIF NOT EXISTS %s ON %s (%s)' % (
+            'UNIQUE ' if self.unique else '',
+            'CONCURRENTLY ' if concurrently else '',
+            quote(self.name), quote(self.table), ', '.join(self.columns)
+        )
+        if self.where:
+            statement += f' WHERE {self.where}'
+        return statement
+
+    def run(self, migrator: 'Migrator', progress: Progress) -> None:
+        """Build the index, concurrently where the database can."""
+        started = time.perf_counter()
+        if db.engine.dialect.name == 'postgresql':
+            with db.engine.connect() as connection:
+                connection = connection.execution_options(
+                    isolation_level='AUTOCOMMIT'
+                )
+                # a cancelled concurrent build leaves an invalid index
+                lift_statement_timeout(connection, local=False)
+                try:
+                    invalid = connection.execute(text(
+                        'SELECT NOT indisvalid FROM pg_index JOIN pg_class '
+                        'ON pg_class.oid = pg_index.indexrelid '
+                        'WHERE relname = :name'
+                    ), {'name': self.name}).scalar()
+                    if invalid:
+                        migrator.report(f'  dropping invalid {self.name}')
+                        connection.execute(text(
+                            f'DROP INDEX CONCURRENTLY {quote(self.name)}'
+                        ))
+                    connection.execute(text(self.sql(concurrently=True)))
+                finally:
+                    connection.execute(text('RESET statement_timeout'))
+            with db.engine.begin() as connection:
+                progress.finish(connection)
+        else:
+            with db.engine.begin() as connection:
+                lift_statement_timeout(connection)
+                connection.execute(text(self.sql(concurrently=False)))
+                progress.finish(connection)
+        migrator.report(
+            f'  built {self.name} in {time.perf_counter() - started:.1f}s'
+        )
+
+
+class Backfill(Step):
+    """Update the rows matching ``where`` a chunk at a time, by key.
+
+    Either ``set`` is an SQL assignment applied to each chunk, or
+    ``compute`` is called with each chunk's rows (key first, then
+    ``columns``) outside any transaction and returns one dict of new
+    column values per row. Rows are written back only if they still match
+    ``where``, so concurrent changes made meanwhile win. Each chunk
+    commits together with its progress, so an interrupted backfill resumes
+    after the last chunk written, and the runner sleeps ``throttle``
+    seconds between chunks to leave the database room for the site.
+    """
+
+    def __init__(self, table: str, where: str, set: str=None,
+                 compute: Callable[[list], List[Dict]]=None,
+                 columns: Sequence[str]=(), key: str='id',
+                 chunk_size: int=None) -> None:
+        """A backfill of table using either set or compute."""
+        if (set is None) == (compute is None):
+            raise ValueError('a backfill takes exactly one of set or compute')
+        self.table = table
+        self.where = where
+        self.set = set
+        self.compute = compute
+        self.columns = list(columns)
+        self.key = key
+        self.chunk_size = chunk_size
+
+    def describe(self) -> str:
+        """Table and condition of the backfill."""
+        return f'backfill {self.table} where {self.where}'
+
+    def estimate(self, connection, progress: Progress) -> int:
+        """Matching rows after the last key already done."""
+        sql, params = self._remaining(progress.last_key)
+        return estimate_rows(connection, sql, params)
+
+    def run(self, migrator: 'Migrator', progress: Progress) -> None:
+        """Update chunk after chunk until no matching rows are left."""
+        table, key = quote(self.table), quote(self.key)
+        chunk_size = self.chunk_size or migrator.chunk_size
+        with db.engine.connect() as connection:
+            total = progress.row_count + self.estimate(connection, progress)
+        started, done = time.perf_counter(), 0
+        while True:
+            sql, params = self._remaining(progress.last_key)
+            with db.engine.begin() as connection:
+                lift_statement_timeout(connection)
+                rows = connection.execute(text(
+                    f'{sql} ORDER BY {key} LIMIT :chunk_size'
+                ), dict(params, chunk_size=chunk_size)).fetchall()
+            if not rows:
+                break
+            if self.compute is not None:
+                updates = [
+                    dict(values, _key=row[0])
+                    for row, values in zip(rows, self.compute(rows))
+                ]
+            with db.engine.begin() as connection:
+                lift_statement_timeout(connection)
+                if self.compute is None:
+                    connection.execute(text(
+                        f'UPDATE {table} SET {self.set} WHERE {key} >= :first'
+                        f' AND {key} <= :last AND ({self.where})'
+                    ), {'first': rows[0][0], 'last': rows[-1][0]})
+                elif updates:
+                    assignments = ', '.join(
+                        f'{quote(name)} = :{name}'
+                        for name in updates[0] if name != '_key'
+                    )
+                    connection.execute(text(
+                        f'UPDATE {table} SET {assignments} '
+                        f'WHERE {key} = :_key AND ({self.where})'
+                    ), updates)
+                progress.save(connection, rows[-1][0], len(rows))
+            done += len(rows)
+            elapsed = time.perf_counter() - started
+            rate = done / elapsed if elapsed else 0.0
+            left = max(total - progress.row_count, 0)
+            migrator.report(
+                f'  {self.table}: {progress.row_count}/~{total} rows, '
+                f'{rate:.0f} rows/s, ~{left / rate if rate else 0:.0f}s left'
+            )
+            time.sleep(migrator.throttle)
+        with db.engine.begin() as connection:
+            progress.finish(connection)
+
+    def _remaining(self, last_key: int) -> tuple:
+        """The SELECT of matching rows after last_key, and its parameters."""
+        columns = ', '.join(quote(c) for c in [self.key] + self.columns)
+        sql = f'SELECT {columns} FROM {quote(self.table)} ' \
+            f'WHERE ({self.where})'
+        if last_key is None:
+            return sql, {}
+        return sql + f' AND {quote(self.key)} > :last_key', \
+            {'last_key': last_key}
+
+
+class Migration(object):
+    """A numbered migrations/NNN_name.py module and its steps."""
+
+    def __init__(self, version: int, name: str, doc: str,
+                 steps: List[Step]) -> None:
+        """A migration with its version, name, description and steps."""
+        self.version = version
+        self.name = name
+        self.doc = doc
+        self.steps = steps
+
+    @classmethod
+    def load(cls, path: str) -> 'Migration':
+        """Import a migration module from path."""
+        version, name = FILENAME.match(os.path.basename(path)).groups()
+        spec = importlib.util.spec_from_file_location(
+            f'migrations.m{version}_{name}', path
+        )
+        module = importlib.util.module_from_spec(spec)
+        spec.loader.exec_module(module)
+        doc = (module.__doc__ or name).strip().splitlines()[0]
+        return cls(int(version), name, doc, list(module.steps))
+
+
+class Migrator(object):
+    """Applies the migrations in ``MIGRATIONS_DIR`` that haven't run yet.
+
+    Steps run in order and each records its progress in the
+    ``schema_migration`` table as it goes, so a run that is interrupted,
+    or fails, picks up where it stopped the next time. A dry run prints
+    every pending step with an estimate of the rows it would touch.
+    """
+
+    def __init__(self, directory: str=None, chunk_size: int=None,
+                 throttle: float=None, out: Callable[[str], None]=print
+                 ) -> None:
+        """A runner over directory, with app config defaults."""
+        self.directory = directory or app.config['MIGRATIONS_DIR']
+        self.chunk_size = chunk_size or app.config.get(
+            'MIGRATION_CHUNK_SIZE', 1000
+        )
+        self.throttle = throttle if throttle is not None else \
+            app.config.get('MIGRATION_THROTTLE', 0.05)
+        self.lock_timeout = app.config.get('MIGRATION_LOCK_TIMEOUT', 5)
+        self.lock_retries = app.config.get('MIGRATION_LOCK_RETRIES', 5)
+        self.out = out
+
+    def report(self, message: str) -> None:
+        """Print a progress line."""
+        self.out(message)
+
+    def migrations(self) -> List[Migration]:
+        """Every migration in the directory, oldest first."""
+        return [
+            Migration.load(os.path.join(self.directory, filename))
+            for filename in sorted(os.listdir(self.directory))
+            if FILENAME.match(filename)
+        ]
+
+    def state(self) -> Dict[tuple, tuple]:
+        """(state, last_key, row_count) of every step recorded so far."""
+        schema_migration.create(db.engine, checkfirst=True)
+        with db.engine.connect() as connection:
+            return {
+                (row.version, row.step):
+                    (row.state, row.last_key, row.row_count)
+                for row in connection.execute(schema_migration.select())
+            }
+
+    def status(self) -> List[tuple]:
+        """(migration, steps done) for every migration."""
+        state = self.state()
+        return [(migration, sum(
+            state.get((migration.version, number), ('',))[0] == DONE
+            for number in range(len(migration.steps))
+        )) for migration in self.migrations()]
+
+    def pending(self, target: int=None) -> List[Migration]:
+        """Migrations up to target with steps still to run."""
+        return [
+            migration for migration, done in self.status()
+            if done < len(migration.steps) and
+            (target is None or migration.version <= target)
+        ]
+
+    def upgrade(self, target: int=None, dry_run: bool=False) -> List[int]:
+        """Run (or, dry, just describe) pending migrations up to target."""
+        state = self.state()
+        applied = []
+        for migration in self.pending(target):
+            self.report(f'{migration.version:03d} {migration.doc}')
+            for number, step in enumerate(migration.steps):
+                saved, last_key, row_count = state.get(
+                    (migration.version, number), (None, None, 0)
+                )
+                if saved == DONE:
+                    continue
+                progress = Progress(
+                    migration.version, number,
+                    f'{migration.version:03d}_{migration.name}',
+                    last_key, row_count
+                )
+                if dry_run:
+                    with db.engine.connect() as connection:
+                        rows = step.estimate(connection, progress)
+                    resumed = f', resuming after key {last_key}' \
+                        if last_key is not None else ''
+                    self.report(
+                        f'  {step.describe()}: ~{rows} rows{resumed}'
+                    )
+                    continue
+                self.report(f'  {step.describe()}')
+                step.run(self, progress)
+            applied.append(migration.version)
+        return applied
+
+    def mark_applied(self, target: int=None) -> List[int]:
+        """Record migrations as done without running them.
+
+        For databases created with ``db.create_all()``, which already have
+        the schema the migrations would build.
+        """
+        migrations = self.pending(target)
+        with db.engine.begin() as connection:
+            for migration in migrations:
+                for number in range(len(migration.steps)):
+                    Progress(
+                        migration.version, number,
+                        f'{migration.version:03d}_{migration.name}'
+                    ).finish(connection)
+        return [migration.version for migration in migrations]
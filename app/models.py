@@ -1,13 +1,25 @@
 # -*- coding: utf-8 -*-
 #!/usr/bin/env python
-from app import db
-from typing import Union
+from app import db, follow_graph, fragments, timelines
+from app.bulk import insert_ignore
+from app.pagination import newer_key
+from sqlalchemy import tuple_
+from sqlalchemy.sql import ClauseElement
+from typing import Iterable, List, Union
 
 
 followers = db.Table(
     'followers',
-    db.Column('follower_id', db.Integer, db.ForeignKey('user.id')),
-    db.Column('followed_id', db.Integer, db.ForeignKey('user.id')),
+    db.Column(
+        'follower_id', db.Integer, db.ForeignKey('user.id'), primary_key=True
+    ),
+    db.Column(
+        'followed_id', db.Integer, db.ForeignKey('user.id'), primary_key=True
+    ),
+    # the primary key serves follower -> followed; this serves the reverse
+    db.Index(
+        'ix_followers_followed_id_follower_id', 'followed_id', 'follower_id'
+    ),
 )
 
 
@@ -20,6 +32,13 @@ class User(db.Model):
     posts = db.relationship('Post', backref='author', lazy='dynamic')
     about_me = db.Column(db.Unicode)
     last_seen = db.Column(db.DateTime)
+    follower_count = db.Column(db.Integer, default=0, server_default='0')
+    following_count = db.Column(db.Integer, default=0, server_default='0')
+    post_count = db.Column(db.Integer, default=0, server_default='0')
+    # bumped when the user's follows change and when their name or profile
+    # changes; home page ETags are built from them
+    follows_version = db.Column(db.Integer, default=0, server_default='0')
+    profile_version = db.Column(db.Integer, default=0, server_default='0')
     followed = db.relationship(
         'User',
         secondary=followers,
@@ -56,17 +75,116 @@ class User(db.Model):
         """Follow a new user."""
         if not self.is_following(user):
             self.followed.append(user)
+            timelines.backfill(self, user)
+            self.increment('following_count')
+            self.increment('follows_version')
+            user.increment('follower_count')
+            follow_graph.invalidate_on_commit(db.session, self.id, user.id)
+            fragments.invalidate_home(self.id)
             return self
 
     def unfollow(self, user):
-        """Unfollow one of an existing set of users."""
-        if self.is_following(user):
-            self.followed.remove(user)
-            return self
+        """Unfollow one of an existing set of users.
+
+        The edge is deleted by a plain statement rather than checked in the
+        follow graph cache, which can be stale; the counters only move when
+        a row was actually deleted.
+        """
+        deleted = db.session.execute(followers.delete().where(
+            (followers.c.follower_id == self.id) &
+            (followers.c.followed_id == user.id)
+        )).rowcount
+        if not deleted:
+            follow_graph.invalidate(self.id, user.id)
+            return None
+        timelines.prune(self, user)
+        self.increment('following_count', -1)
+        self.increment('follows_version')
+        user.increment('follower_count', -1)
+        follow_graph.invalidate_on_commit(db.session, self.id, user.id)
+        fragments.invalidate_home(self.id)
+        return self
+
+    def follow_many(self, user_ids: Iterable[int]) -> List[int]:
+        """Follow many users at once; return the ids newly followed.
+
+        The edges go in with one INSERT that skips existing ones, and the
+        counters, caches and stored timeline are updated once for the lot.
+        """
+        wanted = sorted(set(user_ids))
+        if not wanted:
+            return []
+        rows = [{'follower_id': self.id, 'followed_id': i} for i in wanted]
+        if db.engine.dialect.name == 'postgresql':
+            added = insert_ignore(followers, rows, followers.c.followed_id)
+        else:
+            existing = self._followed_among(wanted)
+            insert_ignore(followers, rows)
+            added = [i for i in wanted if i not in existing]
+        self._edges_changed(added, 1)
+        return added
+
+    def unfollow_many(self, user_ids: Iterable[int]) -> List[int]:
+        """Unfollow many users at once; return the ids actually unfollowed."""
+        wanted = sorted(set(user_ids))
+        if not wanted:
+            return []
+        removed = sorted(self._followed_among(wanted))
+        if removed:
+            db.session.execute(followers.delete().where(
+                (followers.c.follower_id == self.id) &
+                followers.c.followed_id.in_(removed)
+            ))
+        self._edges_changed(removed, -1)
+        return removed
+
+    def _followed_among(self, user_ids: List[int]) -> set:
+        """Which of these users this user follows, from the database."""
+        rows = db.session.query(followers.c.followed_id).filter(
+            followers.c.follower_id == self.id,
+            followers.c.followed_id.in_(user_ids)
+        )
+        return {row[0] for row in rows}
+
+    def _edges_changed(self, user_ids: List[int], delta: int) -> None:
+        """Update counters, caches and timelines after a bulk (un)follow."""
+        if not user_ids:
+            return
+        self.increment('following_count', delta * len(user_ids))
+        self.increment('follows_version')
+        db.session.execute(User.__table__.update().where(
+            User.id.in_(user_ids)
+        ).values(follower_count=User.follower_count + delta))
+        follow_graph.invalidate_on_commit(db.session, self.id, *user_ids)
+        fragments.invalidate_home(self.id)
+        if timelines.enabled and timelines.store.has(self.id):
+            db.session.flush()
+            timelines.materialize(self, timelines.celebrity_ids(self))
+
+    def increment(self, counter: str, delta: int=1) -> None:
+        """Adjust a denormalized counter in SQL when the session flushes."""
+        pending = getattr(self, counter)
+        if not isinstance(pending, ClauseElement):
+            pending = getattr(User, counter)
+        setattr(self, counter, pending + delta)
 
     def is_following(self, user) -> bool:
         """Check if a given user is being followed."""
-        return self.followed.filter(followers.c.followed_id == user.id).count() > 0
+        return user.id in follow_graph.following(self.id)
+
+    def new_posts_count(self, since: str=None, cap: int=100) -> int:
+        """How many followed posts are newer than a cursor, up to cap.
+
+        ``since`` must be a NEWER cursor; anything else raises ValueError.
+        """
+        query = db.session.query(Post.id).join(
+            followers, followers.c.followed_id == Post.user_id
+        ).filter(followers.c.follower_id == self.id)
+        if since is not None:
+            query = query.filter(
+                tuple_(Post.timestamp, Post.id) > tuple_(*newer_key(since))
+            )
+        return query.limit(cap).count()
 
     def followed_posts(self):
         """Retrieve all of the posts from users this user follows."""
@@ -89,6 +207,47 @@ class Post(db.Model):
     timestamp = db.Column(db.DateTime)
     user_id = db.Column(db.Integer, db.ForeignKey('user.id'))
 
+    __table_args__ = (
+        db.Index(
+            'ix_post_user_id_timestamp',
+            user_id, timestamp.desc(), id.desc()
+        ),
+    )
+
     def __repr__(self) -> str:
         """String representation of the Post model."""
         return f'<Post {self.title}>'
+
+
+class Job(db.Model):
+    """A unit of deferred work, queued in the transaction that needs it."""
+
+    id = db.Column(db.Integer, primary_key=True)
+    kind = db.Column(db.Unicode(length=80), nullable=False)
+    payload = db.Column(db.Unicode, nullable=False, default='{}')
+    state = db.Column(db.Unicode(length=16), nullable=False, default='queued')
+    attempts = db.Column(db.Integer, nullable=False, default=0)
+    run_at = db.Column(db.DateTime, nullable=False)
+    locked_at = db.Column(db.DateTime)
+    last_error = db.Column(db.Unicode)
+
+    __table_args__ = (
+        db.Index('ix_job_state_run_at', state, run_at),
+    )
+
+    def __repr__(self) -> str:
+        """String representation of the Job model."""
+        return f'<Job {self.kind} | id: {self.id} | {self.state}>'
+
+
+# progress of online migrations, one row per step of each migration
+schema_migration = db.Table(
+    'schema_migration',
+    db.Column('version', db.Integer, primary_key=True),
+    db.Column('step', db.Integer, primary_key=True),
+    db.Column('name', db.Unicode(length=200), nullable=False),
+    db.Column('state', db.Unicode(length=16), nullable=False),
+    db.Column('last_key', db.BigInteger),
+    db.Column('row_count', db.Integer, nullable=False, default=0),
+    db.Column('updated_at', db.DateTime, nullable=False),
+)
@@ -0,0 +1,133 @@
+# -*- coding: utf-8 -*-
+#!/usr/bin/env python
+"""Keyset (cursor) pagination for post listings."""
+from base64 import urlsafe_b64decode, urlsafe_b64encode
+from datetime import datetime
+from sqlalchemy import tuple_
+from sqlalchemy.orm import joinedload
+from typing import Tuple
+
+
+OLDER = 'o'
+NEWER = 'n'
+
+
+def encode_cursor(direction: str, timestamp: datetime, post_id: int) -> str:
+    """Build an opaque cursor pointing just past the given post."""
+    raw = f'{direction}|{timestamp.isoformat()}|{post_id}'
+    return urlsafe_b64encode(raw.encode('utf-8')).decode('ascii').rstrip('=')
+
+
+def decode_cursor(cursor: str) -> Tuple[str, datetime, int]:
+    """Unpack a cursor, raising ValueError if it has been tampered with."""
+    try:
+        padded = cursor + '=' * (-len(cursor) % 4)
+        raw = urlsafe_b64decode(padded.encode('ascii')).decode('utf-8')
+        direction, stamp, post_id = raw.split('|')
+        if direction not in (OLDER, NEWER):
+            raise ValueError(direction)
+        if '.' in stamp:
+            timestamp = datetime.strptime(stamp, '%Y-%m-%dT%H:%M:%S.%f')
+        else:
+            timestamp = datetime.strptime(stamp, '%Y-%m-%dT%H:%M:%S')
+        return direction, timestamp, int(post_id)
+    except (TypeError, ValueError, UnicodeError) as error:
+        raise ValueError(f'Invalid cursor: {cursor!r}') from error
+
+
+def newer_key(cursor: str) -> Tuple[datetime, int]:
+    """The (timestamp, id) a newer-posts cursor points past.
+
+    Raises ValueError for anything but an untampered NEWER cursor.
+    """
+    direction, timestamp, post_id = decode_cursor(cursor)
+    if direction != NEWER:
+        raise ValueError(f'Not a newer-posts cursor: {cursor!r}')
+    return timestamp, post_id
+
+
+class CursorPage(object):
+    """One page of posts plus the cursors for its neighbours."""
+
+    def __init__(self, items: list, has_prev: bool, has_next: bool) -> None:
+        """Hold the page items and whether there is anything around them."""
+        self.items = items
+        self.has_prev = has_prev and bool(items)
+        self.has_next = has_next and bool(items)
+
+    @property
+    def prev_cursor(self) -> str:
+        """Cursor for the page of newer posts, if there is one."""
+        if not self.has_prev:
+            return None
+        first = self.items[0]
+        return encode_cursor(NEWER, first.timestamp, first.id)
+
+    @property
+    def top_cursor(self) -> str:
+        """Cursor for anything newer than this page, even if nothing is."""
+        if not self.items:
+            return None
+        first = self.items[0]
+        return encode_cursor(NEWER, first.timestamp, first.id)
+
+    @property
+    def next_cursor(self) -> str:
+        """Cursor for the page of older posts, if there is one."""
+        if not self.has_next:
+            return None
+        last = self.items[-1]
+        return encode_cursor(OLDER, last.timestamp, last.id)
+
+
+def cursor_page(rows: list, direction: str, per_page: int) -> CursorPage:
+    """The page for up to per_page + 1 rows fetched past a cursor.
+
+    Rows come newest first, or oldest first for a NEWER cursor, just as
+    the keyset queries below return them.
+    """
+    if direction is None:
+        return CursorPage(rows[:per_page], False, len(rows) > per_page)
+    if direction == OLDER:
+        return CursorPage(rows[:per_page], True, len(rows) > per_page)
+    items = list(reversed(rows[:per_page]))
+    return CursorPage(items, len(rows) > per_page, True)
+
+
+def paginate_posts(query, cursor: str=None, per_page: int=20,
+                   columns: list=None) -> CursorPage:
+    """Page a Post query newest-first by (timestamp, id) without OFFSET.
+
+    One extra row is fetched to learn whether another page exists, so no
+    COUNT query is needed, and authors are joined in so rendering the page
+    issues no further queries. Given columns (which must include ones
+    labelled ``id`` and ``timestamp``), only those are selected and the
+    items are plain rows instead of Post objects. Raises ValueError for a
+    malformed cursor.
+    """
+    from app.models import Post
+    key = tuple_(Post.timestamp, Post.id)
+    if columns:
+        query = query.order_by(None).with_entities(*columns)
+    else:
+        query = query.order_by(None).options(joinedload(Post.author))
+    if cursor is None:
+        rows = query.order_by(
+            Post.timestamp.desc(), Post.id.desc()
+        ).limit(per_page + 1).all()
+        return cursor_page(rows, None, per_page)
+
+    direction, timestamp, post_id = decode_cursor(cursor)
+    if direction == OLDER:
+        rows = query.filter(
+            key < tuple_(timestamp, post_id)
+        ).order_by(
+            Post.timestamp.desc(), Post.id.desc()
+        ).limit(per_page + 1).all()
+    else:
+        rows = query.filter(
+            key > tuple_(timestamp, post_id)
+        ).order_by(
+            Post.timestamp.asc(), Post.id.asc()
+        ).limit(per_page + 1).all()
+    return cursor_page(rows, direction, per_page)
@@ -0,0 +1,127 @@
+# -*- coding: utf-8 -*-
+#!/usr/bin/env python
+"""Salted password hashes, computed off the request thread."""
+from concurrent.futures import ThreadPoolExecutor, TimeoutError
+from typing import Iterable, List
+from werkzeug.security import check_password_hash, generate_password_hash
+import hmac
+import threading
+
+
+class PasswordsBusy(Exception):
+    """Raised when the pool is too backed up to take another hash."""
+
+
+class PasswordHasher(object):
+    """PBKDF2 password hashes with a tunable work factor.
+
+    Hashes are ``pbkdf2:<digest>:<iterations>$<salt>$<hash>`` strings, so
+    the parameters a password was stored with travel with it and
+    ``needs_rehash`` can tell when ``PASSWORD_ITERATIONS`` has moved on.
+    Rows stored before hashing was introduced hold the plain password;
+    they still verify, and are rehashed on the next successful login.
+
+    Hashing runs in a pool of ``PASSWORD_WORKERS`` threads (the KDF
+    releases the GIL), so at most that many cores are spent on it however
+    many logins arrive at once. At most ``PASSWORD_MAX_PENDING`` calls may
+    be queued or running; beyond that, or when a call waits longer than
+    ``PASSWORD_TIMEOUT`` seconds, ``PasswordsBusy`` is raised rather than
+    letting logins pile up behind each other.
+    """
+
+    def __init__(self, app=None) -> None:
+        """Create a hasher with default parameters, optionally bound."""
+        self.digest = 'sha256'
+        self.iterations = 150000
+        self.salt_length = 16
+        self.workers = 2
+        self.max_pending = 64
+        self.timeout = 10
+        self._pool = None
+        self._slots = threading.BoundedSemaphore(self.max_pending)
+        self._lock = threading.Lock()
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app) -> None:
+        """Read the work factor and pool size from the app config."""
+        self.digest = app.config.get('PASSWORD_DIGEST', 'sha256')
+        self.iterations = app.config.get('PASSWORD_ITERATIONS', 150000)
+        self.salt_length = app.config.get('PASSWORD_SALT_LENGTH', 16)
+        self.workers = app.config.get('PASSWORD_WORKERS', 2)
+        self.max_pending = app.config.get('PASSWORD_MAX_PENDING', 64)
+        self.timeout = app.config.get('PASSWORD_TIMEOUT', 10)
+        self._slots = threading.BoundedSemaphore(self.max_pending)
+
+    @property
+    def method(self) -> str:
+        """The werkzeug method string for the current parameters."""
+        return f'pbkdf2:{self.digest}:{self.iterations}'
+
+    def hash(self, password: str) -> str:
+        """A new salted hash of password, computed in the pool."""
+        return self._call(self._hash, password)
+
+    def hash_many(self, passwords: Iterable[str]) -> List[str]:
+        """Hashes of several passwords, spread across the pool."""
+        return list(self._executor().map(self._hash, passwords))
+
+    def verify(self, stored: str, password: str) -> bool:
+        """Whether password matches a stored hash (or legacy plain text)."""
+        if not stored or not password:
+            return False
+        if not self.is_hashed(stored):
+            return hmac.compare_digest(
+                stored.encode('utf-8'), password.encode('utf-8')
+            )
+        return self._call(check_password_hash, stored, password)
+
+    def needs_rehash(self, stored: str) -> bool:
+        """Whether a stored password predates the current parameters."""
+        return not (stored or '').startswith(self.method + '$')
+
+    @staticmethod
+    def is_hashed(stored: str) -> bool:
+        """Whether a stored password is a hash rather than plain text."""
+        return stored.startswith('pbkdf2:') and stored.count('$') == 2
+
+    def shutdown(self) -> None:
+        """Stop the pool; it is recreated on the next call."""
+        with self._lock:
+            pool, self._pool = self._pool, None
+        if pool is not None:
+            pool.shutdown(wait=True)
+
+    def _hash(self, password: str) -> str:
+        """Hash with the current parameters, on the calling thread."""
+        return generate_password_hash(
+            password, method=self.method, salt_length=self.salt_length
+        )
+
+    def _call(self, func, *args):
+        """Run func in the pool and wait for it, if there is room.
+
+        The slot is given back when the job finishes, not when the caller
+        stops waiting, so jobs left running after a timeout still count.
+        """
+        if not self._slots.acquire(blocking=False):
+            raise PasswordsBusy()
+        try:
+            future = self._executor().submit(func, *args)
+        except BaseException:
+            self._slots.release()
+            raise
+        future.add_done_callback(lambda done: self._slots.release())
+        try:
+            return future.result(self.timeout)
+        except TimeoutError:
+            raise PasswordsBusy()
+
+    def _executor(self) -> ThreadPoolExecutor:
+        """The worker pool, started on first use."""
+        with self._lock:
+            if self._pool is None:
+                self._pool = ThreadPoolExecutor(
+                    max_workers=self.workers, thread_name_prefix='password'
+                )
+            return self._pool
@@ -0,0 +1,157 @@
+# -*- coding: utf-8 -*-
+#!/usr/bin/env python
+"""Opt-in per-request profiling of SQL and template rendering."""
+from flask import before_render_template, g, has_request_context, request
+from flask import template_rendered
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+import heapq
+import time
+
+
+class RequestProfile(object):
+    """Timings gathered while serving one request."""
+
+    def __init__(self, slowest: int) -> None:
+        """Start the request clock."""
+        self.started = time.perf_counter()
+        self.slowest = slowest
+        self.sql_count = 0
+        self.sql_time = 0.0
+        self.statements = []
+        self.template_time = 0.0
+        self.template_started = []
+
+    def add_statement(self, statement: str, seconds: float) -> None:
+        """Count a statement, keeping only the slowest few."""
+        self.sql_count += 1
+        self.sql_time += seconds
+        entry = (seconds, self.sql_count, statement)
+        if len(self.statements) < self.slowest:
+            heapq.heappush(self.statements, entry)
+        else:
+            heapq.heappushpop(self.statements, entry)
+
+    def slowest_statements(self) -> list:
+        """(milliseconds, statement) pairs, slowest first."""
+        return [
+            (round(seconds * 1000, 3), statement)
+            for seconds, _, statement in sorted(self.statements, reverse=True)
+        ]
+
+    def server_timing(self, total: float) -> str:
+        """The Server-Timing header value for this request."""
+        sql = f'sql;dur={self.sql_time * 1000:.3f}'
+        return ', '.join([
+            f'total;dur={total * 1000:.3f}',
+            f'{sql};desc="{self.sql_count} queries"',
+            f'tpl;dur={self.template_time * 1000:.3f}',
+        ])
+
+
+class RequestProfiler(object):
+    """Record endpoint, total, SQL and template time for each request.
+
+    Off unless ``PROFILER_ENABLED`` is set. While disabled no engine or
+    template listeners are attached and the request hooks return at once.
+    When enabled every response carries a ``Server-Timing`` header and
+    requests slower than ``PROFILER_SLOW_REQUEST_MS`` are logged with their
+    slowest statements.
+    """
+
+    def __init__(self, app=None) -> None:
+        """Create a disabled profiler, optionally bound to an app."""
+        self.app = None
+        self.enabled = False
+        self.slow_ms = 500
+        self.slowest = 5
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app) -> None:
+        """Install the request hooks and enable if the config says so."""
+        self.app = app
+        self.slow_ms = app.config.get('PROFILER_SLOW_REQUEST_MS', 500)
+        self.slowest = app.config.get('PROFILER_SLOWEST_STATEMENTS', 5)
+        app.before_request(self._start)
+        app.after_request(self._finish)
+        if app.config.get('PROFILER_ENABLED', False):
+            self.enable()
+
+    def enable(self) -> None:
+        """Start timing statements and template renders."""
+        if self.enabled:
+            return
+        event.listen(Engine, 'before_cursor_execute', self._before_cursor)
+        event.listen(Engine, 'after_cursor_execute', self._after_cursor)
+        before_render_template.connect(self._before_render, self.app)
+        template_rendered.connect(self._after_render, self.app)
+        self.enabled = True
+
+    def disable(self) -> None:
+        """Stop timing and detach every listener."""
+        if not self.enabled:
+            return
+        event.remove(Engine, 'before_cursor_execute', self._before_cursor)
+        event.remove(Engine, 'after_cursor_execute', self._after_cursor)
+        before_render_template.disconnect(self._before_render, self.app)
+        template_rendered.disconnect(self._after_render, self.app)
+        self.enabled = False
+
+    def _start(self) -> None:
+        """Open a profile for the incoming request."""
+        if self.enabled:
+            g.profile = RequestProfile(self.slowest)
+
+    def _finish(self, response):
+        """Attach Server-Timing and log the request if it was slow."""
+        profile = g.get('profile')
+        if profile is None:
+            return response
+        total = time.perf_counter() - profile.started
+        response.headers['Server-Timing'] = profile.server_timing(total)
+        if total * 1000 >= self.slow_ms:
+            self.app.logger.warning(
+                'slow request %s %s (%s): %.1f ms total, %d queries in '
+                '%.1f ms, templates %.1f ms, slowest: %s',
+                request.method, request.path, request.endpoint,
+                total * 1000, profile.sql_count, profile.sql_time * 1000,
+                profile.template_time * 1000,
+                [(ms, sql[:200]) for ms, sql in profile.slowest_statements()]
+            )
+        return response
+
+    def _before_cursor(self, conn, cursor, statement, parameters, context,
+                       executemany) -> None:
+        """Note when a statement was sent."""
+        conn.info.setdefault('profiler_started', []).append(
+            time.perf_counter()
+        )
+
+    def _after_cursor(self, conn, cursor, statement, parameters, context,
+                      executemany) -> None:
+        """Charge a finished statement to the current request."""
+        pending = conn.info.get('profiler_started')
+        if not pending:
+            return
+        started = pending.pop()
+        if has_request_context():
+            profile = g.get('profile')
+            if profile is not None:
+                profile.add_statement(
+                    statement, time.perf_counter() - started
+                )
+
+    def _before_render(self, sender, template, context, **extra) -> None:
+        """Start the clock on a template render."""
+        profile = g.get('profile')
+        if profile is not None:
+            profile.template_started.append(time.perf_counter())
+
+    def _after_render(self, sender, template, context, **extra) -> None:
+        """Stop the clock on a template render."""
+        profile = g.get('profile')
+        if profile is not None and profile.template_started:
+            started = profile.template_started.pop()
+            if not profile.template_started:
+                profile.template_time += time.perf_counter() - started
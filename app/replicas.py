@@ -0,0 +1,257 @@
+# -*- coding: utf-8 -*-
+#!/usr/bin/env python
+"""Read replicas: routing read-only queries away from the primary."""
+from flask import has_request_context, request, session as cookie
+from flask_sqlalchemy import SignallingSession
+from sqlalchemy import event, orm, text
+from sqlalchemy.engine.url import make_url
+from sqlalchemy.sql.selectable import GenerativeSelect
+from typing import List, Set
+import threading
+import time
+
+
+# the session cookie key holding the time until which a user reads the primary
+STICKY_KEY = '_primary_until'
+
+# the session.info key holding the replica engine a transaction reads from
+PINNED_KEY = 'replica'
+
+# replay lag in seconds; 0 when the replica has replayed everything received
+LAG_QUERY = text(
+    'SELECT CASE WHEN NOT pg_is_in_recovery() '
+    'OR pg_last_wal_receive_lsn() = pg_last_wal_replay_lsn() THEN 0 '
+    'ELSE EXTRACT(EPOCH FROM now() - pg_last_xact_replay_timestamp()) END'
+)
+
+
+def replica_uris(app) -> Set[str]:
+    """The URIs of the replica binds, spelled the way engine URLs are."""
+    return {
+        str(make_url(uri))
+        for name, uri in (app.config.get('SQLALCHEMY_BINDS') or {}).items()
+        if name.startswith('replica')
+    }
+
+
+class Replica(object):
+    """The last known health of one replica bind."""
+
+    def __init__(self, name: str) -> None:
+        """A replica not checked yet, presumed healthy."""
+        self.name = name
+        self.healthy = True
+        self.lag = 0.0
+        self.error = None
+        self.checked = None
+        self.lock = threading.Lock()
+
+
+class ReplicaRouter(object):
+    """Round-robin choice among the healthy replicas.
+
+    Replicas are the ``SQLALCHEMY_BINDS`` entries named ``replica*``, so
+    they get the same pool settings as the primary. Each is checked at
+    most every ``REPLICA_CHECK_INTERVAL`` seconds, by whichever request
+    needs it next; one that can't be reached, or whose replay lag exceeds
+    ``REPLICA_MAX_LAG`` seconds, is left out until a later check passes.
+    A replica connection that fails mid-request takes it out at once.
+
+    A request that commits a write makes its user read from the primary
+    for ``REPLICA_STICKY_SECONDS``, recorded in their session cookie, so
+    they see their own post or follow even on a lagging replica.
+    """
+
+    def __init__(self) -> None:
+        """Create a router with no replicas."""
+        self.app = None
+        self.db = None
+        self.replicas = []
+        self.max_lag = 5.0
+        self.check_interval = 5.0
+        self.sticky_seconds = 10
+        self._turn = 0
+        self._lock = threading.Lock()
+        self._watched = set()
+
+    def init_app(self, app, db) -> None:
+        """Find the replica binds and read the routing settings."""
+        self.app = app
+        self.db = db
+        self.max_lag = app.config.get('REPLICA_MAX_LAG', 5.0)
+        self.check_interval = app.config.get('REPLICA_CHECK_INTERVAL', 5.0)
+        self.sticky_seconds = app.config.get('REPLICA_STICKY_SECONDS', 10)
+        self.replicas = [
+            Replica(name)
+            for name in sorted(app.config.get('SQLALCHEMY_BINDS') or {})
+            if name.startswith('replica')
+        ]
+
+    @property
+    def enabled(self) -> bool:
+        """Whether any replicas are configured."""
+        return bool(self.replicas)
+
+    def engine(self, replica: Replica):
+        """The engine for a replica, watched for connection failures."""
+        engine = self.db.get_engine(self.app, bind=replica.name)
+        if engine not in self._watched:
+            self._watched.add(engine)
+
+            @event.listens_for(engine, 'handle_error')
+            def replica_failed(context) -> None:
+                if context.is_disconnect:
+                    self.mark_down(replica, context.original_exception)
+        return engine
+
+    def pick(self):
+        """The engine of the next healthy replica, or None if there is none."""
+        healthy = [r for r in self.replicas if self._healthy(r)]
+        if not healthy:
+            return None
+        with self._lock:
+            self._turn = (self._turn + 1) % len(healthy)
+            return self.engine(healthy[self._turn])
+
+    def check(self, replica: Replica) -> bool:
+        """Connect to a replica, measure its lag and record its health."""
+        try:
+            with self.engine(replica).connect() as connection:
+                if connection.dialect.name == 'postgresql':
+                    lag = float(connection.execute(LAG_QUERY).scalar() or 0)
+                else:
+                    connection.execute(text('SELECT 1'))
+                    lag = 0.0
+        except Exception as error:
+            self.mark_down(replica, error)
+        else:
+            was_healthy = replica.healthy
+            replica.lag = lag
+            replica.healthy = lag <= self.max_lag
+            replica.error = None if replica.healthy else f'lag {lag:.1f}s'
+            if replica.healthy != was_healthy:
+                self.app.logger.warning(
+                    'replica %s %s', replica.name,
+                    'back in rotation' if replica.healthy else replica.error
+                )
+        replica.checked = time.monotonic()
+        return replica.healthy
+
+    def mark_down(self, replica: Replica, error: Exception) -> None:
+        """Take a replica out of rotation until its next check passes."""
+        if replica.healthy:
+            self.app.logger.warning(
+                'replica %s out of rotation: %r', replica.name, error
+            )
+        replica.healthy = False
+        replica.error = repr(error)
+        replica.checked = time.monotonic()
+
+    def stick(self) -> None:
+        """Make the current user read from the primary for a while."""
+        if has_request_context():
+            cookie[STICKY_KEY] = time.time() + self.sticky_seconds
+
+    def sticky(self) -> bool:
+        """Whether the current user wrote too recently to use a replica."""
+        return cookie.get(STICKY_KEY, 0) > time.time()
+
+    def reads_from_replica(self) -> bool:
+        """Whether the current request may read from a replica at all.
+
+        Only GET and HEAD requests do; form posts, background jobs and
+        scripts always see the primary.
+        """
+        return (self.enabled and has_request_context() and
+                request.method in ('GET', 'HEAD') and not self.sticky())
+
+    def status(self) -> List[dict]:
+        """Health of every replica, JSON-ready."""
+        now = time.monotonic()
+        return [{
+            'name': replica.name,
+            'healthy': replica.healthy,
+            'lag': round(replica.lag, 3),
+            'error': replica.error,
+            'checked_seconds_ago': round(now - replica.checked, 3)
+            if replica.checked is not None else None,
+        } for replica in self.replicas]
+
+    def _healthy(self, replica: Replica) -> bool:
+        """A replica's health, rechecked when the last check is too old.
+
+        Only one thread checks a replica at a time; the others go on with
+        its last known health.
+        """
+        due = replica.checked is None or \
+            time.monotonic() - replica.checked >= self.check_interval
+        if due and replica.lock.acquire(blocking=False):
+            try:
+                return self.check(replica)
+            finally:
+                replica.lock.release()
+        return replica.healthy
+
+
+replicas = ReplicaRouter()
+
+
+class RoutingSession(SignallingSession):
+    """A session that sends plain SELECTs to a replica when it can.
+
+    Flushes, INSERT/UPDATE/DELETE, ``FOR UPDATE`` and raw SQL statements
+    go to the primary, and once a transaction has written anything the
+    rest of it stays on the primary too. The replica picked for a
+    transaction's first read serves all of its reads, so they never mix
+    replicas that have replayed different amounts.
+    """
+
+    def get_bind(self, mapper=None, clause=None):
+        """A replica engine for safe reads, else the usual bind."""
+        if self._replica_safe(clause) and replicas.reads_from_replica():
+            engine = self.info.get(PINNED_KEY)
+            if engine is None:
+                engine = replicas.pick()
+            if engine is not None:
+                self.info[PINNED_KEY] = engine
+                return engine
+        return super(RoutingSession, self).get_bind(mapper, clause)
+
+    def _replica_safe(self, clause) -> bool:
+        """Whether clause is a read this transaction can take elsewhere."""
+        if self._flushing or self.info.get('wrote'):
+            return False
+        if not isinstance(clause, GenerativeSelect):
+            if clause is not None:
+                self.info['wrote'] = True
+            return False
+        return clause._for_update_arg is None
+
+
+def sessionmaker(db, **options) -> orm.sessionmaker:
+    """A RoutingSession factory that tracks which transactions wrote."""
+    factory = orm.sessionmaker(class_=RoutingSession, db=db, **options)
+
+    @event.listens_for(factory, 'after_flush')
+    def flushed(session, context) -> None:
+        """Keep the rest of the transaction on the primary."""
+        session.info['wrote'] = True
+
+    @event.listens_for(factory, 'after_commit')
+    def committed(session) -> None:
+        """After a committed write, keep the user on the primary a while."""
+        if session.info.pop('wrote', False) and replicas.enabled:
+            replicas.stick()
+
+    @event.listens_for(factory, 'after_rollback')
+    def rolled_back(session) -> None:
+        """A rolled back transaction wrote nothing."""
+        session.info.pop('wrote', None)
+
+    @event.listens_for(factory, 'after_transaction_end')
+    def ended(session, transaction) -> None:
+        """Let the next transaction pick its own replica."""
+        if transaction.parent is None:
+            session.info.pop(PINNED_KEY, None)
+
+    return factory
@@ -0,0 +1,248 @@
+# -*- coding: utf-8 -*-
+#!/usr/bin/env python
+"""Full-text search over posts, backed by an on-disk Whoosh index."""
+from app import db
+from sqlalchemy import event
+from typing import Iterable, List, Tuple
+import atexit
+import os
+import threading
+import time
+
+
+_schema = None
+
+
+def schema():
+    """The index schema; Whoosh is imported on first use, not with the app."""
+    global _schema
+    if _schema is None:
+        from whoosh.fields import ID, TEXT, Schema
+        _schema = Schema(
+            id=ID(stored=True, unique=True),
+            title=TEXT,
+            body=TEXT,
+        )
+    return _schema
+
+
+def document(post) -> dict:
+    """The fields indexed for a post (or an (id, title, body) row)."""
+    return {
+        'id': str(post.id),
+        'title': post.title or '',
+        'body': post.body or '',
+    }
+
+
+class SearchIndex(object):
+    """Incrementally maintained inverted index of Post.title and Post.body.
+
+    Posts written in a committed session are queued in memory and applied
+    to the index in one writer commit once ``SEARCH_COMMIT_LIMIT`` changes
+    are waiting or the oldest is ``SEARCH_COMMIT_PERIOD`` seconds old, so a
+    single post never pays for an index flush. A timer started with the
+    first queued change flushes it on time even when nothing else is
+    written. The writer lock is only held while a batch is written, so
+    several processes can share one index.
+
+    A flush that fails, say because another process held the writer lock
+    too long, is logged and its changes stay queued for the next write or
+    search to try again: the posts are already committed, so the request
+    that wrote them must not fail.
+    """
+
+    def __init__(self, app=None) -> None:
+        """Create an index handle, optionally bound to an app."""
+        self.app = None
+        self.commit_limit = 100
+        self.commit_period = 5
+        self._index = None
+        self._pending = {}
+        self._oldest = None
+        self._timer = None
+        self._lock = threading.Lock()
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app) -> None:
+        """Read batching settings and start watching session commits."""
+        self.app = app
+        self.commit_limit = app.config.get('SEARCH_COMMIT_LIMIT', 100)
+        self.commit_period = app.config.get('SEARCH_COMMIT_PERIOD', 5)
+        event.listen(db.session, 'after_flush', self._collect)
+        event.listen(db.session, 'after_commit', self._queue)
+        event.listen(db.session, 'after_rollback', self._discard)
+        atexit.register(self.close)
+
+    @property
+    def index(self):
+        """The Whoosh index at WHOOSH_BASE, created on first use."""
+        if self._index is None:
+            from whoosh import index as whoosh_index
+            path = self.app.config['WHOOSH_BASE']
+            if whoosh_index.exists_in(path):
+                self._index = whoosh_index.open_dir(path)
+            else:
+                os.makedirs(path, exist_ok=True)
+                self._index = whoosh_index.create_in(path, schema())
+        return self._index
+
+    def warm(self) -> None:
+        """Import Whoosh's query parser now rather than on the first search."""
+        self.parse('warm')
+
+    def add(self, posts: Iterable) -> None:
+        """Queue posts to be (re)indexed."""
+        self._enqueue({post.id: document(post) for post in posts})
+
+    def remove(self, post_ids: Iterable[int]) -> None:
+        """Queue posts to be dropped from the index."""
+        self._enqueue({post_id: None for post_id in post_ids})
+
+    def flush(self) -> int:
+        """Write every queued change in one commit; return how many."""
+        with self._lock:
+            batch, self._pending = self._pending, {}
+            self._oldest = None
+            if self._timer is not None:
+                self._timer.cancel()
+                self._timer = None
+        if not batch:
+            return 0
+        try:
+            writer = self.index.writer(timeout=10.0)
+            try:
+                for post_id, fields in batch.items():
+                    if fields is None:
+                        writer.delete_by_term('id', str(post_id))
+                    else:
+                        writer.update_document(**fields)
+            except Exception:
+                writer.cancel()
+                raise
+            writer.commit()
+        except Exception:
+            with self._lock:
+                batch.update(self._pending)
+                self._pending = batch
+                self._oldest = self._oldest or time.monotonic()
+                self._schedule()
+            raise
+        return len(batch)
+
+    def search(self, text: str, page: int=1,
+               per_page: int=20) -> Tuple[List[int], int]:
+        """Ids of the posts matching text on one page, and the hit count."""
+        if self._pending:
+            self._try_flush()
+        query = self.parse(text)
+        with self.index.searcher() as searcher:
+            results = searcher.search_page(query, page, pagelen=per_page)
+            return [int(hit['id']) for hit in results], results.total
+
+    def parse(self, text: str):
+        """A Whoosh query for text, matched against titles and bodies."""
+        from whoosh.qparser import MultifieldParser
+        return MultifieldParser(['title', 'body'], schema()).parse(text)
+
+    def reindex(self, chunks: Iterable[Iterable]) -> int:
+        """Rebuild the index from scratch out of chunks of posts."""
+        from whoosh import index as whoosh_index
+        self.close()
+        os.makedirs(self.app.config['WHOOSH_BASE'], exist_ok=True)
+        self._index = whoosh_index.create_in(
+            self.app.config['WHOOSH_BASE'], schema()
+        )
+        count = 0
+        writer = self._index.writer(limitmb=256)
+        for chunk in chunks:
+            for post in chunk:
+                writer.add_document(**document(post))
+                count += 1
+        writer.commit()
+        return count
+
+    def close(self) -> None:
+        """Write anything still queued and let go of the index."""
+        if self._pending and self.app is not None:
+            self._try_flush()
+        if self._index is not None:
+            self._index.close()
+            self._index = None
+
+    def clear(self) -> None:
+        """Drop every queued change without writing it."""
+        with self._lock:
+            self._pending = {}
+            self._oldest = None
+            if self._timer is not None:
+                self._timer.cancel()
+                self._timer = None
+
+    def _enqueue(self, changes: dict) -> None:
+        """Merge changes into the queue, flushing if a threshold is hit."""
+        if not changes:
+            return
+        now = time.monotonic()
+        with self._lock:
+            self._pending.update(changes)
+            if self._oldest is None:
+                self._oldest = now
+                self._schedule()
+            due = (
+                len(self._pending) >= self.commit_limit or
+                now - self._oldest >= self.commit_period
+            )
+        if due:
+            self._try_flush()
+
+    def _schedule(self) -> None:
+        """Start the commit period timer unless one is running; needs the lock.
+
+        Like the last_seen timer it is started lazily, so a forked server
+        worker gets a timer of its own.
+        """
+        if self._timer is None and self.app is not None:
+            self._timer = threading.Timer(
+                self.commit_period, self._flush_when_due
+            )
+            self._timer.daemon = True
+            self._timer.start()
+
+    def _flush_when_due(self) -> None:
+        """Flush from the timer thread."""
+        with self._lock:
+            self._timer = None
+        self._try_flush()
+
+    def _try_flush(self) -> None:
+        """Flush, logging a failure instead of raising it."""
+        try:
+            self.flush()
+        except Exception:
+            self.app.logger.exception(
+                'Could not flush search index; %d changes kept queued',
+                len(self._pending)
+            )
+
+    def _collect(self, session, flush_context) -> None:
+        """Remember posts touched by a flush until the commit succeeds."""
+        from app.models import Post
+        changes = session.info.setdefault('search_changes', {})
+        for instance in list(session.new) + list(session.dirty):
+            if isinstance(instance, Post):
+                changes[instance.id] = document(instance)
+        for instance in session.deleted:
+            if isinstance(instance, Post):
+                changes[instance.id] = None
+
+    def _queue(self, session) -> None:
+        """Hand the posts of a committed transaction to the index."""
+        changes = session.info.pop('search_changes', None)
+        if changes:
+            self._enqueue(changes)
+
+    def _discard(self, session) -> None:
+        """Forget posts from a transaction that was rolled back."""
+        session.info.pop('search_changes', None)
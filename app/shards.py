@@ -0,0 +1,518 @@
+# -*- coding: utf-8 -*-
+#!/usr/bin/env python
+"""Posts spread across several databases by author id."""
+from app.pagination import (
+    NEWER, OLDER, cursor_page, decode_cursor, newer_key
+)
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+from heapq import merge
+from itertools import islice
+from sqlalchemy import (
+    Column, DateTime, Index, Integer, MetaData, Table, Unicode, func, select,
+    text, tuple_
+)
+from typing import Callable, Dict, Iterable, Iterator, List, Tuple
+import threading
+import time
+
+
+# the post table as each shard holds it: no foreign key, users stay primary
+metadata = MetaData()
+posts = Table(
+    'post', metadata,
+    Column('id', Integer, primary_key=True, autoincrement=False),
+    Column('title', Unicode, unique=True),
+    Column('body', Unicode),
+    Column('timestamp', DateTime),
+    Column('user_id', Integer, nullable=False),
+)
+Index(
+    'ix_post_user_id_timestamp',
+    posts.c.user_id, posts.c.timestamp.desc(), posts.c.id.desc()
+)
+
+# what the API serializes a sharded post from, like api.POST_COLUMNS rows
+PostRow = namedtuple('PostRow', 'id title body timestamp author')
+
+
+class ShardPost(object):
+    """A post read from a shard, with its author loaded from the primary.
+
+    Quacks like ``Post`` as far as the templates, fragment cache, search
+    index and cursor pages are concerned.
+    """
+
+    __slots__ = ('id', 'title', 'body', 'timestamp', 'user_id', 'author')
+
+    def __init__(self, row, author) -> None:
+        """Wrap a shard row and the User who wrote it."""
+        self.id = row.id
+        self.title = row.title
+        self.body = row.body
+        self.timestamp = row.timestamp
+        self.user_id = row.user_id
+        self.author = author
+
+    def __repr__(self) -> str:
+        """String representation of the sharded post."""
+        return f'<ShardPost {self.title}>'
+
+    def as_row(self) -> PostRow:
+        """The post as the API serializes it."""
+        return PostRow(
+            self.id, self.title, self.body, self.timestamp,
+            self.author.username if self.author is not None else None
+        )
+
+
+class PostShards(object):
+    """Routes post reads and writes to the shard that owns the author.
+
+    Shards are the ``SQLALCHEMY_BINDS`` entries named ``shard*``; with none
+    configured every post stays in the primary's ``post`` table as before.
+    An author belongs to bucket ``user_id % POST_SHARD_BUCKETS`` and each
+    bucket to one shard, per ``POST_SHARD_MAP`` (shard name -> list of
+    ``[first, last]`` bucket ranges), or to equal contiguous ranges over
+    the shards in name order when no map is given. Moving buckets between
+    shards is a config change plus ``db_rebalance.py``; the author id never
+    changes.
+
+    A profile reads one shard. A home timeline asks every shard holding a
+    followed author for one page at once, on ``POST_SHARD_WORKERS``
+    threads, and merges the sorted answers lazily so no more than a page
+    plus one row is ever taken from them.
+    """
+
+    def __init__(self, app=None, db=None) -> None:
+        """Create a router with no shards, optionally bound."""
+        self.app = None
+        self.db = None
+        self.names = []
+        self.buckets = 1024
+        self.workers = 4
+        self.owners = []
+        self._last_id = 0
+        self._pool = None
+        self._lock = threading.Lock()
+        if app is not None:
+            self.init_app(app, db)
+
+    def init_app(self, app, db) -> None:
+        """Find the shard binds and build the bucket -> shard table."""
+        self.app = app
+        self.db = db
+        self.buckets = app.config.get('POST_SHARD_BUCKETS', 1024)
+        self.workers = app.config.get('POST_SHARD_WORKERS', 4)
+        self.names = sorted(
+            name for name in app.config.get('SQLALCHEMY_BINDS') or {}
+            if name.startswith('shard')
+        )
+        self.owners = self._owners(app.config.get('POST_SHARD_MAP'))
+
+    @property
+    def enabled(self) -> bool:
+        """Whether posts live on shards rather than the primary."""
+        return bool(self.names)
+
+    def engine(self, name: str):
+        """The engine of a shard bind."""
+        return self.db.get_engine(self.app, bind=name)
+
+    def bucket(self, user_id: int) -> int:
+        """The bucket an author's posts are kept in."""
+        return user_id % self.buckets
+
+    def shard_for(self, user_id: int) -> str:
+        """The name of the shard holding an author's posts."""
+        return self.owners[self.bucket(user_id)]
+
+    def group(self, user_ids: Iterable[int]) -> Dict[str, List[int]]:
+        """Author ids grouped by the shard holding their posts."""
+        grouped = {}
+        for user_id in user_ids:
+            grouped.setdefault(self.shard_for(user_id), []).append(user_id)
+        return grouped
+
+    def create_all(self) -> None:
+        """Create the post table on every shard that lacks it."""
+        for name in self.names:
+            metadata.create_all(self.engine(name), checkfirst=True)
+
+    def next_id(self) -> int:
+        """A post id no shard has used."""
+        return self.next_ids(1)[0]
+
+    def next_ids(self, count: int) -> List[int]:
+        """count post ids no shard has used.
+
+        Postgres hands them out from the primary's ``post_id_seq``; other
+        databases take the highest id on any shard, under a process lock,
+        which is only good enough for a single development process.
+        """
+        primary = self.db.engine
+        if primary.dialect.name == 'postgresql':
+            return [row[0] for row in primary.execute(text(
+                "SELECT nextval('post_id_seq') FROM generate_series(1, :n)"
+            ), n=count)]
+        with self._lock:
+            newest = max(
+                self._scalar(name, select([func.max(posts.c.id)])) or 0
+                for name in self.names
+            )
+            first = max(newest, self._last_id) + 1
+            self._last_id = first + count - 1
+            return list(range(first, first + count))
+
+    def title_taken(self, title: str) -> bool:
+        """Whether any shard already has a post with this title."""
+        statement = select([posts.c.id]).where(posts.c.title == title) \
+            .limit(1)
+        return any(self._scatter(
+            {name: statement for name in self.names},
+            lambda connection, query: connection.execute(query).first()
+        ).values())
+
+    def add_post(self, title: str, body: str, user_id: int) -> int:
+        """Write a post to its author's shard and queue it for search."""
+        from app import search_index
+        row = {
+            'id': self.next_id(), 'title': title, 'body': body,
+            'timestamp': datetime.utcnow(), 'user_id': user_id,
+        }
+        with self.engine(self.shard_for(user_id)).begin() as connection:
+            connection.execute(posts.insert(), row)
+        search_index.add([PostRow(row['id'], title, body, None, None)])
+        return row['id']
+
+    def user_page(self, user, cursor: str=None, per_page: int=20):
+        """One page of an author's posts, from their shard alone."""
+        return self._page([user.id], cursor, per_page)
+
+    def timeline_page(self, user, cursor: str=None, per_page: int=20):
+        """One page of a home timeline, gathered from every shard needed.
+
+        Raises ValueError for a malformed cursor, like paginate_posts.
+        """
+        from app import follow_graph
+        return self._page(follow_graph.following(user.id), cursor, per_page)
+
+    def newest_followed(self, user) -> Tuple[int, datetime]:
+        """(id, timestamp) of the newest post a user follows, or None."""
+        from app import follow_graph
+        statements = {
+            name: select([posts.c.id, posts.c.timestamp]).where(
+                posts.c.user_id.in_(user_ids)
+            ).order_by(posts.c.timestamp.desc(), posts.c.id.desc()).limit(1)
+            for name, user_ids in self.group(
+                follow_graph.following(user.id)
+            ).items()
+        }
+        rows = [row for row in self._scatter(
+            statements,
+            lambda connection, query: connection.execute(query).first()
+        ).values() if row is not None]
+        if not rows:
+            return None
+        newest = max(rows, key=lambda row: (row.timestamp, row.id))
+        return newest.id, newest.timestamp
+
+    def new_posts_count(self, user, since: str=None, cap: int=100) -> int:
+        """Followed posts newer than a NEWER cursor, summed up to cap."""
+        from app import follow_graph
+        key = newer_key(since) if since is not None else None
+        statements = {}
+        for name, user_ids in self.group(
+            follow_graph.following(user.id)
+        ).items():
+            query = select([posts.c.id]).where(posts.c.user_id.in_(user_ids))
+            if key is not None:
+                query = query.where(
+                    tuple_(posts.c.timestamp, posts.c.id) > tuple_(*key)
+                )
+            statements[name] = select([func.count()]).select_from(
+                query.limit(cap).alias()
+            )
+        counts = self._scatter(
+            statements,
+            lambda connection, query: connection.execute(query).scalar()
+        )
+        return min(sum(counts.values()), cap)
+
+    def load(self, post_ids: List[int]) -> List[ShardPost]:
+        """Posts by id from whichever shards have them, in the given order."""
+        if not post_ids:
+            return []
+        statement = select([posts]).where(posts.c.id.in_(post_ids))
+        found = {}
+        for rows in self._scatter(
+            {name: statement for name in self.names},
+            lambda connection, query: connection.execute(query).fetchall()
+        ).values():
+            found.update((row.id, row) for row in rows)
+        rows = [found[i] for i in post_ids if i in found]
+        return self._attach_authors(rows)
+
+    def add_posts(self, rows: List[dict]) -> List[PostRow]:
+        """Write posts to their authors' shards in one insert per shard.
+
+        Rows whose title the shard already has are skipped. Returns the
+        rows that are stored under those titles, to be indexed.
+        """
+        from app.bulk import insert_ignore
+        grouped = {}
+        for row, post_id in zip(rows, self.next_ids(len(rows))):
+            row = dict(row, id=post_id)
+            grouped.setdefault(self.shard_for(row['user_id']), []).append(row)
+        stored = []
+        for name, chunk in grouped.items():
+            with self.engine(name).begin() as connection:
+                insert_ignore(posts, chunk, connection=connection)
+            stored += [
+                PostRow(row.id, row.title, row.body, row.timestamp, None)
+                for row in self._fetch(name, select([posts]).where(
+                    posts.c.title.in_([row['title'] for row in chunk])
+                ))
+            ]
+        return stored
+
+    def scan(self, size: int=5000) -> Iterator[list]:
+        """Every post, shard by shard in id order, size rows at a time.
+
+        Rows left on a shard that no longer owns their bucket are skipped,
+        so a post caught half way through a rebalance is seen once.
+        """
+        for name in self.names:
+            after = 0
+            while True:
+                rows = self._fetch(name, select([posts]).where(
+                    posts.c.id > after
+                ).order_by(posts.c.id).limit(size))
+                if not rows:
+                    break
+                after = rows[-1].id
+                owned = [
+                    row for row in rows if self.shard_for(row.user_id) == name
+                ]
+                if owned:
+                    yield owned
+
+    def post_counts(self) -> Dict[int, int]:
+        """How many posts each author has, counted on their own shard."""
+        statement = select([posts.c.user_id, func.count()]).group_by(
+            posts.c.user_id
+        )
+        counts = {}
+        for name, rows in self._scatter(
+            {name: statement for name in self.names},
+            lambda connection, query: connection.execute(query).fetchall()
+        ).items():
+            counts.update(
+                (user_id, count) for user_id, count in rows
+                if self.shard_for(user_id) == name
+            )
+        return counts
+
+    def counts(self) -> Dict[str, int]:
+        """How many posts each shard holds."""
+        return {
+            name: self._scalar(name, select([func.count()]).select_from(posts))
+            for name in self.names
+        }
+
+    def count_buckets(self, first: int, last: int, name: str) -> int:
+        """How many posts in buckets first..last a shard holds."""
+        return self._scalar(name, select([func.count()]).where(
+            self._in_buckets(first, last)
+        ))
+
+    def copy_buckets(self, first: int, last: int, source: str, target: str,
+                     batch: int=1000, throttle: float=0.0,
+                     out: Callable=print) -> int:
+        """Copy every post in buckets first..last from source to target.
+
+        Rows are streamed in id order, batch at a time, each batch written
+        in its own transaction and skipped where the target already has
+        it, so the copy can be interrupted and rerun, and run again after
+        the map is switched to catch up on posts written meanwhile.
+        Returns how many rows were read.
+        """
+        from app.bulk import insert_ignore
+        in_buckets = self._in_buckets(first, last)
+        copied, after = 0, 0
+        while True:
+            rows = self._fetch(source, select([posts]).where(
+                in_buckets & (posts.c.id > after)
+            ).order_by(posts.c.id).limit(batch))
+            if not rows:
+                break
+            with self.engine(target).begin() as connection:
+                insert_ignore(
+                    posts, [dict(row) for row in rows], connection=connection
+                )
+            copied += len(rows)
+            after = rows[-1].id
+            out(f'copied {copied} posts {source} -> {target} (id {after})')
+            time.sleep(throttle)
+        return copied
+
+    def purge_buckets(self, first: int, last: int, source: str,
+                      batch: int=1000, throttle: float=0.0,
+                      out: Callable=print) -> int:
+        """Delete posts in buckets first..last from a shard that gave them up.
+
+        Refuses while the map still sends any of those buckets to source.
+        Each batch is copied to the shards that now own it first, and only
+        the ids read back from them are deleted, so a post the last
+        ``copy_buckets`` missed is moved rather than lost. Returns how many
+        rows were deleted.
+        """
+        from app.bulk import insert_ignore
+        kept = [b for b in range(first, last + 1) if self.owners[b] == source]
+        if kept:
+            raise ValueError(
+                f'{source} still owns buckets {kept[0]}..{kept[-1]}; '
+                'update POST_SHARD_MAP first'
+            )
+        in_buckets = self._in_buckets(first, last)
+        purged, missing, after = 0, 0, 0
+        while True:
+            rows = self._fetch(source, select([posts]).where(
+                in_buckets & (posts.c.id > after)
+            ).order_by(posts.c.id).limit(batch))
+            if not rows:
+                break
+            after = rows[-1].id
+            owned = {}
+            for row in rows:
+                owned.setdefault(self.shard_for(row.user_id), []).append(row)
+            confirmed = []
+            for target, moved in owned.items():
+                with self.engine(target).begin() as connection:
+                    insert_ignore(
+                        posts, [dict(row) for row in moved],
+                        connection=connection
+                    )
+                confirmed += [row.id for row in self._fetch(
+                    target, select([posts.c.id]).where(
+                        posts.c.id.in_([row.id for row in moved])
+                    )
+                )]
+            if confirmed:
+                with self.engine(source).begin() as connection:
+                    connection.execute(
+                        posts.delete().where(posts.c.id.in_(confirmed))
+                    )
+            purged += len(confirmed)
+            missing += len(rows) - len(confirmed)
+            out(f'purged {purged} posts from {source} (id {after})')
+            time.sleep(throttle)
+        if missing:
+            out(f'kept {missing} posts on {source} that their new shard '
+                'did not have; rerun purge')
+        return purged
+
+    def _owners(self, shard_map: dict) -> List[str]:
+        """The shard of every bucket, checked to cover each exactly once."""
+        if not self.names:
+            return []
+        if not shard_map:
+            size = -(-self.buckets // len(self.names))
+            return [self.names[b // size] for b in range(self.buckets)]
+        owners = [None] * self.buckets
+        for name, ranges in shard_map.items():
+            if name not in self.names:
+                raise ValueError(f'POST_SHARD_MAP names unknown shard {name}')
+            for first, last in ranges:
+                for b in range(first, last + 1):
+                    if owners[b] is not None:
+                        raise ValueError(f'bucket {b} is mapped twice')
+                    owners[b] = name
+        if None in owners:
+            raise ValueError(
+                f'bucket {owners.index(None)} is not mapped to a shard'
+            )
+        return owners
+
+    def _page(self, user_ids: Iterable[int], cursor: str, per_page: int):
+        """Merge one keyset page from each shard holding these authors."""
+        direction = key = None
+        if cursor is not None:
+            direction, timestamp, post_id = decode_cursor(cursor)
+            key = tuple_(timestamp, post_id)
+        order = tuple_(posts.c.timestamp, posts.c.id)
+        statements = {}
+        for name, ids in self.group(user_ids).items():
+            query = select([posts]).where(posts.c.user_id.in_(ids))
+            if direction == NEWER:
+                query = query.where(order > key).order_by(
+                    posts.c.timestamp.asc(), posts.c.id.asc()
+                )
+            else:
+                if direction == OLDER:
+                    query = query.where(order < key)
+                query = query.order_by(
+                    posts.c.timestamp.desc(), posts.c.id.desc()
+                )
+            statements[name] = query.limit(per_page + 1)
+        answers = self._scatter(
+            statements,
+            lambda connection, query: connection.execute(query).fetchall()
+        )
+        rows = list(islice(merge(
+            *answers.values(), key=lambda row: (row.timestamp, row.id),
+            reverse=direction != NEWER
+        ), per_page + 1))
+        page = cursor_page(rows, direction, per_page)
+        page.items = self._attach_authors(page.items)
+        return page
+
+    def _attach_authors(self, rows: list) -> List[ShardPost]:
+        """Wrap shard rows, loading all their authors in one query."""
+        from app.models import User
+        user_ids = {row.user_id for row in rows}
+        authors = {
+            user.id: user
+            for user in User.query.filter(User.id.in_(user_ids))
+        } if user_ids else {}
+        return [ShardPost(row, authors.get(row.user_id)) for row in rows]
+
+    def _in_buckets(self, first: int, last: int):
+        """Where a post's author falls in buckets first..last."""
+        bucket = posts.c.user_id % self.buckets
+        return (bucket >= first) & (bucket <= last)
+
+    def _fetch(self, name: str, statement) -> list:
+        """All rows of a statement run on one shard."""
+        with self.engine(name).connect() as connection:
+            return connection.execute(statement).fetchall()
+
+    def _scalar(self, name: str, statement):
+        """The single value of a statement run on one shard."""
+        with self.engine(name).connect() as connection:
+            return connection.execute(statement).scalar()
+
+    def _scatter(self, statements: dict, run: Callable) -> dict:
+        """run(connection, statement) on each named shard, concurrently.
+
+        A single shard is queried on the calling thread.
+        """
+        def one(name: str):
+            with self.engine(name).connect() as connection:
+                return run(connection, statements[name])
+
+        if len(statements) <= 1:
+            return {name: one(name) for name in statements}
+        pool = self._executor()
+        futures = {name: pool.submit(one, name) for name in statements}
+        return {name: future.result() for name, future in futures.items()}
+
+    def _executor(self) -> ThreadPoolExecutor:
+        """The scatter pool, started on first use."""
+        with self._lock:
+            if self._pool is None:
+                self._pool = ThreadPoolExecutor(
+                    max_workers=self.workers, thread_name_prefix='shard'
+                )
+            return self._pool
@@ -0,0 +1,30 @@
+# -*- coding: utf-8 -*-
+#!/usr/bin/env python
+"""Handlers for the background jobs queued by the views.
+
+Only timeline fan-out runs as a job, and only with a timeline store every
+process shares. Search changes are already batched after the commit by
+``SearchIndex``, and fragment invalidation must reach the cache of the
+process that rendered the page, which a job worker's per-process cache
+is not.
+"""
+from app import app, db, jobs, timelines
+from app.models import Post
+from typing import List
+
+
+@jobs.handler('timeline.fan_out', batch=True)
+def fan_out_posts(payloads: List[dict]) -> None:
+    """Push a batch of new posts into their authors' followers' timelines."""
+    if not timelines.fans_out_in_jobs:
+        app.logger.error(
+            'Dropping %d timeline fan-out jobs: this process has no timeline '
+            'store shared with the web processes', len(payloads)
+        )
+        return
+    post_ids = [payload['post_id'] for payload in payloads]
+    posts = Post.query.options(
+        db.joinedload(Post.author)
+    ).filter(Post.id.in_(post_ids)).order_by(Post.id)
+    for post in posts:
+        timelines.fan_out(post)
@@ -0,0 +1,50 @@
+# -*- coding: utf-8 -*-
+#!/usr/bin/env python
+"""Compiled templates kept on disk, shared by every worker and deploy."""
+from jinja2 import FileSystemBytecodeCache
+from typing import List
+import os
+import threading
+
+
+class AtomicBytecodeCache(FileSystemBytecodeCache):
+    """Jinja's file bytecode cache, writing each entry under a temporary name.
+
+    Workers starting together may compile the same template at once; the
+    rename means none of them ever reads another's half-written file.
+    """
+
+    def dump_bytecode(self, bucket) -> None:
+        """Write a compiled template, then move it into place."""
+        path = self._get_cache_filename(bucket)
+        partial = f'{path}.{os.getpid()}.{threading.get_ident()}'
+        with open(partial, 'wb') as output:
+            bucket.write_bytecode(output)
+        os.replace(partial, path)
+
+
+def use_bytecode_cache(app, create: bool=False) -> None:
+    """Cache compiled templates in TEMPLATE_CACHE_DIR, if one is set.
+
+    Only deploy-time compiling and servers warming the app create the
+    directory; without it, templates are compiled in memory only.
+    """
+    directory = app.config.get('TEMPLATE_CACHE_DIR')
+    if not directory:
+        return
+    if create:
+        os.makedirs(directory, exist_ok=True)
+    if os.path.isdir(directory):
+        app.jinja_env.bytecode_cache = AtomicBytecodeCache(directory)
+
+
+def compile_templates(app) -> List[str]:
+    """Compile every template the app can find; return their names.
+
+    Each one is parsed at most once: templates already in the bytecode
+    cache are loaded from it, the others are compiled and written to it.
+    """
+    names = app.jinja_env.list_templates()
+    for name in names:
+        app.jinja_env.get_template(name)
+    return names
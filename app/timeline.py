@@ -0,0 +1,528 @@
+# -*- coding: utf-8 -*-
+#!/usr/bin/env python
+"""Materialized home timelines, filled in when posts are written."""
+from abc import ABC, abstractmethod
+from app import db
+from app.pagination import CursorPage, NEWER, OLDER, decode_cursor
+from bisect import bisect_left, insort
+from datetime import datetime
+from typing import Iterable, List, Tuple
+import os
+import sqlite3
+import threading
+import weakref
+
+
+Entry = Tuple[datetime, int, int]  # (timestamp, post id, author id)
+
+TIMESTAMP_FORMAT = '%Y-%m-%dT%H:%M:%S.%f'
+
+
+class TimelineStore(ABC):
+    """A bounded, per-user list of timeline entries kept in key order.
+
+    Entries are ``(timestamp, post_id, author_id)`` tuples. A user only has
+    a timeline once it has been materialized with ``replace``; ``push`` to
+    users without one is ignored so a partial timeline is never served.
+    ``shared`` says whether every process on the host sees the same
+    timelines, which fan-out in a job worker relies on.
+    """
+
+    shared = False
+
+    def __init__(self, max_length: int=800) -> None:
+        """Keep at most max_length entries per user."""
+        self.max_length = max_length
+
+    @abstractmethod
+    def has(self, user_id: int) -> bool:
+        """Whether the user's timeline has been materialized."""
+
+    @abstractmethod
+    def size(self, user_id: int) -> int:
+        """How many entries the user's timeline currently holds."""
+
+    @abstractmethod
+    def oldest(self, user_id: int) -> Entry:
+        """The oldest entry still held for a user, or None."""
+
+    @abstractmethod
+    def replace(self, user_id: int, entries: Iterable[Entry]) -> None:
+        """Materialize a user's timeline from scratch."""
+
+    @abstractmethod
+    def push(self, user_ids: Iterable[int], entry: Entry) -> None:
+        """Add one entry to every listed user that has a timeline."""
+
+    @abstractmethod
+    def extend(self, user_id: int, entries: Iterable[Entry]) -> None:
+        """Merge several entries into one user's timeline."""
+
+    @abstractmethod
+    def remove_author(self, user_id: int, author_id: int) -> None:
+        """Drop every entry written by author_id from a user's timeline."""
+
+    @abstractmethod
+    def page(self, user_id: int, direction: str=None,
+             key: Tuple[datetime, int]=None, limit: int=20) -> List[Entry]:
+        """Up to limit entries past key, newest first.
+
+        With no key this is the head of the timeline; OLDER returns entries
+        below key and NEWER returns the entries just above it.
+        """
+
+    @abstractmethod
+    def clear(self) -> None:
+        """Forget every timeline."""
+
+
+class MemoryTimelineStore(TimelineStore):
+    """Timelines held in process memory, oldest entry first.
+
+    Only the process that holds them sees them: fan-out from a job worker
+    or another server process would never reach this one's readers, so it
+    suits a single process serving requests and running its own jobs.
+    """
+
+    def __init__(self, max_length: int=800) -> None:
+        """Start with no materialized timelines."""
+        super(MemoryTimelineStore, self).__init__(max_length)
+        self._timelines = {}
+        self._lock = threading.Lock()
+
+    def has(self, user_id: int) -> bool:
+        """Whether the user's timeline has been materialized."""
+        return user_id in self._timelines
+
+    def size(self, user_id: int) -> int:
+        """How many entries the user's timeline currently holds."""
+        return len(self._timelines.get(user_id, ()))
+
+    def oldest(self, user_id: int) -> Entry:
+        """The oldest entry still held for a user, or None."""
+        timeline = self._timelines.get(user_id)
+        return timeline[0] if timeline else None
+
+    def replace(self, user_id: int, entries: Iterable[Entry]) -> None:
+        """Materialize a user's timeline from scratch."""
+        timeline = sorted(set(entries))[-self.max_length:]
+        with self._lock:
+            self._timelines[user_id] = timeline
+
+    def push(self, user_ids: Iterable[int], entry: Entry) -> None:
+        """Add one entry to every listed user that has a timeline."""
+        with self._lock:
+            for user_id in user_ids:
+                timeline = self._timelines.get(user_id)
+                if timeline is not None:
+                    self._insert(timeline, entry)
+
+    def extend(self, user_id: int, entries: Iterable[Entry]) -> None:
+        """Merge several entries into one user's timeline."""
+        with self._lock:
+            timeline = self._timelines.get(user_id)
+            if timeline is None:
+                return
+            for entry in entries:
+                self._insert(timeline, entry)
+
+    def remove_author(self, user_id: int, author_id: int) -> None:
+        """Drop every entry written by author_id from a user's timeline."""
+        with self._lock:
+            timeline = self._timelines.get(user_id)
+            if timeline is not None:
+                timeline[:] = [e for e in timeline if e[2] != author_id]
+
+    def page(self, user_id: int, direction: str=None,
+             key: Tuple[datetime, int]=None, limit: int=20) -> List[Entry]:
+        """Up to limit entries past key, newest first."""
+        with self._lock:
+            timeline = self._timelines.get(user_id, [])
+            if direction is None:
+                chunk = timeline[-limit:]
+            elif direction == OLDER:
+                end = bisect_left(timeline, key)
+                chunk = timeline[max(0, end - limit):end]
+            else:
+                start = bisect_left(timeline, (key[0], key[1] + 1))
+                chunk = timeline[start:start + limit]
+        return list(reversed(chunk))
+
+    def clear(self) -> None:
+        """Forget every timeline."""
+        with self._lock:
+            self._timelines = {}
+
+    def _insert(self, timeline: list, entry: Entry) -> None:
+        """Insert in key order, skipping duplicates and trimming the tail."""
+        index = bisect_left(timeline, entry)
+        if index < len(timeline) and timeline[index] == entry:
+            return
+        insort(timeline, entry)
+        if len(timeline) > self.max_length:
+            del timeline[:len(timeline) - self.max_length]
+
+
+class SQLiteTimelineStore(TimelineStore):
+    """Timelines kept in a local SQLite file that survives restarts.
+
+    The file is opened on first use, once in every process: a SQLite
+    connection must not be used on both sides of a fork, so a forked
+    worker drops the one it inherited and opens its own.
+    """
+
+    shared = True
+
+    def __init__(self, path: str, max_length: int=800) -> None:
+        """Use the timeline database at path, created when first opened."""
+        super(SQLiteTimelineStore, self).__init__(max_length)
+        self.path = path
+        self._forget()
+        _sqlite_stores.add(self)
+
+    @property
+    def _conn(self) -> sqlite3.Connection:
+        """This process's connection; callers hold the lock."""
+        if self._connection is None:
+            self._connection = sqlite3.connect(
+                self.path, check_same_thread=False
+            )
+            with self._connection:
+                self._connection.execute(
+                    'CREATE TABLE IF NOT EXISTS timeline_owner ('
+                    'user_id INTEGER PRIMARY KEY)'
+                )
+                self._connection.execute(
+                    'CREATE TABLE IF NOT EXISTS timeline_entry ('
+                    'user_id INTEGER NOT NULL, ts TEXT NOT NULL, '
+                    'post_id INTEGER NOT NULL, author_id INTEGER NOT NULL, '
+                    'PRIMARY KEY (user_id, ts, post_id)) WITHOUT ROWID'
+                )
+        return self._connection
+
+    def _forget(self) -> None:
+        """Drop the connection and lock; the next call opens new ones."""
+        self._lock = threading.Lock()
+        self._connection = None
+
+    def has(self, user_id: int) -> bool:
+        """Whether the user's timeline has been materialized."""
+        with self._lock:
+            row = self._conn.execute(
+                'SELECT 1 FROM timeline_owner WHERE user_id = ?', (user_id,)
+            ).fetchone()
+        return row is not None
+
+    def size(self, user_id: int) -> int:
+        """How many entries the user's timeline currently holds."""
+        with self._lock:
+            return self._conn.execute(
+                'SELECT count(*) FROM timeline_entry WHERE user_id = ?',
+                (user_id,)
+            ).fetchone()[0]
+
+    def oldest(self, user_id: int) -> Entry:
+        """The oldest entry still held for a user, or None."""
+        with self._lock:
+            row = self._conn.execute(
+                'SELECT ts, post_id, author_id FROM timeline_entry '
+                'WHERE user_id = ? ORDER BY ts ASC, post_id ASC LIMIT 1',
+                (user_id,)
+            ).fetchone()
+        if row is None:
+            return None
+        return (datetime.strptime(row[0], TIMESTAMP_FORMAT), row[1], row[2])
+
+    def replace(self, user_id: int, entries: Iterable[Entry]) -> None:
+        """Materialize a user's timeline from scratch."""
+        with self._lock, self._conn:
+            self._conn.execute(
+                'DELETE FROM timeline_entry WHERE user_id = ?', (user_id,)
+            )
+            self._conn.execute(
+                'INSERT OR IGNORE INTO timeline_owner (user_id) VALUES (?)',
+                (user_id,)
+            )
+            self._insert(user_id, entries)
+
+    def push(self, user_ids: Iterable[int], entry: Entry) -> None:
+        """Add one entry to every listed user that has a timeline."""
+        user_ids = list(user_ids)
+        with self._lock, self._conn:
+            for start in range(0, len(user_ids), 500):
+                chunk = user_ids[start:start + 500]
+                marks = ','.join('?' * len(chunk))
+                owners = [row[0] for row in self._conn.execute(
+                    'SELECT user_id FROM timeline_owner '
+                    f'WHERE user_id IN ({marks})', chunk
+                )]
+                for user_id in owners:
+                    self._insert(user_id, [entry])
+
+    def extend(self, user_id: int, entries: Iterable[Entry]) -> None:
+        """Merge several entries into one user's timeline."""
+        with self._lock, self._conn:
+            owner = self._conn.execute(
+                'SELECT 1 FROM timeline_owner WHERE user_id = ?', (user_id,)
+            ).fetchone()
+            if owner is not None:
+                self._insert(user_id, entries)
+
+    def remove_author(self, user_id: int, author_id: int) -> None:
+        """Drop every entry written by author_id from a user's timeline."""
+        with self._lock, self._conn:
+            self._conn.execute(
+                'DELETE FROM timeline_entry '
+                'WHERE user_id = ? AND author_id = ?', (user_id, author_id)
+            )
+
+    def page(self, user_id: int, direction: str=None,
+             key: Tuple[datetime, int]=None, limit: int=20) -> List[Entry]:
+        """Up to limit entries past key, newest first."""
+        sql = 'SELECT ts, post_id, author_id FROM timeline_entry '
+        params = [user_id]
+        if direction is None:
+            sql += 'WHERE user_id = ? ORDER BY ts DESC, post_id DESC'
+        elif direction == OLDER:
+            sql += ('WHERE user_id = ? AND (ts, post_id) < (?, ?) '
+                    'ORDER BY ts DESC, post_id DESC')
+            params += [key[0].strftime(TIMESTAMP_FORMAT), key[1]]
+        else:
+            sql += ('WHERE user_id = ? AND (ts, post_id) > (?, ?) '
+                    'ORDER BY ts ASC, post_id ASC')
+            params += [key[0].strftime(TIMESTAMP_FORMAT), key[1]]
+        with self._lock:
+            rows = self._conn.execute(sql + ' LIMIT ?', params + [limit])
+            entries = [
+                (datetime.strptime(ts, TIMESTAMP_FORMAT), post_id, author_id)
+                for ts, post_id, author_id in rows
+            ]
+        if direction == NEWER:
+            entries.reverse()
+        return entries
+
+    def clear(self) -> None:
+        """Forget every timeline."""
+        with self._lock, self._conn:
+            self._conn.execute('DELETE FROM timeline_entry')
+            self._conn.execute('DELETE FROM timeline_owner')
+
+    def _insert(self, user_id: int, entries: Iterable[Entry]) -> None:
+        """Insert entries for one user and trim it back to max_length."""
+        self._conn.executemany(
+            'INSERT OR IGNORE INTO timeline_entry '
+            '(user_id, ts, post_id, author_id) VALUES (?, ?, ?, ?)',
+            [(user_id, ts.strftime(TIMESTAMP_FORMAT), post_id, author_id)
+             for ts, post_id, author_id in entries]
+        )
+        self._conn.execute(
+            'DELETE FROM timeline_entry WHERE user_id = ? AND '
+            '(ts, post_id) NOT IN (SELECT ts, post_id FROM timeline_entry '
+            'WHERE user_id = ? ORDER BY ts DESC, post_id DESC LIMIT ?)',
+            (user_id, user_id, self.max_length)
+        )
+
+
+# every SQLite store, so a forked child can drop the parent's connections
+_sqlite_stores = weakref.WeakSet()
+
+
+def _forget_sqlite_connections() -> None:
+    """In a forked child, stop using the connections of the parent."""
+    for store in list(_sqlite_stores):
+        store._forget()
+
+
+os.register_at_fork(after_in_child=_forget_sqlite_connections)
+
+
+class Timelines(object):
+    """Fan-out-on-write home timelines with a fan-out-on-read fallback.
+
+    New posts are pushed into the stored timeline of every follower, so
+    the home page reads a precomputed list of post ids. Authors with more
+    than ``TIMELINE_FANOUT_LIMIT`` followers are never fanned out; their
+    posts are merged in at read time instead. When ``TIMELINE_ENABLED`` is
+    off every call falls through to the plain ``followed_posts`` query.
+    """
+
+    def __init__(self, app=None) -> None:
+        """Create a disabled timeline service, optionally bound to an app."""
+        self.enabled = False
+        self.store = None
+        self.fanout_limit = 10000
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app) -> None:
+        """Pick the store backend and limits from the app config."""
+        self.enabled = app.config.get('TIMELINE_ENABLED', False)
+        self.fanout_limit = app.config.get('TIMELINE_FANOUT_LIMIT', 10000)
+        max_length = app.config.get('TIMELINE_MAX_LENGTH', 800)
+        if app.config.get('TIMELINE_BACKEND', 'memory') == 'sqlite':
+            self.store = SQLiteTimelineStore(
+                app.config['TIMELINE_SQLITE_PATH'], max_length
+            )
+        else:
+            self.store = MemoryTimelineStore(max_length)
+
+    def is_celebrity(self, user) -> bool:
+        """Whether a user has too many followers to fan out to."""
+        return (user.follower_count or 0) > self.fanout_limit
+
+    def celebrity_ids(self, user) -> List[int]:
+        """Ids of the accounts this user follows that are read at read time."""
+        from app.models import User, followers
+        rows = db.session.query(User.id).join(
+            followers, followers.c.followed_id == User.id
+        ).filter(
+            followers.c.follower_id == user.id,
+            User.follower_count > self.fanout_limit
+        )
+        return [row[0] for row in rows]
+
+    @property
+    def fans_out_in_jobs(self) -> bool:
+        """Whether new posts are fanned out by job workers.
+
+        Jobs run in whichever process claims them, so this needs a store
+        every process shares; with a per-process one the request that
+        wrote the post fans it out itself.
+        """
+        return self.enabled and self.store.shared
+
+    def fan_out(self, post) -> None:
+        """Push a freshly committed post into its author's followers."""
+        if not self.enabled:
+            return
+        from app.models import followers
+        author = post.author
+        if self.is_celebrity(author):
+            return
+        follower_ids = [row[0] for row in db.session.query(
+            followers.c.follower_id
+        ).filter(followers.c.followed_id == author.id)]
+        self.store.push(follower_ids, (post.timestamp, post.id, author.id))
+
+    def backfill(self, user, followed) -> None:
+        """Merge a newly followed account's recent posts into a timeline."""
+        if not self.enabled or not self.store.has(user.id):
+            return
+        if self.is_celebrity(followed):
+            return
+        from app.models import Post
+        rows = db.session.query(
+            Post.timestamp, Post.id, Post.user_id
+        ).filter(
+            Post.user_id == followed.id
+        ).order_by(
+            Post.timestamp.desc(), Post.id.desc()
+        ).limit(self.store.max_length)
+        self.store.extend(user.id, [tuple(row) for row in rows])
+
+    def prune(self, user, unfollowed) -> None:
+        """Remove an unfollowed account's posts from a timeline."""
+        if self.enabled:
+            self.store.remove_author(user.id, unfollowed.id)
+
+    def materialize(self, user, celebrity_ids: List[int]) -> None:
+        """Build a user's stored timeline from the database."""
+        from app.models import Post
+        query = user.followed_posts().with_entities(
+            Post.timestamp, Post.id, Post.user_id
+        )
+        if celebrity_ids:
+            query = query.filter(~Post.user_id.in_(celebrity_ids))
+        rows = query.order_by(None).order_by(
+            Post.timestamp.desc(), Post.id.desc()
+        ).limit(self.store.max_length)
+        self.store.replace(user.id, [tuple(row) for row in rows])
+
+    def page(self, user, cursor: str=None, per_page: int=20) -> CursorPage:
+        """One page of a user's home timeline.
+
+        Raises ValueError for a malformed cursor, like paginate_posts.
+        """
+        from app.models import Post
+        from app.pagination import paginate_posts
+        if not self.enabled:
+            return paginate_posts(user.followed_posts(), cursor, per_page)
+
+        direction = key = None
+        if cursor is not None:
+            direction, timestamp, post_id = decode_cursor(cursor)
+            key = (timestamp, post_id)
+        celebrity_ids = self.celebrity_ids(user)
+        if not self.store.has(user.id):
+            self.materialize(user, celebrity_ids)
+
+        entries = self.store.page(user.id, direction, key, per_page + 1)
+        if self._outside_window(user, direction, key, len(entries), per_page):
+            return paginate_posts(user.followed_posts(), cursor, per_page)
+
+        if celebrity_ids:
+            celebrity_posts = paginate_posts(
+                Post.query.filter(Post.user_id.in_(celebrity_ids)),
+                cursor, per_page
+            )
+            entries = sorted(set(entries) | {
+                (p.timestamp, p.id, p.user_id) for p in celebrity_posts.items
+            }, reverse=True)
+            # The celebrity page was trimmed; an extra row there still counts.
+            more_celebrity = (
+                celebrity_posts.has_prev if direction == NEWER
+                else celebrity_posts.has_next
+            )
+        else:
+            more_celebrity = False
+
+        more = len(entries) > per_page or more_celebrity
+        if direction == NEWER:
+            entries = entries[-per_page:]
+        else:
+            entries = entries[:per_page]
+        items = self._load([entry[1] for entry in entries])
+        if direction == NEWER:
+            return CursorPage(items, more, True)
+        return CursorPage(items, direction == OLDER, more)
+
+    def current(self, user) -> bool:
+        """Whether the stored timeline holds the newest post fanned out to it.
+
+        It lags the database while a fan-out job is still queued, so a page
+        read from it can be older than the posts a home ETag is built from.
+        """
+        if not self.enabled or not self.store.has(user.id):
+            return True
+        from app.models import Post, User, followers
+        newest = db.session.query(Post.timestamp, Post.id).join(
+            followers, followers.c.followed_id == Post.user_id
+        ).join(
+            User, User.id == Post.user_id
+        ).filter(
+            followers.c.follower_id == user.id,
+            db.func.coalesce(User.follower_count, 0) <= self.fanout_limit
+        ).order_by(Post.timestamp.desc(), Post.id.desc()).first()
+        if newest is None:
+            return True
+        head = self.store.page(user.id, limit=1)
+        return bool(head) and head[0][:2] >= tuple(newest)
+
+    def _outside_window(self, user, direction: str, key: Tuple[datetime, int],
+                        found: int, per_page: int) -> bool:
+        """Whether a page reaches past the oldest entry a full store kept."""
+        if self.store.size(user.id) < self.store.max_length:
+            return False
+        if direction != NEWER and found <= per_page:
+            return True
+        return key is not None and key < self.store.oldest(user.id)[:2]
+
+    def _load(self, post_ids: List[int]) -> list:
+        """Fetch posts by id in one query, keeping the given order."""
+        from app.models import Post
+        if not post_ids:
+            return []
+        posts = {p.id: p for p in Post.query.options(
+            db.joinedload(Post.author)
+        ).filter(Post.id.in_(post_ids))}
+        return [posts[i] for i in post_ids if i in posts]
@@ -1,27 +1,48 @@
 """Request handlers for the microblog."""
-from app import app, db, lm
+from app import (
+    app, conditional, db, fragments, identity, jobs, lm, last_seen_tracker,
+    passwords, pool_stats, replicas, search_index, shards, timelines
+)
+from app.api import POST_COLUMNS, post_json
+from app.bulk import user_ids
 from app.forms import LoginForm, RegistrationForm, ProfileForm, PostForm
 from app.models import User, Post
+from app.pagination import newer_key, paginate_posts
+from app.passwords import PasswordsBusy
 from config import POSTS_PER_PAGE
 from datetime import datetime
 from flask import (
     render_template, flash, redirect,
-    url_for, request, g, session
+    url_for, request, g, session, abort, jsonify
 )
 from flask_login import login_user, logout_user, current_user, login_required
+from functools import wraps
+from sqlalchemy.exc import IntegrityError
 
-from typing import Union
+from typing import Callable, Union
 from werkzeug.local import LocalStack
 from werkzeug.wrappers import Response
+import hmac
+
+
+# the header operators send INTERNAL_TOKEN in to reach /internal/*
+INTERNAL_TOKEN_HEADER = 'X-Internal-Token'
 
 
 @app.route('/', methods=['GET', 'POST'])
-@app.route('/posts/<int:page>', methods=['GET', 'POST'])
+@app.route('/posts/<cursor>', methods=['GET', 'POST'])
 @login_required
-def index(page=1) -> Union[LocalStack, Response]:
+def index(cursor=None) -> Union[LocalStack, Response]:
     """The home page for the Flask microblog."""
     form = PostForm()
     if form.validate_on_submit():
+        if shards.enabled:
+            if not shards.title_taken(form.title.data):
+                shards.add_post(form.title.data, form.body.data, g.user.id)
+                g.user.increment('post_count')
+                db.session.commit()
+                fragments.invalidate_author(g.user.id)
+            return redirect(url_for('index'))
         existing_post = Post.query.filter_by(title=form.title.data).first()
         if not existing_post:
             post = Post(
@@ -31,19 +52,106 @@ def index(page=1) -> Union[LocalStack, Response]:
                 user_id=g.user.id
             )
             db.session.add(post)
+            g.user.increment('post_count')
+            if timelines.fans_out_in_jobs:
+                db.session.flush()
+                jobs.enqueue('timeline.fan_out', post_id=post.id)
             db.session.commit()
+            if not timelines.fans_out_in_jobs:
+                timelines.fan_out(post)
+            fragments.invalidate_author(g.user.id)
         return redirect(url_for('index'))
 
+    etag = None
+    if request.method == 'GET':
+        etag = conditional.timeline_etag(g.user, cursor)
+        unchanged = conditional.not_modified(etag)
+        if unchanged is not None:
+            return unchanged
+
+    def render_posts() -> str:
+        try:
+            if shards.enabled:
+                posts = shards.timeline_page(g.user, cursor, POSTS_PER_PAGE)
+            else:
+                posts = timelines.page(g.user, cursor, POSTS_PER_PAGE)
+        except ValueError:
+            abort(404)
+        return render_template(
+            'post_list.html', posts=posts, endpoint='index', endpoint_args={}
+        )
+
+    post_list, cached = fragments.page('home', g.user.id, cursor, render_posts)
+    if cached or not (shards.enabled or timelines.current(g.user)):
+        # the body may predate the state the ETag was built from
+        etag = None
     user = {'nickname': g.user.username}
-    posts = g.user.followed_posts().paginate(page, POSTS_PER_PAGE, False)
-
     context = {
         'title': 'Home',
         'user': user,
-        'posts': posts,
-        'form': form
+        'post_list': post_list,
+        'form': form,
+        'poll_seconds': app.config.get('NEW_POSTS_POLL_SECONDS', 30)
+        if cursor is None else None
     }
-    return render_template('index.html', **context)
+    return conditional.tag(render_template('index.html', **context), etag)
+
+
+@app.route('/posts/new')
+@login_required
+def new_posts() -> Response:
+    """Followed posts newer than the client's top post, for polling.
+
+    ``since`` is the top_cursor of the posts the client already shows.
+    Posts come back oldest first in runs of NEW_POSTS_LIMIT, as rendered
+    post.html rows or, with ``format=json``, as API objects; ``more`` says
+    whether another run is waiting.
+    """
+    since = request.args.get('since')
+    limit = app.config.get('NEW_POSTS_LIMIT', 50)
+    query = g.user.followed_posts()
+    try:
+        if since is not None:
+            newer_key(since)
+        if shards.enabled:
+            page = shards.timeline_page(g.user, since, limit)
+            if request.args.get('format') == 'json':
+                body = {'posts': [post_json(p.as_row()) for p in page.items]}
+            else:
+                body = {'html': ''.join(fragments.render_posts(page.items))}
+        elif request.args.get('format') == 'json':
+            page = paginate_posts(
+                query.join(User, User.id == Post.user_id), since, limit,
+                POST_COLUMNS
+            )
+            body = {'posts': [post_json(row) for row in page.items]}
+        else:
+            page = paginate_posts(query, since, limit)
+            body = {'html': ''.join(fragments.render_posts(page.items))}
+    except ValueError:
+        abort(400)
+    body.update({
+        'count': len(page.items),
+        'more': page.has_prev if since else page.has_next,
+        'top_cursor': page.top_cursor or since,
+    })
+    return jsonify(body)
+
+
+@app.route('/posts/new/count')
+@login_required
+def new_posts_count() -> Response:
+    """How many followed posts are newer than ``since``, up to a cap."""
+    since = request.args.get('since')
+    cap = app.config.get('NEW_POSTS_COUNT_CAP', 100)
+    try:
+        if shards.enabled:
+            count = shards.new_posts_count(g.user, since, cap)
+        else:
+            count = g.user.new_posts_count(since, cap)
+    except ValueError:
+        abort(400)
+    return jsonify({'count': count, 'capped': count >= cap})
 
 
 @app.route('/login', methods=['GET', 'POST'])
@@ -56,12 +164,15 @@ def login() -> Union[Response, LocalStack]:
     if request.method == 'POST':
 
         if form.validate_on_submit():
-            if form.check_credentials():
+            try:
+                valid = form.check_credentials()
+            except PasswordsBusy:
+                return busy('login.html', title='Sign In', form=form)
+            if valid:
                 session['remember_me'] = form.remember_me.data
-                user = User.query.filter_by(
-                    username=form.username.data
-                ).first()
+                user = form.user
                 login_user(user, remember=form.remember_me.data)
+                identity.remember(user)
                 return redirect(url_for('index'))
 
         flash('Invalid login. Please try again.')
@@ -74,6 +185,7 @@ def login() -> Union[Response, LocalStack]:
 def logout() -> LocalStack:
     """Log a user out and remove from global context."""
     logout_user()
+    identity.forget()
     return render_template('logout.html')
 
 
@@ -99,32 +211,99 @@ def register() -> Union[LocalStack, Response]:
             if pw1 != pw2:
                 flash("Passwords don't match")
                 return render_template('register.html', **context)
+            try:
+                hashed = passwords.hash(pw1)
+            except PasswordsBusy:
+                return busy('register.html', **context)
             new_user = User(
-                username=username, password=pw1
+                username=username, password=hashed
             )
             db.session.add(new_user)
             db.session.commit()
             # the new user will follow themselves
             new_user.follow(new_user)
             db.session.add(new_user)
-            dbsession.commit()
+            db.session.commit()
             login_user(new_user)
+            identity.remember(new_user)
             return redirect(url_for('index'))
 
     return render_template('register.html', **context)
 
 
 @app.route('/profile/<username>')
-@app.route('/profile/<username>/<int:page>')
+@app.route('/profile/<username>/<cursor>')
 @login_required
-def profile(username, page=1) -> Union[LocalStack, Response]:
+def profile(username, cursor=None) -> Union[LocalStack, Response]:
     """View for a user's profile."""
     user = User.query.filter_by(username=username).first()
     if not user:
         return redirect(url_for('index'))
-    posts = user.posts.paginate(page, POSTS_PER_PAGE, False)
-    context = {'user': user, 'posts': posts}
-    return render_template('profile.html', **context)
+    last_seen = last_seen_tracker.last_seen(user)
+    if last_seen is not None:
+        # shown to the minute, so the owner's own visits keep the ETag
+        last_seen = last_seen.replace(second=0, microsecond=0)
+    etag = conditional.profile_etag(g.user, user, cursor, last_seen)
+    unchanged = conditional.not_modified(etag)
+    if unchanged is not None:
+        return unchanged
+
+    def render_posts() -> str:
+        try:
+            if shards.enabled:
+                posts = shards.user_page(user, cursor, POSTS_PER_PAGE)
+            else:
+                posts = paginate_posts(user.posts, cursor, POSTS_PER_PAGE)
+        except ValueError:
+            abort(404)
+        return render_template(
+            'post_list.html', posts=posts, endpoint='profile',
+            endpoint_args={'username': user.username}
+        )
+
+    post_list, cached = fragments.page(
+        'profile', user.id, cursor, render_posts
+    )
+    if cached:
+        etag = None
+    context = {
+        'user': user,
+        'post_list': post_list,
+        'last_seen': last_seen
+    }
+    return conditional.tag(render_template('profile.html', **context), etag)
+
+
+@app.route('/search')
+@login_required
+def search() -> LocalStack:
+    """View for full-text search over post titles and bodies."""
+    query = request.args.get('q', '').strip()
+    page = request.args.get('page', 1, type=int)
+    if page < 1:
+        abort(404)
+    posts, total = [], 0
+    if query:
+        ids, total = search_index.search(query, page, POSTS_PER_PAGE)
+        if shards.enabled:
+            posts = shards.load(ids)
+        else:
+            found = {
+                p.id: p for p in Post.query.options(
+                    db.joinedload(Post.author)
+                ).filter(Post.id.in_(ids))
+            } if ids else {}
+            posts = [found[i] for i in ids if i in found]
+    context = {
+        'title': 'Search',
+        'query': query,
+        'posts': posts,
+        'total': total,
+        'page': page,
+        'has_prev': page > 1,
+        'has_next': page * POSTS_PER_PAGE < total
+    }
+    return render_template('search.html', **context)
 
 
 @app.route('/edit_profile', methods=['GET', 'POST'])
@@ -133,11 +312,15 @@ def edit_profile() -> Union[LocalStack, Response]:
     """View for editing a user's profile."""
     form = ProfileForm(g.user.username)
     if form.validate_on_submit():
-        g.user.username = form.username.data
-        g.user.about_me = form.about_me.data
-        db.session.add(g.user)
+        user = g.user.row
+        user.username = form.username.data
+        user.about_me = form.about_me.data
+        user.increment('profile_version')
+        db.session.add(user)
         db.session.commit()
-        return redirect(url_for('profile'))
+        identity.remember(user)
+        fragments.invalidate_author(user.id)
+        return redirect(url_for('profile', username=user.username))
     else:
         form.username.data = g.user.username
         form.about_me.data = g.user.about_me
@@ -154,11 +337,15 @@ def follow(username) -> Response:
         return redirect(url_for('index'))
     if user == g.user:
         return redirect(url_for('profile', username=username))
-    u = g.user.follow(user)
-    if not u:
-        return redirect(url_for('profile', username=username))
-    db.session.add(u)
-    db.session.commit()
+    try:
+        u = g.user.follow(user)
+        if u:
+            db.session.add(u)
+            db.session.commit()
+    except IntegrityError:
+        # a follow set cached before the edge was added said it was missing
+        db.session.rollback()
+        flash(f'You are already following {username}.')
     return redirect(url_for('profile', username=username))
 
 
@@ -179,6 +366,71 @@ def unfollow(username) -> Response:
     return redirect(url_for('profile', username=username))
 
 
+@app.route('/follow', methods=['POST'])
+@login_required
+def follow_many() -> Response:
+    """Follow a JSON list of usernames and/or ids in one go."""
+    return bulk_follow(g.user.follow_many)
+
+
+@app.route('/unfollow', methods=['POST'])
+@login_required
+def unfollow_many() -> Response:
+    """Unfollow a JSON list of usernames and/or ids in one go."""
+    return bulk_follow(g.user.unfollow_many)
+
+
+def bulk_follow(change) -> Response:
+    """Resolve {"users": [...]} in one query and apply change to the ids."""
+    body = request.get_json(silent=True) or {}
+    refs = body.get('users')
+    limit = app.config.get('FOLLOW_BULK_LIMIT', 10000)
+    if not isinstance(refs, list) or len(refs) > limit or not all(
+        isinstance(ref, (int, str)) and not isinstance(ref, bool)
+        for ref in refs
+    ):
+        abort(400)
+    found = user_ids(refs)
+    targets = {found[ref] for ref in refs if ref in found} - {g.user.id}
+    changed = change(targets)
+    db.session.commit()
+    return jsonify({
+        'changed': changed,
+        'unchanged': len(targets) - len(changed),
+        'unknown': [ref for ref in refs if ref not in found],
+    })
+
+
+def internal_only(view: Callable) -> Callable:
+    """Hide a view unless the request carries the INTERNAL_TOKEN header.
+
+    The client address is no proof of anything behind a reverse proxy,
+    where every request comes from the proxy's own address.
+    """
+    @wraps(view)
+    def wrapped(*args, **kwargs):
+        token = app.config.get('INTERNAL_TOKEN')
+        sent = request.headers.get(INTERNAL_TOKEN_HEADER, '')
+        if not token or not hmac.compare_digest(sent, token):
+            abort(404)
+        return view(*args, **kwargs)
+    return wrapped
+
+
+@app.route('/internal/pool')
+@internal_only
+def internal_pool() -> Response:
+    """Connection pool occupancy and checkout latency, for operators."""
+    return jsonify(pool_stats.snapshot())
+
+
+@app.route('/internal/replicas')
+@internal_only
+def internal_replicas() -> Response:
+    """Health and replay lag of the read replicas, for operators."""
+    return jsonify({'replicas': replicas.status()})
+
+
 @app.errorhandler(404)
 def not_found_error(error) -> LocalStack:
     """View for a 404 error."""
@@ -193,9 +445,9 @@ def internal_error(error) -> LocalStack:
 
 
 @lm.user_loader
-def load_user(id: int) -> User:
-    """Given an ID, load a user from the database."""
-    return User.query.get(int(id))
+def load_user(id: int) -> identity.SessionUser:
+    """Given an ID, identify the user from the session or the database."""
+    return identity.load(id)
 
 
 def authenticated(g_ctx: g) -> bool:
@@ -205,11 +457,18 @@ def authenticated(g_ctx: g) -> bool:
     return False
 
 
+def busy(template: str, **context) -> Response:
+    """Re-show a form with a 503 when the password pool is backed up."""
+    flash('The server is busy. Please try again in a moment.')
+    response = app.make_response(render_template(template, **context))
+    response.status_code = 503
+    response.headers['Retry-After'] = '1'
+    return response
+
+
 @app.before_request
 def before_request() -> None:
     """Execute this before every request."""
     g.user = current_user
     if g.user.is_authenticated:
-        g.user.last_seen = datetime.utcnow()
-        db.session.add(g.user)
-        db.session.commit()
+        last_seen_tracker.record(g.user.id)
@@ -0,0 +1 @@
+"""Benchmarks for the microblog, run against a throwaway database."""
@@ -0,0 +1,164 @@
+# -*- coding: utf-8 -*-
+#!/usr/bin/env python
+"""Deterministic synthetic social graph for benchmarks.
+
+Users follow and post with Zipf-like popularity: a few accounts have most
+of the followers and write most of the posts, like a real network. The
+same arguments and seed always produce the same rows, so runs on different
+commits measure the same data::
+
+    python -m benchmarks.datagen --users 100000 --posts 1000000
+"""
+from app import app, db, passwords
+from app.models import User, Post, followers
+from datetime import datetime, timedelta
+from itertools import accumulate
+from typing import Iterable, Iterator
+import argparse
+import config
+import csv
+import io
+import random
+
+
+PASSWORD = 'bench'
+EPOCH = datetime(2017, 1, 1)
+
+
+def zipf_weights(count: int, exponent: float) -> list:
+    """Cumulative weights where rank r is picked ~ 1 / r**exponent."""
+    return list(accumulate(1.0 / (rank ** exponent)
+                           for rank in range(1, count + 1)))
+
+
+def users(count: int, password: str=PASSWORD) -> Iterator[dict]:
+    """User rows with ids 1..count, all sharing one hash of password."""
+    stored = passwords.hash(password)
+    for user_id in range(1, count + 1):
+        yield {
+            'id': user_id,
+            'username': f'user{user_id}',
+            'password': stored,
+            'about_me': None,
+            'last_seen': None,
+        }
+
+
+def follows(count: int, mean_follows: int=50, exponent: float=1.1,
+            seed: int=0) -> Iterator[dict]:
+    """A power-law follow graph; everyone also follows themselves.
+
+    Out-degree is Pareto distributed around mean_follows and targets are
+    drawn by Zipf popularity over a fixed shuffle of the user ids.
+    """
+    rng = random.Random(seed)
+    popularity = list(range(1, count + 1))
+    rng.shuffle(popularity)
+    weights = zipf_weights(count, exponent)
+    for follower in range(1, count + 1):
+        yield {'follower_id': follower, 'followed_id': follower}
+        degree = min(count - 1, int(rng.paretovariate(2.0) * mean_follows / 2))
+        targets = set(rng.choices(popularity, cum_weights=weights, k=degree))
+        targets.discard(follower)
+        for followed in sorted(targets):
+            yield {'follower_id': follower, 'followed_id': followed}
+
+
+def posts(count: int, user_count: int, exponent: float=0.8,
+          seed: int=0) -> Iterator[dict]:
+    """Post rows, one second apart, authored by Zipf popularity."""
+    rng = random.Random(seed + 1)
+    authors = list(range(1, user_count + 1))
+    rng.shuffle(authors)
+    weights = zipf_weights(user_count, exponent)
+    for post_id in range(1, count + 1):
+        yield {
+            'id': post_id,
+            'title': f'post {post_id}',
+            'body': f'synthetic post number {post_id}',
+            'timestamp': EPOCH + timedelta(seconds=post_id),
+            'user_id': rng.choices(authors, cum_weights=weights)[0],
+        }
+
+
+def bulk_insert(table, rows: Iterable[dict], batch: int=10000) -> int:
+    """Insert rows with COPY on Postgres or executemany elsewhere."""
+    rows = iter(rows)
+    columns = [column.name for column in table.columns]
+    total = 0
+    while True:
+        chunk = [row for _, row in zip(range(batch), rows)]
+        if not chunk:
+            return total
+        if db.engine.dialect.name == 'postgresql':
+            _copy(table, columns, chunk)
+        else:
+            db.engine.execute(table.insert(), chunk)
+        total += len(chunk)
+
+
+def _copy(table, columns: list, chunk: list) -> None:
+    """Stream one chunk of rows through COPY ... FROM STDIN."""
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    for row in chunk:
+        writer.writerow([
+            '' if row.get(c) is None else row[c] for c in columns
+        ])
+    buffer.seek(0)
+    quoted = ', '.join(f'"{c}"' for c in columns)
+    connection = db.engine.raw_connection()
+    try:
+        cursor = connection.cursor()
+        cursor.copy_expert(
+            f'COPY "{table.name}" ({quoted}) FROM STDIN WITH CSV', buffer
+        )
+        connection.commit()
+    finally:
+        connection.close()
+
+
+def load(user_count: int, post_count: int, mean_follows: int=50,
+         seed: int=0, password: str=PASSWORD) -> dict:
+    """Recreate the schema and fill it; return how many rows went in."""
+    from db_reconcile import reconcile_counters
+    db.drop_all()
+    db.create_all()
+    loaded = {
+        'users': bulk_insert(User.__table__, users(user_count, password)),
+        'follows': bulk_insert(
+            followers, follows(user_count, mean_follows, seed=seed)
+        ),
+        'posts': bulk_insert(
+            Post.__table__, posts(post_count, user_count, seed=seed)
+        ),
+    }
+    if db.engine.dialect.name == 'postgresql':
+        db.engine.execute(
+            "SELECT setval('user_id_seq', (SELECT max(id) FROM \"user\"))"
+        )
+        db.engine.execute(
+            "SELECT setval('post_id_seq', (SELECT max(id) FROM post))"
+        )
+    reconcile_counters()
+    if db.engine.dialect.name == 'postgresql':
+        db.engine.execute('ANALYZE')
+    return loaded
+
+
+def main() -> None:
+    """Load a synthetic dataset into the benchmark database."""
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--database', default=config.BENCHMARK_DATABASE_URI)
+    parser.add_argument('--users', type=int, default=10000)
+    parser.add_argument('--posts', type=int, default=100000)
+    parser.add_argument('--follows', type=int, default=50)
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+    app.config['SQLALCHEMY_DATABASE_URI'] = args.database
+    with app.app_context():
+        print(load(args.users, args.posts, args.follows, args.seed))
+
+
+if __name__ == '__main__':
+    main()
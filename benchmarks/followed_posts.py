@@ -0,0 +1,125 @@
+# -*- coding: utf-8 -*-
+#!/usr/bin/env python
+"""Query plan and latency of the home timeline before and after indexing.
+
+Seeds a throwaway database, then times the first page of
+``User.followed_posts`` with the follow/post indexes dropped and again with
+them in place::
+
+    python -m benchmarks.followed_posts --users 5000 --posts 200000
+
+The database named by ``--database`` (``BENCHMARK_DATABASE_URI`` by default)
+is dropped and recreated, so never point it at real data.
+"""
+from app import app, db
+from app.models import User, Post
+from app.pagination import paginate_posts
+from benchmarks import datagen
+import argparse
+import config
+import random
+import statistics
+import time
+
+
+# (drop, create) statements for the indexes added in migration 005
+POSTGRES_INDEXES = [
+    (
+        'ALTER TABLE followers DROP CONSTRAINT followers_pkey',
+        'ALTER TABLE followers ADD CONSTRAINT followers_pkey '
+        'PRIMARY KEY (follower_id, followed_id)',
+    ),
+    (
+        'DROP INDEX ix_followers_followed_id_follower_id',
+        'CREATE INDEX ix_followers_followed_id_follower_id '
+        'ON followers (followed_id, follower_id)',
+    ),
+    (
+        'DROP INDEX ix_post_user_id_timestamp',
+        'CREATE INDEX ix_post_user_id_timestamp '
+        'ON post (user_id, timestamp DESC, id DESC)',
+    ),
+]
+SQLITE_INDEXES = POSTGRES_INDEXES[1:]
+
+
+def timeline_query(user_id: int):
+    """The first home timeline page, as the index view builds it."""
+    return User.query.get(user_id).followed_posts().order_by(None).order_by(
+        Post.timestamp.desc(), Post.id.desc()
+    ).limit(config.POSTS_PER_PAGE + 1)
+
+
+def explain(query) -> str:
+    """The database's plan for a query, with real row counts on Postgres."""
+    sql = str(query.statement.compile(
+        dialect=db.engine.dialect, compile_kwargs={'literal_binds': True}
+    ))
+    if db.engine.dialect.name == 'postgresql':
+        rows = db.engine.execute('EXPLAIN (ANALYZE, BUFFERS) ' + sql)
+        return '\n'.join(row[0] for row in rows)
+    rows = db.engine.execute('EXPLAIN QUERY PLAN ' + sql)
+    return '\n'.join(str(row[-1]) for row in rows)
+
+
+def measure(user_ids: list, repeat: int) -> list:
+    """Milliseconds taken by each first-page timeline read."""
+    timings = []
+    for _ in range(repeat):
+        for user_id in user_ids:
+            user = User.query.get(user_id)
+            started = time.perf_counter()
+            paginate_posts(user.followed_posts(), None, config.POSTS_PER_PAGE)
+            timings.append((time.perf_counter() - started) * 1000)
+            db.session.remove()
+    return timings
+
+
+def summarize(label: str, timings: list) -> None:
+    """Print the median and tail latency of a run."""
+    ordered = sorted(timings)
+    p95 = ordered[int(len(ordered) * 0.95) - 1]
+    print(f'{label}: p50 {statistics.median(ordered):.2f} ms, '
+          f'p95 {p95:.2f} ms over {len(ordered)} reads')
+
+
+def main() -> None:
+    """Seed, then compare plans and latency without and with the indexes."""
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--database', default=config.BENCHMARK_DATABASE_URI)
+    parser.add_argument('--users', type=int, default=2000)
+    parser.add_argument('--follows', type=int, default=50)
+    parser.add_argument('--posts', type=int, default=100000)
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--sample', type=int, default=20)
+    args = parser.parse_args()
+
+    app.config['SQLALCHEMY_DATABASE_URI'] = args.database
+    with app.app_context():
+        datagen.load(args.users, args.posts, args.follows)
+        indexes = (
+            POSTGRES_INDEXES if db.engine.dialect.name == 'postgresql'
+            else SQLITE_INDEXES
+        )
+        sample = random.Random(1).sample(
+            range(1, args.users + 1), min(args.sample, args.users)
+        )
+
+        for drop, _ in indexes:
+            db.engine.execute(drop)
+        print('--- without indexes ---')
+        print(explain(timeline_query(sample[0])))
+        summarize('without indexes', measure(sample, args.repeat))
+
+        for _, create in indexes:
+            db.engine.execute(create)
+        if db.engine.dialect.name == 'postgresql':
+            db.engine.execute('ANALYZE')
+        print('--- with indexes ---')
+        print(explain(timeline_query(sample[0])))
+        summarize('with indexes', measure(sample, args.repeat))
+        db.session.remove()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,262 @@
+# -*- coding: utf-8 -*-
+#!/usr/bin/env python
+"""Drive the app with a realistic mix of timeline reads, posts and follows.
+
+Against the in-process Flask test client (loading a synthetic dataset
+first)::
+
+    python -m benchmarks.load --load --users 10000 --posts 100000 \\
+        --requests 5000 --out before.json
+
+Or against a running server, with the same dataset already loaded::
+
+    python -m benchmarks.load --url http://127.0.0.1:5000 --users 10000 \\
+        --concurrency 16 --requests 20000 --out after.json
+
+Compare two runs with ``python -m benchmarks.report before.json after.json``.
+"""
+from app import app, create_app, db
+from benchmarks import datagen, report
+from http.cookiejar import CookieJar
+from typing import Dict, Tuple
+from urllib.error import HTTPError
+from urllib.parse import urlencode
+import argparse
+import config
+import random
+import re
+import threading
+import time
+import urllib.request
+
+
+# relative weight of each operation in the traffic mix
+MIX = {
+    'timeline': 70,
+    'older': 10,
+    'profile': 12,
+    'post': 5,
+    'follow': 3,
+}
+
+TOKEN = re.compile(r'name="csrf_token"[^>]*value="([^"]+)"')
+OLDER_LINK = re.compile(r'href="([^"]+)">&gt;&gt; Older posts')
+
+
+class TestClientSession(object):
+    """One logged-in browser, served in-process by the Flask test client."""
+
+    def __init__(self) -> None:
+        """Open a fresh client with its own cookie jar."""
+        self.client = create_app().test_client()
+
+    def get(self, path: str) -> Tuple[int, str]:
+        """GET a path without following redirects."""
+        response = self.client.get(path)
+        return response.status_code, response.get_data(as_text=True)
+
+    def post(self, path: str, data: dict) -> Tuple[int, str]:
+        """POST a form without following redirects."""
+        response = self.client.post(path, data=data)
+        return response.status_code, response.get_data(as_text=True)
+
+
+class _NoRedirect(urllib.request.HTTPRedirectHandler):
+    """Report redirects instead of following them, like the test client."""
+
+    def redirect_request(self, *args, **kwargs):
+        return None
+
+
+class HTTPSession(object):
+    """One logged-in browser talking to a running server over HTTP."""
+
+    def __init__(self, base_url: str) -> None:
+        """Open a cookie-keeping connection to base_url."""
+        self.base_url = base_url.rstrip('/')
+        self.opener = urllib.request.build_opener(
+            urllib.request.HTTPCookieProcessor(CookieJar()), _NoRedirect()
+        )
+
+    def get(self, path: str) -> Tuple[int, str]:
+        """GET a path without following redirects."""
+        return self._open(urllib.request.Request(self.base_url + path))
+
+    def post(self, path: str, data: dict) -> Tuple[int, str]:
+        """POST a form without following redirects."""
+        return self._open(urllib.request.Request(
+            self.base_url + path, data=urlencode(data).encode()
+        ))
+
+    def _open(self, request) -> Tuple[int, str]:
+        """Send a request, treating 3xx/4xx/5xx as ordinary responses."""
+        try:
+            with self.opener.open(request, timeout=30) as response:
+                return response.status, response.read().decode()
+        except HTTPError as error:
+            return error.code, error.read().decode()
+
+
+class VirtualUser(object):
+    """A synthetic account clicking through the site."""
+
+    def __init__(self, session, user_id: int, user_count: int,
+                 rng: random.Random) -> None:
+        """Act as user{user_id} through the given session."""
+        self.session = session
+        self.user_id = user_id
+        self.user_count = user_count
+        self.rng = rng
+        self.token = None
+        self.older = None
+        self.posted = 0
+
+    def login(self) -> int:
+        """Sign in with the synthetic password."""
+        status, html = self.session.get('/login')
+        status, html = self.session.post('/login', {
+            'username': f'user{self.user_id}',
+            'password': datagen.PASSWORD,
+            'csrf_token': self._token(html),
+        })
+        return status
+
+    def timeline(self) -> int:
+        """Load the first page of the home timeline."""
+        status, html = self.session.get('/')
+        self.token = self._token(html) or self.token
+        match = OLDER_LINK.search(html)
+        self.older = match.group(1) if match else None
+        return status
+
+    def older_page(self) -> int:
+        """Follow the "older posts" link from the last timeline page."""
+        if self.older is None:
+            return self.timeline()
+        status, html = self.session.get(self.older)
+        match = OLDER_LINK.search(html)
+        self.older = match.group(1) if match else None
+        return status
+
+    def profile(self) -> int:
+        """Look at somebody's profile."""
+        other = self.rng.randint(1, self.user_count)
+        return self.session.get(f'/profile/user{other}')[0]
+
+    def post(self) -> int:
+        """Write a new post."""
+        if self.token is None:
+            self.timeline()
+        self.posted += 1
+        title = f'load {self.user_id}-{self.posted}-{self.rng.random()}'
+        return self.session.post('/', {
+            'title': title,
+            'body': 'written by the load harness',
+            'csrf_token': self.token,
+        })[0]
+
+    def follow(self) -> int:
+        """Follow somebody."""
+        other = self.rng.randint(1, self.user_count)
+        return self.session.get(f'/follow/user{other}')[0]
+
+    def _token(self, html: str) -> str:
+        """The CSRF token in a page's form, if it has one."""
+        match = TOKEN.search(html)
+        return match.group(1) if match else None
+
+
+def run(make_session, user_count: int, requests: int, concurrency: int=1,
+        mix: Dict[str, int]=MIX, seed: int=0) -> Tuple[dict, dict, float]:
+    """Replay the mix; return latency samples, error counts and wall time."""
+    samples = {name: [] for name in list(mix) + ['login']}
+    errors = {}
+    lock = threading.Lock()
+    names = list(mix)
+    weights = [mix[name] for name in names]
+
+    def record(name: str, started: float, status: int) -> None:
+        with lock:
+            samples[name].append((time.perf_counter() - started) * 1000)
+            if status >= 400:
+                errors[name] = errors.get(name, 0) + 1
+
+    def worker(index: int, quota: int) -> None:
+        rng = random.Random(seed * 1000 + index)
+        user = VirtualUser(
+            make_session(), rng.randint(1, user_count), user_count, rng
+        )
+        started = time.perf_counter()
+        record('login', started, user.login())
+        actions = {
+            'timeline': user.timeline,
+            'older': user.older_page,
+            'profile': user.profile,
+            'post': user.post,
+            'follow': user.follow,
+        }
+        for name in rng.choices(names, weights=weights, k=quota):
+            started = time.perf_counter()
+            try:
+                status = actions[name]()
+            except Exception:
+                status = 599
+            record(name, started, status)
+
+    quotas = [requests // concurrency] * concurrency
+    quotas[0] += requests - sum(quotas)
+    threads = [
+        threading.Thread(target=worker, args=(i, quota))
+        for i, quota in enumerate(quotas)
+    ]
+    started = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return samples, errors, time.perf_counter() - started
+
+
+def main() -> None:
+    """Optionally load data, replay the traffic mix and save a report."""
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--url', help='drive a running server instead')
+    parser.add_argument('--database', default=config.BENCHMARK_DATABASE_URI)
+    parser.add_argument('--load', action='store_true',
+                        help='recreate and fill the database first')
+    parser.add_argument('--users', type=int, default=1000)
+    parser.add_argument('--posts', type=int, default=20000)
+    parser.add_argument('--follows', type=int, default=50)
+    parser.add_argument('--requests', type=int, default=2000)
+    parser.add_argument('--concurrency', type=int, default=1)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--out', default='bench_output.json')
+    args = parser.parse_args()
+
+    if args.url:
+        make_session = lambda: HTTPSession(args.url)  # noqa: E731
+    else:
+        app.config['SQLALCHEMY_DATABASE_URI'] = args.database
+        make_session = TestClientSession
+        if args.load:
+            with app.app_context():
+                print(datagen.load(
+                    args.users, args.posts, args.follows, args.seed
+                ))
+                db.session.remove()
+
+    samples, errors, seconds = run(
+        make_session, args.users, args.requests, args.concurrency,
+        seed=args.seed
+    )
+    result = report.build(samples, seconds, vars(args), errors)
+    report.save(result, args.out)
+    for name, summary in sorted(result['operations'].items()):
+        print(f"{name:<10} n={summary['count']:<6} p50={summary['p50']}ms "
+              f"p95={summary['p95']}ms p99={summary['p99']}ms")
+    print(f"overall throughput {result['overall']['throughput']} req/s, "
+          f"errors {errors or 'none'}, saved to {args.out}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,150 @@
+# -*- coding: utf-8 -*-
+#!/usr/bin/env python
+"""Login throughput and latency at several password work factors.
+
+For each ``--iterations`` value every synthetic user's password is rehashed
+with that work factor, then ``--concurrency`` clients log in and out as
+fast as they can while one more client keeps reading its home timeline, so
+the cost of hashing to everybody else shows up too::
+
+    python -m benchmarks.login --iterations 50000 150000 300000 \\
+        --workers 2 --concurrency 8 --out login.json
+
+Use it to pick ``PASSWORD_ITERATIONS`` and ``PASSWORD_WORKERS``: the highest
+work factor whose login p95 and timeline p95 are still acceptable at the
+expected peak login rate.
+"""
+from app import app, db, passwords
+from app.models import User
+from benchmarks import datagen, report
+from benchmarks.load import TestClientSession, VirtualUser
+from typing import List, Tuple
+import argparse
+import config
+import random
+import threading
+import time
+
+
+def run(iterations: int, user_count: int, logins: int,
+        concurrency: int=4, seed: int=0) -> Tuple[dict, dict, float]:
+    """Log in logins times at a work factor, timing timeline reads alongside.
+
+    Returns latency samples for ``login`` and ``timeline``, error counts
+    (a login answered with anything but a redirect is an error) and the
+    wall time of the login phase.
+    """
+    passwords.shutdown()
+    passwords.iterations = iterations
+    with app.app_context():
+        User.query.update(
+            {'password': passwords.hash(datagen.PASSWORD)},
+            synchronize_session=False
+        )
+        db.session.commit()
+        db.session.remove()
+
+    samples = {'login': [], 'timeline': []}
+    errors = {}
+    lock = threading.Lock()
+    done = threading.Event()
+
+    def record(name: str, started: float, ok: bool) -> None:
+        with lock:
+            samples[name].append((time.perf_counter() - started) * 1000)
+            if not ok:
+                errors[name] = errors.get(name, 0) + 1
+
+    def login_worker(index: int, quota: int) -> None:
+        rng = random.Random(seed * 1000 + index)
+        session = TestClientSession()
+        for _ in range(quota):
+            user = VirtualUser(
+                session, rng.randint(1, user_count), user_count, rng
+            )
+            started = time.perf_counter()
+            record('login', started, user.login() == 302)
+            session.get('/logout')
+
+    def timeline_worker() -> None:
+        rng = random.Random(seed)
+        user = VirtualUser(TestClientSession(), 1, user_count, rng)
+        user.login()
+        while not done.is_set():
+            started = time.perf_counter()
+            record('timeline', started, user.timeline() == 200)
+
+    quotas = [logins // concurrency] * concurrency
+    quotas[0] += logins - sum(quotas)
+    reader = threading.Thread(target=timeline_worker)
+    reader.start()
+    threads = [
+        threading.Thread(target=login_worker, args=(i, quota))
+        for i, quota in enumerate(quotas)
+    ]
+    started = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    seconds = time.perf_counter() - started
+    done.set()
+    reader.join()
+    return samples, errors, seconds
+
+
+def sweep(work_factors: List[int], user_count: int, logins: int,
+          concurrency: int, seed: int=0) -> dict:
+    """Run every work factor; return a report with one entry per factor."""
+    samples, errors, total = {}, {}, 0.0
+    for iterations in work_factors:
+        found, failed, seconds = run(
+            iterations, user_count, logins, concurrency, seed
+        )
+        total += seconds
+        for name, values in found.items():
+            samples[f'{name}@{iterations}'] = values
+        for name, count in failed.items():
+            errors[f'{name}@{iterations}'] = count
+        print(f"{iterations:>8} iterations: "
+              f"{len(found['login']) / seconds:.1f} logins/s, "
+              f"{report.summarize(found['login'], seconds)['p95']}ms login "
+              f"p95, {report.summarize(found['timeline'], seconds)['p95']}"
+              f"ms timeline p95")
+    return report.build(samples, total, {
+        'work_factors': work_factors,
+        'workers': passwords.workers,
+        'concurrency': concurrency,
+        'logins': logins,
+    }, errors)
+
+
+def main() -> None:
+    """Load users, sweep the work factors and save a report."""
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--database', default=config.BENCHMARK_DATABASE_URI)
+    parser.add_argument('--iterations', type=int, nargs='+',
+                        default=[50000, 150000, 300000])
+    parser.add_argument('--workers', type=int, default=passwords.workers)
+    parser.add_argument('--users', type=int, default=1000)
+    parser.add_argument('--posts', type=int, default=20000)
+    parser.add_argument('--logins', type=int, default=200)
+    parser.add_argument('--concurrency', type=int, default=4)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--out', default='login_bench.json')
+    args = parser.parse_args()
+
+    app.config['SQLALCHEMY_DATABASE_URI'] = args.database
+    passwords.workers = args.workers
+    with app.app_context():
+        datagen.load(args.users, args.posts, seed=args.seed)
+        db.session.remove()
+    result = sweep(
+        args.iterations, args.users, args.logins, args.concurrency, args.seed
+    )
+    report.save(result, args.out)
+    print(f'saved to {args.out}')
+
+
+if __name__ == '__main__':
+    main()
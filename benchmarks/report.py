@@ -0,0 +1,98 @@
+# -*- coding: utf-8 -*-
+#!/usr/bin/env python
+"""Latency summaries saved as JSON so runs can be compared across commits.
+
+    python -m benchmarks.report before.json after.json
+"""
+from datetime import datetime
+from typing import Dict, List
+import json
+import subprocess
+import sys
+
+
+def percentile(ordered: List[float], fraction: float) -> float:
+    """The value below which fraction of the sorted samples fall."""
+    if not ordered:
+        return 0.0
+    index = min(len(ordered) - 1, max(0, int(round(fraction * len(ordered))) - 1))
+    return ordered[index]
+
+
+def summarize(samples: List[float], seconds: float) -> dict:
+    """Count, throughput and p50/p95/p99/max of millisecond samples."""
+    ordered = sorted(samples)
+    return {
+        'count': len(ordered),
+        'throughput': round(len(ordered) / seconds, 2) if seconds else 0.0,
+        'p50': round(percentile(ordered, 0.50), 3),
+        'p95': round(percentile(ordered, 0.95), 3),
+        'p99': round(percentile(ordered, 0.99), 3),
+        'max': round(ordered[-1], 3) if ordered else 0.0,
+    }
+
+
+def git_commit() -> str:
+    """The commit being measured, or None outside a checkout."""
+    try:
+        return subprocess.check_output(
+            ['git', 'rev-parse', '--short', 'HEAD'],
+            stderr=subprocess.DEVNULL
+        ).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def build(samples: Dict[str, List[float]], seconds: float,
+          settings: dict, errors: Dict[str, int]=None) -> dict:
+    """A full report: per-operation summaries plus run metadata."""
+    everything = [ms for values in samples.values() for ms in values]
+    return {
+        'commit': git_commit(),
+        'created': datetime.utcnow().isoformat(),
+        'seconds': round(seconds, 3),
+        'settings': settings,
+        'errors': errors or {},
+        'overall': summarize(everything, seconds),
+        'operations': {
+            name: summarize(values, seconds)
+            for name, values in sorted(samples.items())
+        },
+    }
+
+
+def save(report: dict, path: str) -> None:
+    """Write a report as indented JSON."""
+    with open(path, 'w') as output:
+        json.dump(report, output, indent=2, sort_keys=True)
+
+
+def compare(before: dict, after: dict) -> str:
+    """A table of p50/p95/p99 and throughput changes between two reports."""
+    lines = [
+        f"{'operation':<12} {'metric':<10} {before.get('commit') or 'before':>10}"
+        f" {after.get('commit') or 'after':>10} {'change':>8}"
+    ]
+    names = sorted(set(before['operations']) | set(after['operations']))
+    for name in ['overall'] + names:
+        old = before['overall'] if name == 'overall' else \
+            before['operations'].get(name)
+        new = after['overall'] if name == 'overall' else \
+            after['operations'].get(name)
+        if not old or not new:
+            continue
+        for metric in ('p50', 'p95', 'p99', 'throughput'):
+            change = (
+                f'{(new[metric] - old[metric]) / old[metric] * 100:+.1f}%'
+                if old[metric] else 'n/a'
+            )
+            lines.append(
+                f'{name:<12} {metric:<10} {old[metric]:>10} '
+                f'{new[metric]:>10} {change:>8}'
+            )
+    return '\n'.join(lines)
+
+
+if __name__ == '__main__':
+    with open(sys.argv[1]) as first, open(sys.argv[2]) as second:
+        print(compare(json.load(first), json.load(second)))
@@ -0,0 +1,183 @@
+# -*- coding: utf-8 -*-
+#!/usr/bin/env python
+"""Cold start time of the app and memory per serve.py worker.
+
+Each cold start is a fresh interpreter, timed from launch to exit, doing
+one of: ``import app`` (what scripts and job workers pay), ``create_app()``
+(views and API registered) or ``create_app(warm=True)`` (templates compiled
+and a database connection tried, as serve.py's master does). Then serve.py
+is started with and without ``--no-preload``, timed until it answers, sent
+a few requests and its workers' memory read from /proc::
+
+    python -m benchmarks.startup --runs 5 --workers 4 --out startup.json
+
+RSS counts every page a worker touches, shared or not; PSS splits shared
+pages between the processes sharing them, so a preloaded app that stays
+shared copy-on-write shows up as a lower PSS per worker.
+"""
+from benchmarks import report
+from typing import Dict, List, Tuple
+import argparse
+import config
+import os
+import signal
+import socket
+import subprocess
+import sys
+import time
+import urllib.error
+import urllib.request
+
+
+COLD_STARTS = {
+    'import': 'import app',
+    'create_app': 'from app import create_app; create_app()',
+    'warm': 'from app import create_app; create_app(warm=True)',
+}
+
+
+def cold_start(code: str) -> float:
+    """Milliseconds for a fresh interpreter to run code and exit."""
+    started = time.perf_counter()
+    subprocess.run(
+        [sys.executable, '-W', 'ignore', '-c', code], cwd=config.BASE_DIR,
+        check=True, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL
+    )
+    return (time.perf_counter() - started) * 1000
+
+
+def free_port() -> int:
+    """A local TCP port nothing is listening on right now."""
+    with socket.socket() as probe:
+        probe.bind(('127.0.0.1', 0))
+        return probe.getsockname()[1]
+
+
+def get(url: str) -> int:
+    """The status of a GET, or 0 if nothing answered."""
+    try:
+        with urllib.request.urlopen(url, timeout=5) as response:
+            return response.status
+    except urllib.error.HTTPError as error:
+        return error.code
+    except OSError:
+        return 0
+
+
+def children(pid: int) -> List[int]:
+    """The pids whose parent is pid."""
+    found = []
+    for name in os.listdir('/proc'):
+        if not name.isdigit():
+            continue
+        try:
+            with open(f'/proc/{name}/stat') as stat:
+                fields = stat.read().rsplit(')', 1)[1].split()
+        except OSError:
+            continue
+        if int(fields[1]) == pid:
+            found.append(int(name))
+    return found
+
+
+def memory(pid: int) -> Dict[str, int]:
+    """A process's RSS and, where the kernel reports it, PSS in kB."""
+    sizes = {'rss': None, 'pss': None}
+    for path, key, field in ((f'/proc/{pid}/status', 'rss', 'VmRSS:'),
+                             (f'/proc/{pid}/smaps_rollup', 'pss', 'Pss:')):
+        try:
+            with open(path) as lines:
+                for line in lines:
+                    if line.startswith(field):
+                        sizes[key] = int(line.split()[1])
+                        break
+        except OSError:
+            pass
+    return sizes
+
+
+def serve(preload: bool, workers: int, threads: int,
+          requests: int) -> Tuple[float, List[dict]]:
+    """Start serve.py; return ms until it answered and its workers' memory."""
+    port = free_port()
+    url = f'http://127.0.0.1:{port}/login'
+    command = [
+        sys.executable, '-W', 'ignore',
+        os.path.join(config.BASE_DIR, 'serve.py'),
+        '--bind', f'127.0.0.1:{port}', '--workers', str(workers),
+        '--threads', str(threads),
+    ] + ([] if preload else ['--no-preload'])
+    started = time.perf_counter()
+    master = subprocess.Popen(
+        command, cwd=config.BASE_DIR,
+        stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL
+    )
+    try:
+        while get(url) != 200:
+            if master.poll() is not None:
+                raise RuntimeError(f'serve.py exited with {master.returncode}')
+            time.sleep(0.01)
+        answered = (time.perf_counter() - started) * 1000
+        deadline = time.monotonic() + 60
+        while len(children(master.pid)) < workers:
+            if time.monotonic() > deadline:
+                raise RuntimeError('workers did not start')
+            time.sleep(0.05)
+        for _ in range(requests):
+            get(url)
+        return answered, [memory(pid) for pid in children(master.pid)]
+    finally:
+        master.send_signal(signal.SIGTERM)
+        master.wait()
+
+
+def run(runs: int, workers: int, threads: int, requests: int) -> dict:
+    """Time every cold start and both serve modes runs times; a report."""
+    samples = {name: [] for name in COLD_STARTS}
+    workers_memory = {}
+    total = 0.0
+    for name, code in COLD_STARTS.items():
+        for _ in range(runs):
+            samples[name].append(cold_start(code))
+        total += sum(samples[name]) / 1000
+        print(f'{name:>18}: {min(samples[name]):8.1f}ms best of {runs}')
+    for preload in (True, False):
+        name = 'serve' if preload else 'serve_no_preload'
+        samples[name] = []
+        for _ in range(runs):
+            answered, found = serve(preload, workers, threads, requests)
+            samples[name].append(answered)
+            workers_memory[name] = found
+        total += sum(samples[name]) / 1000
+        rss = [sizes['rss'] or 0 for sizes in workers_memory[name]]
+        pss = [sizes['pss'] or 0 for sizes in workers_memory[name]]
+        print(f'{name:>18}: {min(samples[name]):8.1f}ms to first response, '
+              f'{sum(rss) / len(rss) / 1024:.1f}MB RSS and '
+              f'{sum(pss) / len(pss) / 1024:.1f}MB PSS per worker')
+    result = report.build(samples, total, {
+        'runs': runs,
+        'workers': workers,
+        'threads': threads,
+        'requests': requests,
+    })
+    result['memory_kb'] = workers_memory
+    return result
+
+
+def main() -> None:
+    """Measure cold starts and serve.py workers and save a report."""
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--runs', type=int, default=5)
+    parser.add_argument('--workers', type=int, default=4)
+    parser.add_argument('--threads', type=int, default=config.SERVER_THREADS)
+    parser.add_argument('--requests', type=int, default=20)
+    parser.add_argument('--out', default='startup_bench.json')
+    args = parser.parse_args()
+
+    result = run(args.runs, args.workers, args.threads, args.requests)
+    report.save(result, args.out)
+    print(f'saved to {args.out}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,166 @@
+# -*- coding: utf-8 -*-
+#!/usr/bin/env python
+"""First-request latency and timeline render time of the templates.
+
+Each first request is a fresh process that logs in and times its first two
+home timeline requests, with templates compiled in memory only, into an
+empty bytecode cache, or loaded from one filled by templates_compile.py.
+Then the 50-post home timeline list is rendered repeatedly in this
+process, with every post row rendered and with the rows coming from the
+fragment cache::
+
+    python -m benchmarks.templates --runs 5 --renders 200 --out tpl.json
+
+The database named by ``--database`` (``BENCHMARK_DATABASE_URI`` by default)
+is dropped and recreated, so never point it at real data.
+"""
+from app import app, create_app, db, fragments, timelines
+from app.models import User
+from benchmarks import datagen, report
+from flask import render_template
+from typing import Dict, List
+import argparse
+import config
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+
+TIMELINE_POSTS = 50
+
+
+def first_requests(database: str) -> None:
+    """Log in as user1, then print the ms taken by two timeline requests."""
+    app.config['SQLALCHEMY_DATABASE_URI'] = database
+    app.config['WTF_CSRF_ENABLED'] = False
+    client = create_app().test_client()
+    client.post('/login', data={
+        'username': 'user1', 'password': datagen.PASSWORD
+    })
+    timings = []
+    for _ in range(2):
+        started = time.perf_counter()
+        status = client.get('/').status_code
+        timings.append((time.perf_counter() - started) * 1000)
+        if status != 200:
+            sys.exit(f'home timeline answered {status}')
+    print(json.dumps(timings))
+
+
+def fresh_process(database: str, cache_dir: str) -> List[float]:
+    """First and second request ms of a new process using cache_dir."""
+    output = subprocess.run(
+        [sys.executable, '-W', 'ignore', '-m', 'benchmarks.templates',
+         '--database', database, '--first-requests'],
+        env=dict(os.environ, TEMPLATE_CACHE_DIR=cache_dir),
+        check=True, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL
+    ).stdout
+    return json.loads(output.decode().splitlines()[-1])
+
+
+def startup(database: str, runs: int) -> Dict[str, List[float]]:
+    """First and second request samples for each way of caching templates."""
+    samples = {}
+    precompiled = tempfile.mkdtemp()
+    subprocess.run(
+        [sys.executable, '-W', 'ignore',
+         os.path.join(config.BASE_DIR, 'templates_compile.py')],
+        env=dict(os.environ, TEMPLATE_CACHE_DIR=precompiled),
+        check=True, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL
+    )
+    for mode in ('memory', 'empty_cache', 'precompiled'):
+        first, second = [], []
+        for _ in range(runs):
+            if mode == 'memory':
+                cache_dir = ''
+            elif mode == 'empty_cache':
+                cache_dir = tempfile.mkdtemp()
+            else:
+                cache_dir = precompiled
+            timings = fresh_process(database, cache_dir)
+            first.append(timings[0])
+            second.append(timings[1])
+            if mode == 'empty_cache':
+                shutil.rmtree(cache_dir)
+        samples[f'first_request@{mode}'] = first
+        samples[f'second_request@{mode}'] = second
+        print(f'{mode:>12}: {min(first):7.1f}ms first request, '
+              f'{min(second):7.1f}ms second, best of {runs}')
+    shutil.rmtree(precompiled)
+    return samples
+
+
+def timeline_renders(renders: int) -> Dict[str, List[float]]:
+    """Render times of user1's 50-post timeline list, rows cached or not."""
+    samples = {}
+    enabled = fragments.enabled
+    with app.test_request_context('/'):
+        user = User.query.get(1)
+        posts = timelines.page(user, None, TIMELINE_POSTS)
+        if len(posts.items) < TIMELINE_POSTS:
+            print(f'only {len(posts.items)} posts on the timeline; '
+                  f'load more with --posts')
+        for name, cached in (('timeline_50', False),
+                             ('timeline_50_cached_rows', True)):
+            fragments.enabled = cached
+            fragments.clear()
+            render_template(
+                'post_list.html', posts=posts, endpoint='index',
+                endpoint_args={}
+            )
+            samples[name] = []
+            for _ in range(renders):
+                started = time.perf_counter()
+                render_template(
+                    'post_list.html', posts=posts, endpoint='index',
+                    endpoint_args={}
+                )
+                samples[name].append((time.perf_counter() - started) * 1000)
+            print(f'{name:>24}: {min(samples[name]):.3f}ms best, '
+                  f'{report.summarize(samples[name], 1)["p50"]}ms p50')
+        db.session.remove()
+    fragments.enabled = enabled
+    return samples
+
+
+def main() -> None:
+    """Seed, time first requests and timeline renders, save a report."""
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--database', default=config.BENCHMARK_DATABASE_URI)
+    parser.add_argument('--users', type=int, default=200)
+    parser.add_argument('--posts', type=int, default=10000)
+    parser.add_argument('--runs', type=int, default=5)
+    parser.add_argument('--renders', type=int, default=200)
+    parser.add_argument('--out', default='templates_bench.json')
+    parser.add_argument('--first-requests', action='store_true',
+                        help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.first_requests:
+        first_requests(args.database)
+        return
+
+    app.config['SQLALCHEMY_DATABASE_URI'] = args.database
+    create_app()
+    with app.app_context():
+        datagen.load(args.users, args.posts)
+        db.session.remove()
+    started = time.perf_counter()
+    samples = startup(args.database, args.runs)
+    samples.update(timeline_renders(args.renders))
+    result = report.build(samples, time.perf_counter() - started, {
+        'users': args.users,
+        'posts': args.posts,
+        'runs': args.runs,
+        'renders': args.renders,
+    })
+    report.save(result, args.out)
+    print(f'saved to {args.out}')
+
+
+if __name__ == '__main__':
+    main()
@@ -24,6 +24,177 @@ if DATABASE_USER:
 SQLALCHEMY_DATABASE_URI += f'{DATABASE_HOST}:{DATABASE_PORT}/{DATABASE_NAME}'
 SQLALCHEMY_MIGRATE_REPO = os.path.join(BASE_DIR, 'db_repository')
 
-TEST_DATABASE_URI = f'postgresql://{DATABASE_HOST}:{DATABASE_PORT}/test_db'
+# Online migrations (db_migrate.py). Backfills update MIGRATION_CHUNK_SIZE rows
+# per transaction and sleep MIGRATION_THROTTLE seconds between chunks; DDL
+# waits at most MIGRATION_LOCK_TIMEOUT seconds for its locks on Postgres.
+MIGRATIONS_DIR = os.path.join(BASE_DIR, 'migrations')
+MIGRATION_CHUNK_SIZE = 1000
+MIGRATION_THROTTLE = 0.05
+MIGRATION_LOCK_TIMEOUT = 5
+MIGRATION_LOCK_RETRIES = 5
+
+# Connection pool. Recycle and pre-ping guard against connections the server
+# or a proxy dropped while idle; the statement timeout is in milliseconds.
+DATABASE_POOL_SIZE = int(os.environ.get('DATABASE_POOL_SIZE', '10'))
+DATABASE_MAX_OVERFLOW = int(os.environ.get('DATABASE_MAX_OVERFLOW', '20'))
+DATABASE_POOL_TIMEOUT = int(os.environ.get('DATABASE_POOL_TIMEOUT', '10'))
+DATABASE_POOL_RECYCLE = int(os.environ.get('DATABASE_POOL_RECYCLE', '1800'))
+DATABASE_POOL_PRE_PING = os.environ.get('DATABASE_POOL_PRE_PING', '1') == '1'
+DATABASE_STATEMENT_TIMEOUT = int(
+    os.environ.get('DATABASE_STATEMENT_TIMEOUT', '30000')
+)
+
+SQLALCHEMY_POOL_SIZE = DATABASE_POOL_SIZE
+SQLALCHEMY_MAX_OVERFLOW = DATABASE_MAX_OVERFLOW
+SQLALCHEMY_POOL_TIMEOUT = DATABASE_POOL_TIMEOUT
+SQLALCHEMY_POOL_RECYCLE = DATABASE_POOL_RECYCLE
+
+# Read replicas, as a comma-separated list of URIs. GET requests read from a
+# healthy one unless the user committed a write in the last
+# REPLICA_STICKY_SECONDS; replicas lagging more than REPLICA_MAX_LAG seconds
+# are skipped. Each is rechecked every REPLICA_CHECK_INTERVAL seconds, and
+# connecting to one gives up after REPLICA_CONNECT_TIMEOUT seconds.
+DATABASE_REPLICA_URIS = [
+    uri for uri in os.environ.get('DATABASE_REPLICA_URIS', '').split(',')
+    if uri
+]
+SQLALCHEMY_BINDS = {
+    f'replica{number}': uri
+    for number, uri in enumerate(DATABASE_REPLICA_URIS)
+}
+REPLICA_MAX_LAG = 5.0
+REPLICA_CHECK_INTERVAL = 5.0
+REPLICA_STICKY_SECONDS = 10
+REPLICA_CONNECT_TIMEOUT = 2
+
+# Post shards, as a comma-separated list of URIs; none keeps posts on the
+# primary. An author's posts live on the shard owning bucket
+# user_id % POST_SHARD_BUCKETS. POST_SHARD_MAP assigns bucket ranges to
+# shards, e.g. {'shard0': [[0, 511]], 'shard1': [[512, 1023]]}; None splits
+# the buckets evenly in shard order. Change it only alongside
+# db_rebalance.py. Timelines query up to POST_SHARD_WORKERS shards at once.
+POST_SHARD_URIS = [
+    uri for uri in os.environ.get('POST_SHARD_URIS', '').split(',') if uri
+]
+SQLALCHEMY_BINDS.update({
+    f'shard{number}': uri for number, uri in enumerate(POST_SHARD_URIS)
+})
+POST_SHARD_BUCKETS = 1024
+POST_SHARD_MAP = None
+POST_SHARD_WORKERS = 4
+
+# Pool stats are logged this often (seconds). /internal/pool and
+# /internal/replicas answer only requests sending INTERNAL_TOKEN in an
+# X-Internal-Token header, and are turned off while it is unset.
+POOL_STATS_LOG_INTERVAL = 300
+INTERNAL_TOKEN = os.environ.get('INTERNAL_TOKEN', '')
+
+# serve.py: where to listen, how many worker processes to fork and how
+# many requests each answers at once. Workers stopped or reloaded get
+# SERVER_GRACEFUL_TIMEOUT seconds to finish what they are serving.
+SERVER_BIND = os.environ.get('SERVER_BIND', '127.0.0.1:8000')
+SERVER_WORKERS = int(
+    os.environ.get('SERVER_WORKERS', str(os.cpu_count() or 1))
+)
+SERVER_THREADS = int(os.environ.get('SERVER_THREADS', '4'))
+SERVER_GRACEFUL_TIMEOUT = 30
+
+TEST_DATABASE_URI = os.environ.get(
+    'TEST_DATABASE_URI',
+    f'postgresql://{DATABASE_HOST}:{DATABASE_PORT}/test_db'
+)
+BENCHMARK_DATABASE_URI = os.environ.get(
+    'BENCHMARK_DATABASE_URI',
+    f'postgresql://{DATABASE_HOST}:{DATABASE_PORT}/benchmark_db'
+)
 
 POSTS_PER_PAGE = 3
+
+# The home page polls for new posts this often (seconds); one poll returns
+# at most NEW_POSTS_LIMIT posts and counts at most NEW_POSTS_COUNT_CAP.
+NEW_POSTS_POLL_SECONDS = 30
+NEW_POSTS_LIMIT = 50
+NEW_POSTS_COUNT_CAP = 100
+
+# JSON API page sizes; exports are read from the database this many at a time.
+API_PAGE_SIZE = 20
+API_MAX_PAGE_SIZE = 100
+API_EXPORT_CHUNK = 1000
+
+# The logged-in user's id and username are trusted from the signed session
+# for this many seconds before being re-read from the database.
+IDENTITY_TTL = 300
+
+# PBKDF2 password hashes. Raising PASSWORD_ITERATIONS rehashes each password
+# at its owner's next login. At most PASSWORD_WORKERS hashes run at once, and
+# logins beyond PASSWORD_MAX_PENDING waiting ones are answered with a 503.
+PASSWORD_DIGEST = 'sha256'
+PASSWORD_ITERATIONS = int(os.environ.get('PASSWORD_ITERATIONS', '150000'))
+PASSWORD_SALT_LENGTH = 16
+PASSWORD_WORKERS = int(os.environ.get('PASSWORD_WORKERS', '2'))
+PASSWORD_MAX_PENDING = 64
+PASSWORD_TIMEOUT = 10
+
+# last_seen is buffered in memory and written in batches; a buffered value is
+# flushed at most LAST_SEEN_STALENESS seconds after it was recorded.
+LAST_SEEN_STALENESS = 60
+LAST_SEEN_BATCH_SIZE = 500
+
+# Fan-out-on-write home timelines. Authors with more than
+# TIMELINE_FANOUT_LIMIT followers are merged in at read time instead. Only
+# the sqlite backend is shared by every process on the host, so only with it
+# are new posts fanned out by background jobs; the memory backend keeps
+# fan-out in the request that wrote the post.
+TIMELINE_ENABLED = os.environ.get('TIMELINE_ENABLED', '') == '1'
+TIMELINE_BACKEND = os.environ.get('TIMELINE_BACKEND', 'memory')
+TIMELINE_SQLITE_PATH = os.path.join(BASE_DIR, 'tmp', 'timelines.db')
+TIMELINE_MAX_LENGTH = 800
+TIMELINE_FANOUT_LIMIT = 10000
+
+# Background jobs. Web processes run JOBS_LOCAL_WORKERS threads; set it to
+# 0 when worker.py processes drain the queue instead. Failed jobs are retried
+# after JOBS_RETRY_DELAY * 2**(attempt - 1) seconds, JOBS_MAX_ATTEMPTS times.
+JOBS_LOCAL_WORKERS = int(os.environ.get('JOBS_LOCAL_WORKERS', '2'))
+JOBS_BATCH_SIZE = 100
+JOBS_MAX_ATTEMPTS = 5
+JOBS_RETRY_DELAY = 2
+JOBS_LEASE = 300
+JOBS_POLL_INTERVAL = 1.0
+
+# Most users accepted by one bulk /follow or /unfollow request.
+FOLLOW_BULK_LIMIT = 10000
+
+# Followed/follower id sets cached per process, least recently used first out.
+FOLLOW_CACHE_SIZE = 10000
+FOLLOW_CACHE_TTL = 30
+
+# Full-text search. Indexed post changes are written in one commit per batch.
+WHOOSH_BASE = os.path.join(BASE_DIR, 'search.db')
+SEARCH_COMMIT_LIMIT = 100
+SEARCH_COMMIT_PERIOD = 5
+
+# Per-request SQL/template profiling, reported in a Server-Timing header.
+# Requests slower than PROFILER_SLOW_REQUEST_MS are written to the log.
+PROFILER_ENABLED = os.environ.get('PROFILER_ENABLED', '') == '1'
+PROFILER_SLOW_REQUEST_MS = 500
+PROFILER_SLOWEST_STATEMENTS = 5
+
+# Rendered post rows, kept per process or shared through memcached. Whole
+# post lists are cached too when FRAGMENT_PAGE_CACHE is on, each for at most
+# FRAGMENT_PAGE_TTL seconds.
+FRAGMENT_CACHE_ENABLED = os.environ.get('FRAGMENT_CACHE_ENABLED', '1') == '1'
+FRAGMENT_CACHE_BACKEND = os.environ.get('FRAGMENT_CACHE_BACKEND', 'memory')
+FRAGMENT_CACHE_SERVERS = os.environ.get(
+    'FRAGMENT_CACHE_SERVERS', '127.0.0.1:11211'
+).split(',')
+FRAGMENT_CACHE_MAX_BYTES = 32 * 1024 * 1024
+FRAGMENT_PAGE_CACHE = os.environ.get('FRAGMENT_PAGE_CACHE', '') == '1'
+FRAGMENT_PAGE_TTL = 60
+
+# Compiled templates, kept on disk so a new worker or a restart loads them
+# instead of parsing every template again; set it empty to compile in memory
+# only. templates_compile.py creates and fills it at deploy time, as does a
+# server warming the app; until then templates are compiled in memory.
+TEMPLATE_CACHE_DIR = os.environ.get(
+    'TEMPLATE_CACHE_DIR', os.path.join(BASE_DIR, 'template_cache')
+)
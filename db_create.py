@@ -1,18 +1,13 @@
 # -*- coding: utf-8 -*-
 #!/usr/bin/env python
-from migrate.versioning import api
-from config import SQLALCHEMY_DATABASE_URI, SQLALCHEMY_MIGRATE_REPO
-from app import db
-import os
+from app import db, shards
+from app.migrator import Migrator
 
 
+fresh = not db.engine.dialect.has_table(db.engine, 'user')
 db.create_all()
-if not os.path.exists(SQLALCHEMY_MIGRATE_REPO):
-    api.create(SQLALCHEMY_MIGRATE_REPO, 'database repository')
-    api.version_control(SQLALCHEMY_DATABASE_URI, SQLALCHEMY_MIGRATE_REPO)
-else:
-    api.version_control(
-        SQLALCHEMY_DATABASE_URI,
-        SQLALCHEMY_MIGRATE_REPO,
-        api.version(SQLALCHEMY_MIGRATE_REPO)
-    )
+shards.create_all()
+if fresh:
+    # the models already describe the migrated schema, so an empty database
+    # records every migration as applied instead of running them
+    Migrator().mark_applied()
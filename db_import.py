@@ -0,0 +1,142 @@
+# -*- coding: utf-8 -*-
+#!/usr/bin/env python
+"""Stream users, posts or follows from CSV or JSON Lines into the database.
+
+    python db_import.py users users.csv
+    python db_import.py posts posts.jsonl
+    python db_import.py follows follows.csv 5000
+
+Columns: users take ``username``, ``password`` (hashed on the way in unless
+it already is a ``pbkdf2:`` hash) and optionally ``about_me``; posts take
+``username``, ``title``, ``body`` and optionally an ISO 8601 ``timestamp``,
+and go to their author's shard when posts are sharded; follows take
+``follower`` and ``followed`` usernames.
+
+Rows are inserted a chunk at a time, one commit per chunk, and rows that
+already exist are skipped, so an interrupted import can simply be rerun.
+The follower/following/post counters are reconciled once at the end.
+"""
+from app import db, passwords, search_index, shards
+from app.bulk import insert_ignore, user_ids
+from app.models import User, Post, followers
+from datetime import datetime
+from db_reconcile import reconcile_counters
+from itertools import islice
+from typing import Iterable, Iterator, List
+import csv
+import json
+import sys
+
+
+def read_rows(path: str) -> Iterator[dict]:
+    """Rows of a .jsonl/.ndjson file, or of a CSV file with a header."""
+    with open(path, newline='') as source:
+        if path.endswith(('.jsonl', '.ndjson')):
+            for line in source:
+                if line.strip():
+                    yield json.loads(line)
+        else:
+            yield from csv.DictReader(source)
+
+
+def chunked(rows: Iterable[dict], size: int) -> Iterator[List[dict]]:
+    """Lists of up to size rows."""
+    rows = iter(rows)
+    while True:
+        chunk = list(islice(rows, size))
+        if not chunk:
+            return
+        yield chunk
+
+
+def parse_timestamp(value: str) -> datetime:
+    """An ISO 8601 timestamp, with or without fractional seconds."""
+    if not value:
+        return datetime.utcnow()
+    for layout in ('%Y-%m-%dT%H:%M:%S.%f', '%Y-%m-%dT%H:%M:%S'):
+        try:
+            return datetime.strptime(value, layout)
+        except ValueError:
+            pass
+    raise ValueError(f'bad timestamp {value!r}')
+
+
+def import_users(chunk: List[dict]) -> int:
+    """Insert new users, each following themselves like registration does."""
+    stored = [row['password'] for row in chunk]
+    plain = [i for i, value in enumerate(stored)
+             if not passwords.is_hashed(value)]
+    for i, value in zip(plain, passwords.hash_many(stored[i] for i in plain)):
+        stored[i] = value
+    insert_ignore(User.__table__, [{
+        'username': row['username'],
+        'password': password,
+        'about_me': row.get('about_me') or None,
+    } for row, password in zip(chunk, stored)])
+    ids = user_ids(row['username'] for row in chunk).values()
+    insert_ignore(followers, [
+        {'follower_id': i, 'followed_id': i} for i in ids
+    ])
+    return len(chunk)
+
+
+def import_posts(chunk: List[dict]) -> int:
+    """Insert posts by known authors and queue them for search indexing."""
+    authors = user_ids(row['username'] for row in chunk)
+    rows = [{
+        'title': row['title'],
+        'body': row.get('body') or '',
+        'timestamp': parse_timestamp(row.get('timestamp')),
+        'user_id': authors[row['username']],
+    } for row in chunk if row['username'] in authors]
+    if not rows:
+        return 0
+    if shards.enabled:
+        search_index.add(shards.add_posts(rows))
+        return len(rows)
+    insert_ignore(Post.__table__, rows)
+    db.session.commit()
+    search_index.add(db.session.query(Post.id, Post.title, Post.body).filter(
+        Post.title.in_([row['title'] for row in rows])
+    ))
+    return len(rows)
+
+
+def import_follows(chunk: List[dict]) -> int:
+    """Insert follow edges between known users."""
+    ids = user_ids(
+        name for row in chunk for name in (row['follower'], row['followed'])
+    )
+    rows = [{
+        'follower_id': ids[row['follower']],
+        'followed_id': ids[row['followed']],
+    } for row in chunk if row['follower'] in ids and row['followed'] in ids]
+    insert_ignore(followers, rows)
+    return len(rows)
+
+
+IMPORTERS = {
+    'users': import_users,
+    'posts': import_posts,
+    'follows': import_follows,
+}
+
+
+def run(kind: str, path: str, size: int=1000) -> int:
+    """Import a file chunk by chunk; return how many rows were accepted."""
+    importer = IMPORTERS[kind]
+    total = 0
+    for chunk in chunked(read_rows(path), size):
+        total += importer(chunk)
+        db.session.commit()
+    reconcile_counters()
+    search_index.flush()
+    return total
+
+
+if __name__ == '__main__':
+    if len(sys.argv) < 3 or sys.argv[1] not in IMPORTERS:
+        sys.exit(__doc__)
+    size = int(sys.argv[3]) if len(sys.argv) > 3 else 1000
+    kind, path = sys.argv[1:3]
+    print('Imported %d %s' % (run(kind, path, size), kind))
@@ -1,26 +1,86 @@
 # -*- coding: utf-8 -*-
 #!/usr/bin/env python
+"""Apply online schema migrations from migrations/NNN_name.py.
 
+    python db_migrate.py                  # run everything pending
+    python db_migrate.py --dry-run        # list pending steps and row counts
+    python db_migrate.py --target 3 --chunk-size 500 --throttle 0.2
+    python db_migrate.py status
+    python db_migrate.py new add_post_language
 
-import imp
-from migrate.versioning import api
+Indexes are built concurrently and backfills run in small throttled
+chunks, so migrations can run against the live database. Progress is
+saved as it goes; rerunning after an interruption carries on from there.
+
+A database still versioned by the old sqlalchemy-migrate repository in
+db_repository/ is brought up to its last version first.
+"""
 from app import db
+from app.migrator import Migrator
 from config import SQLALCHEMY_DATABASE_URI, SQLALCHEMY_MIGRATE_REPO
+import argparse
+import os
+
+
+TEMPLATE = '''"""{doc}"""
+from app.migrator import Backfill, CreateIndex, SQL
+
+
+steps = [
+]
+'''
+
+
+def upgrade_legacy() -> None:
+    """Run outstanding sqlalchemy-migrate scripts on databases that use it."""
+    if not db.engine.dialect.has_table(db.engine, 'migrate_version'):
+        return
+    from migrate.versioning import api
+    current = api.db_version(SQLALCHEMY_DATABASE_URI, SQLALCHEMY_MIGRATE_REPO)
+    if current < api.version(SQLALCHEMY_MIGRATE_REPO):
+        print(f'Upgrading from legacy repository version {current}')
+        api.upgrade(SQLALCHEMY_DATABASE_URI, SQLALCHEMY_MIGRATE_REPO)
+
+
+def new(migrator: Migrator, name: str) -> str:
+    """Write an empty migration after the latest one; return its path."""
+    latest = max([m.version for m in migrator.migrations()] or [0])
+    path = os.path.join(
+        migrator.directory, '%03d_%s.py' % (latest + 1, name)
+    )
+    with open(path, 'x') as script:
+        script.write(TEMPLATE.format(doc=name.replace('_', ' ').capitalize()))
+    return path
+
+
+def main() -> None:
+    """Parse the command line and run the requested command."""
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('command', nargs='?', default='upgrade',
+                        choices=['upgrade', 'status', 'new'])
+    parser.add_argument('name', nargs='?', help='name of a new migration')
+    parser.add_argument('--dry-run', action='store_true')
+    parser.add_argument('--target', type=int)
+    parser.add_argument('--chunk-size', type=int)
+    parser.add_argument('--throttle', type=float)
+    args = parser.parse_args()
+
+    migrator = Migrator(chunk_size=args.chunk_size, throttle=args.throttle)
+    if args.command == 'new':
+        if not args.name:
+            parser.error('new needs a migration name')
+        print('New migration saved as ' + new(migrator, args.name))
+    elif args.command == 'status':
+        for migration, done in migrator.status():
+            print(f'{migration.version:03d} {migration.name}: '
+                  f'{done}/{len(migration.steps)} steps done')
+    else:
+        if not args.dry_run:
+            upgrade_legacy()
+        applied = migrator.upgrade(args.target, args.dry_run)
+        verb = 'Would apply' if args.dry_run else 'Applied'
+        print(f'{verb} {len(applied)} migration(s)')
 
 
-v = api.db_version(SQLALCHEMY_DATABASE_URI, SQLALCHEMY_MIGRATE_REPO)
-migration = SQLALCHEMY_MIGRATE_REPO + ('/versions/%03d_migration.py' % (v + 1))
-tmp_module = imp.new_module('old_model')
-old_model = api.create_model(SQLALCHEMY_DATABASE_URI, SQLALCHEMY_MIGRATE_REPO)
-exec(old_model, tmp_module.__dict__)
-script = api.make_update_script_for_model(
-    SQLALCHEMY_DATABASE_URI,
-    SQLALCHEMY_MIGRATE_REPO,
-    tmp_module.meta,
-    db.metadata
-)
-open(migration, 'wt').write(script)
-api.upgrade(SQLALCHEMY_DATABASE_URI, SQLALCHEMY_MIGRATE_REPO)
-v = api.db_version(SQLALCHEMY_DATABASE_URI, SQLALCHEMY_MIGRATE_REPO)
-print('New migration saved as ' + migration)
-print('Current database version: ' + str(v))
+if __name__ == '__main__':
+    main()
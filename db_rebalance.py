@@ -0,0 +1,89 @@
+# -*- coding: utf-8 -*-
+#!/usr/bin/env python
+"""Move post buckets from one shard to another while the site is up.
+
+    python db_rebalance.py status
+    python db_rebalance.py copy 512 1023 shard0 shard1 --batch 500
+    python db_rebalance.py purge 512 1023 shard0 --throttle 0.1
+
+To move buckets 512..1023 from shard0 to shard1:
+
+1. ``copy`` them; shard0 keeps taking new posts meanwhile.
+2. Point those buckets at shard1 in ``POST_SHARD_MAP`` and restart.
+3. ``copy`` again to pick up posts written to shard0 before the restart.
+4. ``purge`` them from shard0, which refuses while shard0 still owns them.
+
+Step 2 is the write fence: purge only once every process that writes
+posts (web workers, job workers, scripts) runs with the new map, so none
+of them can still add posts in those buckets to shard0. ``purge`` copies
+each batch to shard1 again and deletes only the posts it reads back from
+there, but a post written to shard0 after purge has passed its id would
+be left behind on shard0 and hidden from the site.
+
+Both commands stream rows in id order, a batch per transaction, and can
+be stopped and rerun at any point.
+"""
+from app import shards
+import argparse
+
+
+def status() -> None:
+    """Print each shard's post count and bucket ranges."""
+    counts = shards.counts()
+    for name in shards.names:
+        ranges, start = [], None
+        for bucket, owner in enumerate(shards.owners + [None]):
+            if owner == name and start is None:
+                start = bucket
+            elif owner != name and start is not None:
+                ranges.append(f'{start}..{bucket - 1}')
+                start = None
+        print(f"{name}: {counts[name]} posts, buckets {', '.join(ranges)}")
+
+
+def main() -> None:
+    """Parse the command line and run the requested command."""
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('command', choices=['status', 'copy', 'purge'])
+    parser.add_argument('first', type=int, nargs='?')
+    parser.add_argument('last', type=int, nargs='?')
+    parser.add_argument('source', nargs='?')
+    parser.add_argument('target', nargs='?')
+    parser.add_argument('--batch', type=int, default=1000)
+    parser.add_argument('--throttle', type=float, default=0.0)
+    parser.add_argument('--dry-run', action='store_true')
+    args = parser.parse_args()
+
+    if not shards.enabled:
+        parser.error('no post shards are configured')
+    if args.command == 'status':
+        status()
+        return
+    if None in (args.first, args.last, args.source) or (
+            args.command == 'copy' and args.target is None):
+        parser.error(f'{args.command} needs a bucket range and shard names')
+    for name in filter(None, (args.source, args.target)):
+        if name not in shards.names:
+            parser.error(f'unknown shard {name}')
+    if args.dry_run:
+        count = shards.count_buckets(args.first, args.last, args.source)
+        print(f'Would {args.command} {count} posts from {args.source}')
+    elif args.command == 'copy':
+        shards.create_all()
+        count = shards.copy_buckets(
+            args.first, args.last, args.source, args.target,
+            args.batch, args.throttle
+        )
+        print(f'Copied {count} posts to {args.target}')
+    else:
+        try:
+            count = shards.purge_buckets(
+                args.first, args.last, args.source, args.batch, args.throttle
+            )
+        except ValueError as error:
+            parser.error(str(error))
+        print(f'Purged {count} posts from {args.source}')
+
+
+if __name__ == '__main__':
+    main()
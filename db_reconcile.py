@@ -0,0 +1,61 @@
+# -*- coding: utf-8 -*-
+#!/usr/bin/env python
+"""Recompute the denormalized follower/following/post counters on User."""
+from app import db, shards
+from app.models import User, Post, followers
+from sqlalchemy import bindparam, func, or_, select
+
+
+def reconcile_counters() -> int:
+    """Repair every drifted counter; return how many rows were updated.
+
+    The counters are fixed with one UPDATE. With sharded posts that UPDATE
+    leaves post_count alone; the shards are counted instead and only the
+    users whose count drifted are written, so a user with both kinds of
+    drift counts twice.
+    """
+    follower_count = select([func.count()]).where(
+        followers.c.followed_id == User.id
+    ).as_scalar()
+    following_count = select([func.count()]).where(
+        followers.c.follower_id == User.id
+    ).as_scalar()
+    post_count = select([func.count()]).where(
+        Post.user_id == User.id
+    ).as_scalar()
+    values = {
+        'follower_count': follower_count,
+        'following_count': following_count,
+        'post_count': post_count,
+    }
+    if shards.enabled:
+        del values['post_count']
+    statement = User.__table__.update().where(or_(*(
+        getattr(User, name).is_distinct_from(value)
+        for name, value in values.items()
+    ))).values(**values)
+    with db.engine.begin() as connection:
+        fixed = connection.execute(statement).rowcount
+    if shards.enabled:
+        fixed += reconcile_post_counts(shards.post_counts())
+    return fixed
+
+
+def reconcile_post_counts(counts: dict) -> int:
+    """Set post_count from per-author counts where it differs."""
+    with db.engine.begin() as connection:
+        drifted = [
+            {'_id': user_id, 'post_count': counts.get(user_id, 0)}
+            for user_id, stored in connection.execute(
+                select([User.id, User.post_count])
+            ) if stored != counts.get(user_id, 0)
+        ]
+        if drifted:
+            connection.execute(User.__table__.update().where(
+                User.id == bindparam('_id')
+            ).values(post_count=bindparam('post_count')), drifted)
+    return len(drifted)
+
+
+if __name__ == '__main__':
+    print('Repaired counters on %d users' % reconcile_counters())
@@ -0,0 +1,71 @@
+from sqlalchemy import *
+from migrate import *
+
+
+from migrate.changeset import schema
+from migrate.changeset.constraint import PrimaryKeyConstraint
+pre_meta = MetaData()
+post_meta = MetaData()
+followers = Table('followers', post_meta,
+    Column('follower_id', Integer, primary_key=True, nullable=False),
+    Column('followed_id', Integer, primary_key=True, nullable=False),
+)
+post = Table('post', post_meta,
+    Column('id', Integer, primary_key=True, nullable=False),
+    Column('title', Unicode),
+    Column('body', Unicode),
+    Column('timestamp', DateTime),
+    Column('user_id', Integer),
+)
+
+
+def upgrade(migrate_engine):
+    # Upgrade operations go here. Don't create your own engine; bind
+    # migrate_engine to your metadata
+    pre_meta.bind = migrate_engine
+    post_meta.bind = migrate_engine
+    # Duplicate and half-empty follow rows would block the primary key.
+    migrate_engine.execute(
+        'DELETE FROM followers '
+        'WHERE follower_id IS NULL OR followed_id IS NULL'
+    )
+    migrate_engine.execute(
+        'DELETE FROM followers a USING followers b '
+        'WHERE a.ctid < b.ctid '
+        'AND a.follower_id = b.follower_id '
+        'AND a.followed_id = b.followed_id'
+    )
+    followers = post_meta.tables['followers']
+    PrimaryKeyConstraint(
+        followers.c.follower_id, followers.c.followed_id,
+        name='followers_pkey', table=followers
+    ).create()
+    Index(
+        'ix_followers_followed_id_follower_id',
+        followers.c.followed_id, followers.c.follower_id
+    ).create()
+    post = post_meta.tables['post']
+    Index(
+        'ix_post_user_id_timestamp',
+        post.c.user_id, post.c.timestamp.desc(), post.c.id.desc()
+    ).create()
+
+
+def downgrade(migrate_engine):
+    # Operations to reverse the above upgrade go here.
+    pre_meta.bind = migrate_engine
+    post_meta.bind = migrate_engine
+    post = post_meta.tables['post']
+    Index(
+        'ix_post_user_id_timestamp',
+        post.c.user_id, post.c.timestamp.desc(), post.c.id.desc()
+    ).drop()
+    followers = post_meta.tables['followers']
+    Index(
+        'ix_followers_followed_id_follower_id',
+        followers.c.followed_id, followers.c.follower_id
+    ).drop()
+    PrimaryKeyConstraint(
+        followers.c.follower_id, followers.c.followed_id,
+        name='followers_pkey', table=followers
+    ).drop()
@@ -0,0 +1,46 @@
+from sqlalchemy import *
+from migrate import *
+
+
+from migrate.changeset import schema
+pre_meta = MetaData()
+post_meta = MetaData()
+user = Table('user', post_meta,
+    Column('id', Integer, primary_key=True, nullable=False),
+    Column('username', Unicode(length=80)),
+    Column('password', Unicode),
+    Column('about_me', Unicode),
+    Column('last_seen', DateTime),
+    Column('follower_count', Integer, server_default='0'),
+    Column('following_count', Integer, server_default='0'),
+    Column('post_count', Integer, server_default='0'),
+)
+
+
+def upgrade(migrate_engine):
+    # Upgrade operations go here. Don't create your own engine; bind
+    # migrate_engine to your metadata
+    pre_meta.bind = migrate_engine
+    post_meta.bind = migrate_engine
+    post_meta.tables['user'].columns['follower_count'].create()
+    post_meta.tables['user'].columns['following_count'].create()
+    post_meta.tables['user'].columns['post_count'].create()
+    # Existing users start from the real counts; db_reconcile.py repairs drift.
+    migrate_engine.execute(
+        'UPDATE "user" SET '
+        'follower_count = (SELECT count(*) FROM followers '
+        'WHERE followers.followed_id = "user".id), '
+        'following_count = (SELECT count(*) FROM followers '
+        'WHERE followers.follower_id = "user".id), '
+        'post_count = (SELECT count(*) FROM post '
+        'WHERE post.user_id = "user".id)'
+    )
+
+
+def downgrade(migrate_engine):
+    # Operations to reverse the above upgrade go here.
+    pre_meta.bind = migrate_engine
+    post_meta.bind = migrate_engine
+    post_meta.tables['user'].columns['follower_count'].drop()
+    post_meta.tables['user'].columns['following_count'].drop()
+    post_meta.tables['user'].columns['post_count'].drop()
@@ -0,0 +1,33 @@
+from sqlalchemy import *
+from migrate import *
+
+
+from migrate.changeset import schema
+pre_meta = MetaData()
+post_meta = MetaData()
+job = Table('job', post_meta,
+    Column('id', Integer, primary_key=True, nullable=False),
+    Column('kind', Unicode(length=80), nullable=False),
+    Column('payload', Unicode, nullable=False),
+    Column('state', Unicode(length=16), nullable=False),
+    Column('attempts', Integer, nullable=False),
+    Column('run_at', DateTime, nullable=False),
+    Column('locked_at', DateTime),
+    Column('last_error', Unicode),
+)
+Index('ix_job_state_run_at', job.c.state, job.c.run_at)
+
+
+def upgrade(migrate_engine):
+    # Upgrade operations go here. Don't create your own engine; bind
+    # migrate_engine to your metadata
+    pre_meta.bind = migrate_engine
+    post_meta.bind = migrate_engine
+    post_meta.tables['job'].create()
+
+
+def downgrade(migrate_engine):
+    # Operations to reverse the above upgrade go here.
+    pre_meta.bind = migrate_engine
+    post_meta.bind = migrate_engine
+    post_meta.tables['job'].drop()
@@ -0,0 +1,23 @@
+"""Hash passwords still stored in plain text by accounts that never log in.
+
+Active accounts are rehashed at login; this catches the dormant ones. The
+chunks are small because every row costs a full password hash.
+"""
+from app import passwords
+from app.migrator import Backfill
+
+
+def hash_passwords(rows: list) -> list:
+    """New hashes for (id, password) rows."""
+    return [
+        {'password': hashed}
+        for hashed in passwords.hash_many(row[1] for row in rows)
+    ]
+
+
+steps = [
+    Backfill(
+        'user', "password IS NOT NULL AND password NOT LIKE 'pbkdf2:%'",
+        compute=hash_passwords, columns=['password'], chunk_size=100
+    ),
+]
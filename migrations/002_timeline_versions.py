@@ -0,0 +1,14 @@
+"""Add the version counters home page ETags are built from.
+
+Both default to 0, which Postgres 11+ and SQLite add without rewriting
+the table.
+"""
+from app.migrator import SQL
+
+
+steps = [
+    SQL('ALTER TABLE "user" ADD COLUMN follows_version INTEGER '
+        'NOT NULL DEFAULT 0'),
+    SQL('ALTER TABLE "user" ADD COLUMN profile_version INTEGER '
+        'NOT NULL DEFAULT 0'),
+]
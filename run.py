@@ -1,3 +1,3 @@
 #!flask/bin/python
-from app import app
-app.run(debug=True)
+from app import create_app
+create_app().run(debug=True)
@@ -0,0 +1,153 @@
+# -*- coding: utf-8 -*-
+#!/usr/bin/env python
+"""Run tests.py in parallel processes, each with a database of its own.
+
+    python run_tests.py                  # one worker per CPU
+    python run_tests.py -j 4 --slowest 20
+    python run_tests.py follow search    # tests whose names contain either
+
+Worker n uses TEST_DATABASE_URI with ``_n`` appended to the database name
+(created if missing on Postgres, a separate file on SQLite), so workers
+never see each other's rows. Failures are printed with their tracebacks,
+followed by the slowest tests.
+"""
+import argparse
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import time
+import unittest
+
+
+class TimedResult(unittest.TextTestResult):
+    """A test result that also records how long each test took."""
+
+    def __init__(self, *args, **kwargs) -> None:
+        """Start with no timings."""
+        super(TimedResult, self).__init__(*args, **kwargs)
+        self.timings = {}
+        self._started = None
+
+    def startTest(self, test) -> None:
+        """Note when a test starts."""
+        self._started = time.perf_counter()
+        super(TimedResult, self).startTest(test)
+
+    def stopTest(self, test) -> None:
+        """Record how long a test took, setUp and tearDown included."""
+        super(TimedResult, self).stopTest(test)
+        self.timings[test.id()] = time.perf_counter() - self._started
+
+
+def test_names(patterns: list) -> list:
+    """Names of the TestCase methods matching any pattern, or all of them."""
+    import tests
+    names = unittest.defaultTestLoader.getTestCaseNames(tests.TestCase)
+    return [
+        name for name in names
+        if not patterns or any(pattern in name for pattern in patterns)
+    ]
+
+
+def work(names: list, report: str) -> None:
+    """Run some tests in this process and write their results as JSON."""
+    suite = unittest.defaultTestLoader.loadTestsFromNames(
+        [f'tests.TestCase.{name}' for name in names]
+    )
+    with open(os.devnull, 'w') as stream:
+        result = TimedResult(stream, descriptions=False, verbosity=0)
+        suite.run(result)
+    with open(report, 'w') as out:
+        json.dump({
+            'run': result.testsRun,
+            'skipped': len(result.skipped),
+            'failures': [
+                [test.id(), trace]
+                for test, trace in result.failures + result.errors
+            ],
+            'timings': result.timings,
+        }, out)
+
+
+def run(names: list, workers: int) -> dict:
+    """Spread tests over worker processes; return their combined results.
+
+    Tests are dealt out in turn, so slow neighbours in the file end up in
+    different workers.
+    """
+    directory = tempfile.mkdtemp()
+    processes = []
+    for number in range(min(workers, len(names))):
+        report = os.path.join(directory, f'{number + 1}.json')
+        log = open(os.path.join(directory, f'{number + 1}.log'), 'w+')
+        command = [
+            sys.executable, os.path.abspath(__file__), '--report', report
+        ] + names[number::workers]
+        env = dict(os.environ, TEST_WORKER=str(number + 1))
+        processes.append((number + 1, subprocess.Popen(
+            command, env=env, stdout=log, stderr=subprocess.STDOUT
+        ), report, log))
+
+    combined = {'run': 0, 'skipped': 0, 'failures': [], 'timings': {}}
+    for number, process, report, log in processes:
+        process.wait()
+        if not os.path.exists(report):
+            log.seek(0)
+            combined['failures'].append([f'worker {number}', log.read()])
+        else:
+            with open(report) as results:
+                found = json.load(results)
+            for key in ('run', 'skipped'):
+                combined[key] += found[key]
+            combined['failures'] += found['failures']
+            combined['timings'].update(found['timings'])
+            os.remove(report)
+        log.close()
+        os.remove(log.name)
+    os.rmdir(directory)
+    return combined
+
+
+def main() -> None:
+    """Parse the command line, run the tests and print a summary."""
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('patterns', nargs='*')
+    parser.add_argument('-j', '--workers', type=int,
+                        default=os.cpu_count() or 1)
+    parser.add_argument('--slowest', type=int, default=10)
+    parser.add_argument('--report', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.report:
+        work(args.patterns, args.report)
+        return
+
+    started = time.perf_counter()
+    results = run(test_names(args.patterns), args.workers)
+    seconds = time.perf_counter() - started
+    for name, trace in results['failures']:
+        print('=' * 70)
+        print(f'FAIL: {name}')
+        print('-' * 70)
+        print(trace)
+
+    timings = sorted(
+        results['timings'].items(), key=lambda item: item[1], reverse=True
+    )
+    if timings and args.slowest:
+        print(f'Slowest {min(args.slowest, len(timings))} tests:')
+        for name, took in timings[:args.slowest]:
+            print(f'  {took * 1000:8.1f}ms  {name.rsplit(".", 1)[-1]}')
+    print(f"Ran {results['run']} tests in {seconds:.2f}s on {args.workers} "
+          f"workers ({sum(results['timings'].values()):.2f}s of test time, "
+          f"{results['skipped']} skipped)")
+    if results['failures']:
+        print(f"FAILED ({len(results['failures'])} failed)")
+        sys.exit(1)
+    print('OK')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,31 @@
+# -*- coding: utf-8 -*-
+#!/usr/bin/env python
+"""Rebuild the full-text search index from every post in the database."""
+from app import db, search_index, shards
+from app.models import Post
+import sys
+
+
+def post_chunks(size: int=5000):
+    """Stream (id, title, body) rows in id order, size rows at a time.
+
+    Sharded posts are streamed one shard after another.
+    """
+    if shards.enabled:
+        yield from shards.scan(size)
+        return
+    last_id = 0
+    while True:
+        chunk = db.session.query(Post.id, Post.title, Post.body).filter(
+            Post.id > last_id
+        ).order_by(Post.id).limit(size).all()
+        if not chunk:
+            return
+        yield chunk
+        last_id = chunk[-1].id
+        db.session.expunge_all()
+
+
+if __name__ == '__main__':
+    size = int(sys.argv[1]) if len(sys.argv) > 1 else 5000
+    print('Indexed %d posts' % search_index.reindex(post_chunks(size)))
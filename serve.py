@@ -0,0 +1,299 @@
+#!flask/bin/python
+"""Serve the app from preforked worker processes.
+
+    python serve.py                       # SERVER_* settings from config
+    python serve.py --bind 0.0.0.0:8000 --workers 4 --threads 8
+
+The master imports and warms the app (views, templates, the search query
+parser), opens the listening socket and then forks the workers, which
+start in milliseconds and share the loaded code copy-on-write. Each
+worker fills its own connection pool and answers requests on a fixed
+pool of threads, and only accepts a connection when a thread is free,
+so a busy worker leaves new ones to the others. With --no-preload every
+worker imports the app itself after the fork instead.
+
+Signals to the master:
+
+    HUP         start a new master and workers on the current code; once
+                they are up the old master lets its workers finish what
+                they are serving and exits. If the new code fails to
+                load, the old master and workers carry on.
+    TERM, INT   stop accepting, finish in-flight requests and exit
+    TTIN, TTOU  run one worker more, or one fewer
+
+Workers that die are replaced.
+"""
+from concurrent.futures import ThreadPoolExecutor
+from werkzeug.serving import BaseWSGIServer
+import argparse
+import config
+import os
+import signal
+import socket
+import sys
+import threading
+import time
+import traceback
+
+
+# how a reloading master hands its socket to its successor, and tells it
+# which master to stop once its own workers are running
+LISTEN_FD = 'SERVE_LISTEN_FD'
+REPLACES = 'SERVE_REPLACES_PID'
+
+
+def load():
+    """The app, imported, warmed and ready to fork."""
+    from app import create_app
+    return create_app(warm=True)
+
+
+class PooledServer(BaseWSGIServer):
+    """Werkzeug's WSGI server, answering requests on a fixed thread pool."""
+
+    multithread = True
+    multiprocess = True
+
+    def __init__(self, app, listener: socket.socket, threads: int) -> None:
+        """Serve app on an already listening socket."""
+        host, port = listener.getsockname()[:2]
+        super(PooledServer, self).__init__(
+            host, port, app, fd=listener.fileno()
+        )
+        self.slots = threading.BoundedSemaphore(threads)
+        self.pool = ThreadPoolExecutor(threads, thread_name_prefix='request')
+
+    def get_request(self):
+        """Accept a connection once a thread is free to answer it."""
+        self.slots.acquire()
+        try:
+            return super(PooledServer, self).get_request()
+        except OSError:
+            self.slots.release()
+            raise
+
+    def process_request(self, request, client_address) -> None:
+        """Hand the connection to the thread pool."""
+        self.pool.submit(self.process_in_thread, request, client_address)
+
+    def process_in_thread(self, request, client_address) -> None:
+        """Answer one connection, then free its thread's slot."""
+        try:
+            self.finish_request(request, client_address)
+        except Exception:
+            self.handle_error(request, client_address)
+        finally:
+            self.shutdown_request(request)
+            self.slots.release()
+
+
+def work(app, listener: socket.socket, threads: int) -> int:
+    """Serve in a forked worker until told to stop; return its exit code."""
+    for signum in (signal.SIGHUP, signal.SIGINT, signal.SIGTTIN,
+                   signal.SIGTTOU):
+        signal.signal(signum, signal.SIG_IGN)
+    # until it is serving, a worker has nothing to finish when stopped
+    signal.signal(signal.SIGTERM, signal.SIG_DFL)
+    if app is None:
+        app = load()
+    from app import db, jobs, last_seen_tracker, search_index
+
+    pool_size = app.config.get('SQLALCHEMY_POOL_SIZE') or 5
+    with app.app_context():
+        connections = [
+            db.engine.connect() for _ in range(min(threads, pool_size))
+        ]
+        for connection in connections:
+            connection.close()
+
+    server = PooledServer(app, listener, threads)
+    signal.signal(signal.SIGTERM, lambda signum, frame: threading.Thread(
+        target=server.shutdown
+    ).start())
+    app.logger.info('worker %d serving with %d threads', os.getpid(), threads)
+    server.serve_forever()
+    server.pool.shutdown(wait=True)
+    # a forked worker leaves with os._exit, so run what atexit would have
+    jobs.stop()
+    last_seen_tracker.flush_on_shutdown()
+    search_index.close()
+    return 0
+
+
+class Master(object):
+    """Keeps the configured number of workers running on one socket."""
+
+    def __init__(self, listener: socket.socket, workers: int, threads: int,
+                 graceful_timeout: float, preload: bool) -> None:
+        """Prepare to fork workers; nothing starts until run()."""
+        self.listener = listener
+        self.workers = workers
+        self.threads = threads
+        self.graceful_timeout = graceful_timeout
+        self.app = load() if preload else None
+        self.children = set()
+        self.retiring = {}
+        self.signals = []
+        self.successor = None
+
+    def run(self) -> int:
+        """Fork the workers and look after them until stopped."""
+        for signum in (signal.SIGHUP, signal.SIGTERM, signal.SIGINT,
+                       signal.SIGTTIN, signal.SIGTTOU):
+            signal.signal(signum, self.queue_signal)
+        for _ in range(self.workers):
+            self.spawn()
+        replaces = os.environ.pop(REPLACES, None)
+        if replaces:
+            try:
+                os.kill(int(replaces), signal.SIGTERM)
+            except ProcessLookupError:
+                pass
+        while True:
+            self.reap()
+            while self.signals:
+                signum = self.signals.pop(0)
+                if signum in (signal.SIGTERM, signal.SIGINT):
+                    return self.stop()
+                if signum == signal.SIGHUP:
+                    self.reload()
+                elif signum == signal.SIGTTIN:
+                    self.workers += 1
+                elif signum == signal.SIGTTOU and self.workers > 1:
+                    self.workers -= 1
+                    self.retire([max(self.children)])
+            while len(self.children) < self.workers:
+                self.spawn()
+            self.kill_overdue()
+            time.sleep(0.2)
+
+    def queue_signal(self, signum: int, frame) -> None:
+        """Note a signal for the main loop."""
+        self.signals.append(signum)
+
+    def spawn(self) -> None:
+        """Fork one worker."""
+        pid = os.fork()
+        if pid:
+            self.children.add(pid)
+            return
+        code = 1
+        try:
+            code = work(self.app, self.listener, self.threads)
+        except BaseException:
+            traceback.print_exc()
+        finally:
+            os._exit(code)
+
+    def reap(self) -> None:
+        """Collect exited workers; unexpected exits are replaced later."""
+        while True:
+            try:
+                pid, status = os.waitpid(-1, os.WNOHANG)
+            except ChildProcessError:
+                return
+            if not pid:
+                return
+            if pid == self.successor:
+                print(f'new master {pid} exited with status {status}; '
+                      'still serving the old code', file=sys.stderr)
+                self.successor = None
+            elif pid in self.children and status:
+                print(f'worker {pid} exited with status {status}',
+                      file=sys.stderr)
+            self.children.discard(pid)
+            self.retiring.pop(pid, None)
+
+    def retire(self, pids) -> None:
+        """Ask workers to finish their requests and exit."""
+        deadline = time.monotonic() + self.graceful_timeout
+        for pid in pids:
+            self.children.discard(pid)
+            self.retiring[pid] = deadline
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except ProcessLookupError:
+                self.retiring.pop(pid)
+
+    def kill_overdue(self) -> None:
+        """Kill retiring workers still busy after the graceful timeout."""
+        now = time.monotonic()
+        for pid, deadline in list(self.retiring.items()):
+            if now >= deadline:
+                try:
+                    os.kill(pid, signal.SIGKILL)
+                except ProcessLookupError:
+                    self.retiring.pop(pid)
+
+    def reload(self) -> None:
+        """Start a new master on the same socket to take over from this one.
+
+        The new master is a forked child re-executing this script, so it
+        loads the code as it is now. It sends this master TERM once its
+        own workers are started, and this one then stops gracefully. Until
+        then nothing here changes: if the new code fails to load, the
+        child just exits and this master goes on serving.
+        """
+        if self.successor is not None:
+            return
+        fd = self.listener.fileno()
+        os.set_inheritable(fd, True)
+        pid = os.fork()
+        if pid:
+            self.successor = pid
+            return
+        try:
+            os.environ[LISTEN_FD] = str(fd)
+            os.environ[REPLACES] = str(os.getppid())
+            os.execv(sys.executable, [sys.executable] + sys.argv)
+        finally:
+            os._exit(1)
+
+    def stop(self) -> int:
+        """Stop every worker gracefully, killing stragglers; return 0."""
+        self.retire(list(self.children))
+        while self.retiring:
+            self.reap()
+            self.kill_overdue()
+            time.sleep(0.1)
+        return 0
+
+
+def listen(bind: str) -> socket.socket:
+    """The listening socket: inherited on reload, else bound to host:port."""
+    if LISTEN_FD in os.environ:
+        listener = socket.socket(fileno=int(os.environ.pop(LISTEN_FD)))
+    else:
+        host, port = bind.rsplit(':', 1)
+        listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        listener.bind((host, int(port)))
+        listener.listen(socket.SOMAXCONN)
+    # workers race to accept; the losers must not block in accept()
+    listener.setblocking(False)
+    return listener
+
+
+def main() -> None:
+    """Parse the command line and serve until stopped."""
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--bind', default=config.SERVER_BIND)
+    parser.add_argument('--workers', type=int, default=config.SERVER_WORKERS)
+    parser.add_argument('--threads', type=int, default=config.SERVER_THREADS)
+    parser.add_argument('--graceful-timeout', type=float,
+                        default=config.SERVER_GRACEFUL_TIMEOUT)
+    parser.add_argument('--no-preload', dest='preload', action='store_false')
+    args = parser.parse_args()
+
+    listener = listen(args.bind)
+    master = Master(
+        listener, args.workers, args.threads, args.graceful_timeout,
+        args.preload
+    )
+    print(f'master {os.getpid()} listening on {args.bind} with '
+          f'{args.workers} workers x {args.threads} threads', flush=True)
+    sys.exit(master.run())
+
+
+if __name__ == '__main__':
+    main()
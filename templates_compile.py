@@ -0,0 +1,38 @@
+# -*- coding: utf-8 -*-
+#!/usr/bin/env python
+"""Compile every template into TEMPLATE_CACHE_DIR before workers start.
+
+    python templates_compile.py            # at deploy time, before serve.py
+    python templates_compile.py --clear    # drop entries of old templates too
+
+Workers, reloads and restarts then load compiled templates from the cache
+instead of parsing them on their first requests. Entries are keyed by the
+template source, so an edited template is never served from a stale one.
+"""
+from app import app, compile_templates, use_bytecode_cache
+import argparse
+import sys
+import time
+
+
+def main() -> None:
+    """Fill the bytecode cache and say how long it took."""
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--clear', action='store_true')
+    args = parser.parse_args()
+
+    use_bytecode_cache(app, create=True)
+    cache = app.jinja_env.bytecode_cache
+    if cache is None:
+        sys.exit('TEMPLATE_CACHE_DIR is not set; nothing to compile into')
+    if args.clear:
+        cache.clear()
+    started = time.perf_counter()
+    names = compile_templates(app)
+    print(f'compiled {len(names)} templates into '
+          f"{app.config['TEMPLATE_CACHE_DIR']} in "
+          f'{(time.perf_counter() - started) * 1000:.0f}ms')
+
+
+if __name__ == '__main__':
+    main()
@@ -1,13 +1,210 @@
 # -*- coding: utf-8 -*-
 #!flask/bin/python
-from app import app, models, db
+from app import (
+    app, compile_templates, create_app, models, db, follow_graph, fragments,
+    jobs, last_seen_tracker, passwords, replicas, search_index, shards,
+    timelines
+)
+from app.fragments import MemoryBackend
+from app.templating import AtomicBytecodeCache, use_bytecode_cache
 from bs4 import BeautifulSoup as Soup
 import config
+from contextlib import contextmanager
 from datetime import datetime, timedelta
+import json
 import os
+import shutil
+import tempfile
+import threading
+import time
 import unittest
+from unittest import mock
+from sqlalchemy import create_engine, event
+from sqlalchemy.engine import Engine
+from sqlalchemy.engine.url import make_url
 
 
+def worker_database_uri(uri: str, worker: str) -> str:
+    """The database of one parallel worker: test_db_1, test_1.db, ..."""
+    url = make_url(uri)
+    if url.drivername.startswith('sqlite'):
+        root, extension = os.path.splitext(url.database)
+        url.database = f'{root}_{worker}{extension}'
+    else:
+        url.database = f'{url.database}_{worker}'
+    return str(url)
+
+
+def create_database(uri: str) -> None:
+    """Create a Postgres database if it is missing; SQLite needs nothing."""
+    url = make_url(uri)
+    if url.drivername.startswith('sqlite'):
+        return
+    name, url.database = url.database, 'postgres'
+    engine = create_engine(url, isolation_level='AUTOCOMMIT')
+    with engine.connect() as connection:
+        exists = connection.execute(
+            'SELECT 1 FROM pg_database WHERE datname = %s', name
+        ).scalar()
+        if not exists:
+            connection.execute(f'CREATE DATABASE "{name}"')
+    engine.dispose()
+
+
+class DatabaseFixture(object):
+    """Runs each test in a transaction that is rolled back afterwards.
+
+    The schema is created once per process. Every test then gets a fresh
+    transaction on one shared connection, and the scoped session is bound
+    to that connection inside a savepoint that is reopened whenever the
+    code under test commits or rolls back. Ending the test throws it all
+    away without any DDL.
+
+    Tests marked ``committed`` need their writes to be really committed:
+    they use other connections or threads, or copy the database file.
+    They run against the engine as before and have every table emptied
+    after, so one that changes the schema must undo that itself.
+    """
+
+    # dialect methods replaced while the fixture runs
+    SAVEPOINT_HOOKS = (
+        'do_savepoint', 'do_release_savepoint', 'do_rollback_to_savepoint'
+    )
+
+    def __init__(self) -> None:
+        """A fixture not yet connected."""
+        self.connection = None
+        self.transaction = None
+        self._createfunc = None
+        self._hooks = {}
+
+    def start(self) -> None:
+        """Create the schema and open the connection tests run on."""
+        dialect = db.engine.dialect
+        self._hooks = {
+            name: vars(dialect).get(name) for name in self.SAVEPOINT_HOOKS
+        }
+        # savepoints go straight to the driver, so statement counts seen by
+        # tests and the profiler are the same as outside the fixture
+        dialect.do_savepoint = lambda connection, name: self._raw(
+            connection, f'SAVEPOINT {name}'
+        )
+        dialect.do_release_savepoint = lambda connection, name: self._raw(
+            connection, f'RELEASE SAVEPOINT {name}'
+        )
+        dialect.do_rollback_to_savepoint = lambda connection, name: \
+            self._raw(connection, f'ROLLBACK TO SAVEPOINT {name}')
+        db.drop_all()
+        db.create_all()
+        self.connection = db.engine.connect()
+        if dialect.name == 'sqlite':
+            # pysqlite's own transaction handling ignores SAVEPOINT
+            self.connection.connection.connection.isolation_level = None
+        self._createfunc = db.session.registry.createfunc
+        db.session.registry.createfunc = self._session
+        event.listen(db.session, 'after_transaction_end', self._reopen)
+
+    def stop(self) -> None:
+        """Close the connection, drop the schema and restore the dialect."""
+        event.remove(db.session, 'after_transaction_end', self._reopen)
+        db.session.registry.createfunc = self._createfunc
+        self.connection.close()
+        db.drop_all()
+        dialect = db.engine.dialect
+        for name, hook in self._hooks.items():
+            if hook is None:
+                delattr(dialect, name)
+            else:
+                setattr(dialect, name, hook)
+
+    def begin(self, committed: bool=False) -> None:
+        """Start a test, in a transaction unless it needs real commits."""
+        db.session.remove()
+        factory = db.session.session_factory
+        if committed:
+            factory.kw.pop('bind', None)
+            factory.kw.pop('binds', None)
+        else:
+            factory.configure(bind=self.connection, binds={})
+            self.transaction = self.connection.begin()
+            if self.connection.dialect.name == 'sqlite':
+                self._raw(self.connection, 'BEGIN')
+
+    def end(self, committed: bool=False) -> None:
+        """Throw away whatever the test wrote."""
+        db.session.remove()
+        if committed:
+            self._empty_tables()
+        else:
+            self.transaction.rollback()
+            self.transaction = None
+
+    @staticmethod
+    def _empty_tables() -> None:
+        """Delete every row a committed test left, keeping the schema."""
+        tables = db.metadata.sorted_tables
+        with db.engine.begin() as connection:
+            if connection.dialect.name == 'postgresql':
+                names = ', '.join(f'"{table.name}"' for table in tables)
+                connection.execute(
+                    f'TRUNCATE {names} RESTART IDENTITY CASCADE'
+                )
+            else:
+                for table in reversed(tables):
+                    connection.execute(table.delete())
+
+    @staticmethod
+    def _raw(connection, statement: str) -> None:
+        """Run a transaction control statement without statement events."""
+        connection.connection.cursor().execute(statement)
+
+    def _session(self):
+        """A new scoped session, inside a savepoint when transactional."""
+        session = self._createfunc()
+        if self.transaction is not None:
+            session.begin_nested()
+        return session
+
+    def _reopen(self, session, transaction) -> None:
+        """Open a new savepoint once the test's code has ended the last."""
+        if (self.transaction is not None and transaction.nested and
+                not transaction._parent.nested and
+                transaction._parent.is_active):
+            session.expire_all()
+            session.begin_nested()
+
+
+fixture = DatabaseFixture()
+
+
+def committed(test):
+    """Run a test with real commits instead of inside a transaction."""
+    test.committed = True
+    return test
+
+
+def setUpModule() -> None:
+    """Point the app at this process's test database and create it.
+
+    Compiled templates go to a temporary directory, not the checkout's.
+    """
+    uri = config.TEST_DATABASE_URI
+    worker = os.environ.get('TEST_WORKER')
+    if worker:
+        uri = worker_database_uri(uri, worker)
+        create_database(uri)
+    app.config['TESTING'] = True
+    app.config['SQLALCHEMY_DATABASE_URI'] = uri
+    app.config['TEMPLATE_CACHE_DIR'] = tempfile.mkdtemp()
+    use_bytecode_cache(app)
+    create_app()
+    fixture.start()
+
+
+def tearDownModule() -> None:
+    """."""
+    fixture.stop()
+    shutil.rmtree(app.config['TEMPLATE_CACHE_DIR'])
 
 
 class TestCase(unittest.TestCase):
@@ -15,19 +212,36 @@ class TestCase(unittest.TestCase):
 
     def setUp(self) -> None:
         """."""
-        app.config['TESTING'] = True
-        app.config['SQLALCHEMY_DATABASE_URI'] = config.TEST_DATABASE_URI
-        db.create_all()
+        self.committed = getattr(
+            getattr(self, self._testMethodName), 'committed', False
+        )
+        fixture.begin(self.committed)
+        last_seen_tracker.clear()
+        timelines.store.clear()
+        follow_graph.clear()
+        fragments.clear()
+        fragments.pages = False
+        jobs.workers = 0
+        self.addCleanup(jobs.stop)
+        passwords.iterations = 1000
+        search_index.close()
+        app.config['WHOOSH_BASE'] = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, app.config['WHOOSH_BASE'])
+        self.addCleanup(search_index.close)
         self.client = app.test_client()
 
     def tearDown(self) -> None:
         """."""
-        db.session.remove()
-        db.drop_all()
+        app.config['SQLALCHEMY_BINDS'] = {}
+        app.config['POST_SHARD_BUCKETS'] = config.POST_SHARD_BUCKETS
+        app.config['POST_SHARD_MAP'] = None
+        replicas.init_app(app, db)
+        shards.init_app(app, db)
+        fixture.end(self.committed)
 
     def get_token(self, url) -> None:
         """Retrieve the csrf token from url."""
-        response = self.client.get('/login')
+        response = self.client.get(url)
         html = Soup(response.data, 'html.parser')
         token = html.find('input', {'name': 'csrf_token'}).get('value')
         return token
@@ -39,11 +253,11 @@ class TestCase(unittest.TestCase):
         db.session.commit()
         return new_user
 
-    def authenticate_user(self, user) -> None:
-        """."""
+    def authenticate_user(self, user, password=None) -> None:
+        """Log in; a user loaded after a login only has a hash stored."""
         self.client.post('/login', data={
             'username': user.username,
-            'password': user.password,
+            'password': password or user.password,
             'csrf_token': self.get_token('/login')
         })
 
@@ -59,6 +273,34 @@ class TestCase(unittest.TestCase):
         db.session.commit()
         return u1, u2
 
+    def create_posts(self, user, count, first=0) -> list:
+        """Give a user count posts, one second apart, oldest first."""
+        utcnow = datetime.utcnow()
+        posts = [
+            models.Post(
+                title=f'{user.username} post {i}',
+                body='body',
+                user_id=user.id,
+                timestamp=utcnow + timedelta(seconds=i)
+            ) for i in range(first, first + count)
+        ]
+        db.session.add_all(posts)
+        db.session.commit()
+        return posts
+
+    @contextmanager
+    def assert_num_queries(self, expected):
+        """Assert the block runs exactly expected SQL statements."""
+        statements = []
+
+        def record(conn, cursor, statement, parameters, context, many):
+            statements.append(statement)
+        event.listen(Engine, 'before_cursor_execute', record)
+        try:
+            yield statements
+        finally:
+            event.remove(Engine, 'before_cursor_execute', record)
+        self.assertEqual(len(statements), expected, '\n\n'.join(statements))
 
     def test_unauthenticated_home_route_redirects_to_login(self) -> None:
         """."""
@@ -200,6 +442,21 @@ class TestCase(unittest.TestCase):
         self.assertEqual(u1.followed.count(), 0)
         self.assertEqual(u2.followers.count(), 0)
 
+    def test_unfollow_with_a_stale_follow_graph_changes_nothing(self):
+        """."""
+        u1, u2 = self.setup_users_with_following()
+        self.assertTrue(u1.is_following(u2))
+        # another process removed the edge; this one's cache still has it
+        db.session.execute(models.followers.delete())
+        db.session.commit()
+        self.authenticate_user(u1)
+        response = self.client.get('/unfollow/sue')
+        self.assertEqual(response.status_code, 302)
+        u1 = models.User.query.filter_by(username='john').one()
+        u2 = models.User.query.filter_by(username='sue').one()
+        self.assertEqual((u1.following_count, u2.follower_count), (1, 1))
+        self.assertFalse(u1.is_following(u2))
+
     def test_follow_posts(self):
         # make four users
         u1 = models.User(username='john', password='tugboat')
@@ -250,5 +507,1862 @@ class TestCase(unittest.TestCase):
         self.assertTrue(f3, [p4, p3])
         self.assertTrue(f4, [p4])
 
+    def test_page_views_buffer_last_seen_instead_of_writing(self):
+        """."""
+        user = self.create_user()
+        self.authenticate_user(user)
+        self.client.get('/')
+        self.client.get(f'/profile/{user.username}')
+        db.session.expire_all()
+        self.assertIsNone(models.User.query.get(user.id).last_seen)
+        self.assertIn(user.id, last_seen_tracker._pending)
+
+    @committed
+    def test_last_seen_flush_writes_newest_timestamp(self):
+        """."""
+        user = self.create_user()
+        utcnow = datetime.utcnow()
+        last_seen_tracker.record(user.id, utcnow)
+        last_seen_tracker.record(user.id, utcnow - timedelta(seconds=5))
+        self.assertEqual(last_seen_tracker.flush(), 1)
+        db.session.expire_all()
+        self.assertEqual(models.User.query.get(user.id).last_seen, utcnow)
+        self.assertEqual(last_seen_tracker.flush(), 0)
+
+    @committed
+    def test_last_seen_flushes_when_batch_is_full(self):
+        """."""
+        u1, u2 = self.setup_users_with_following()
+        last_seen_tracker.batch_size = 2
+        try:
+            last_seen_tracker.record(u1.id)
+            self.assertEqual(len(last_seen_tracker._pending), 1)
+            timer = last_seen_tracker._timer
+            last_seen_tracker.record(u2.id)
+            self.assertEqual(len(last_seen_tracker._pending), 0)
+            self.assertIsNone(last_seen_tracker._timer)
+            timer.join(5)
+            self.assertFalse(timer.is_alive())
+        finally:
+            last_seen_tracker.batch_size = app.config['LAST_SEEN_BATCH_SIZE']
+        db.session.expire_all()
+        self.assertIsNotNone(models.User.query.get(u2.id).last_seen)
+
+    def test_failed_last_seen_flush_keeps_the_batch_and_backs_off(self):
+        """."""
+        user = self.create_user()
+        last_seen_tracker.batch_size = 1
+        self.addCleanup(
+            setattr, last_seen_tracker, 'batch_size',
+            app.config['LAST_SEEN_BATCH_SIZE']
+        )
+        broken = mock.Mock()
+        broken.engine.begin.side_effect = RuntimeError('database down')
+        with mock.patch('app.lastseen.db', broken), \
+                mock.patch.object(app.logger, 'exception') as logged:
+            last_seen_tracker.record(user.id)
+            last_seen_tracker.record(user.id)
+        self.assertEqual(broken.engine.begin.call_count, 1)
+        logged.assert_called_once()
+        self.assertIn(user.id, last_seen_tracker._pending)
+
+    @committed
+    def test_last_seen_is_flushed_by_the_timer_when_idle(self):
+        """."""
+        user = self.create_user()
+        last_seen_tracker.staleness = timedelta(seconds=0.05)
+        self.addCleanup(
+            setattr, last_seen_tracker, 'staleness',
+            timedelta(seconds=app.config['LAST_SEEN_STALENESS'])
+        )
+        last_seen_tracker.record(user.id)
+        last_seen_tracker._timer.join(5)
+        db.session.expire_all()
+        self.assertIsNotNone(models.User.query.get(user.id).last_seen)
+
+    def test_profile_shows_buffered_last_seen(self):
+        """."""
+        user = self.create_user()
+        self.authenticate_user(user)
+        response = self.client.get(f'/profile/{user.username}')
+        html = Soup(response.data, 'html.parser')
+        self.assertIn('Last seen on', html.find('em').text)
+
+    def test_cursor_pagination_walks_older_and_newer(self):
+        """."""
+        from app.pagination import paginate_posts
+        user = self.create_user()
+        posts = self.create_posts(user, 5)
+        first = paginate_posts(user.posts, None, 3)
+        self.assertEqual(first.items, posts[:1:-1])
+        self.assertFalse(first.has_prev)
+        self.assertTrue(first.has_next)
+        second = paginate_posts(user.posts, first.next_cursor, 3)
+        self.assertEqual(second.items, posts[1::-1])
+        self.assertTrue(second.has_prev)
+        self.assertFalse(second.has_next)
+        back = paginate_posts(user.posts, second.prev_cursor, 3)
+        self.assertEqual(back.items, first.items)
+        self.assertFalse(back.has_prev)
+
+    def test_profile_pages_link_with_cursors(self):
+        """."""
+        user = self.create_user()
+        self.create_posts(user, 4)
+        self.authenticate_user(user)
+        response = self.client.get(f'/profile/{user.username}')
+        html = Soup(response.data, 'html.parser')
+        older = html.find('a', string='>> Older posts')
+        self.assertIsNotNone(older)
+        response = self.client.get(older['href'])
+        html = Soup(response.data, 'html.parser')
+        self.assertIn('flerg post 0', html.text)
+        self.assertNotIn('flerg post 3', html.text)
+
+    def test_bad_cursor_is_not_found(self):
+        """."""
+        user = self.create_user()
+        self.authenticate_user(user)
+        response = self.client.get('/posts/not-a-cursor')
+        self.assertEqual(response.status_code, 404)
+
+    def enable_timelines(self, fanout_limit=10000, max_length=800) -> None:
+        """Turn on materialized timelines for the rest of this test."""
+        store = timelines.store
+        settings = (timelines.enabled, timelines.fanout_limit, store.max_length)
+
+        def restore():
+            timelines.enabled, timelines.fanout_limit = settings[:2]
+            store.max_length = settings[2]
+        self.addCleanup(restore)
+        timelines.enabled = True
+        timelines.fanout_limit = fanout_limit
+        store.max_length = max_length
+
+    def timeline_titles(self, user, cursor=None, per_page=3) -> list:
+        """Titles on one page of a user's home timeline."""
+        return [p.title for p in timelines.page(user, cursor, per_page).items]
+
+    def test_timeline_fan_out_pushes_new_posts_to_followers(self):
+        """."""
+        self.enable_timelines()
+        u1, u2 = self.setup_users_with_following()
+        self.assertEqual(self.timeline_titles(u1), [])
+        self.assertTrue(timelines.store.has(u1.id))
+        post = self.create_posts(u2, 1)[0]
+        timelines.fan_out(post)
+        self.assertEqual(timelines.store.size(u1.id), 1)
+        self.assertEqual(self.timeline_titles(u1), ['sue post 0'])
+
+    def test_timeline_backfills_on_follow_and_prunes_on_unfollow(self):
+        """."""
+        self.enable_timelines()
+        u1, u2 = self.setup_users_with_following()
+        u3 = models.User(username='mary', password='tugboat')
+        db.session.add(u3)
+        db.session.commit()
+        self.create_posts(u3, 2)
+        self.timeline_titles(u1)
+        u1.follow(u3)
+        db.session.commit()
+        self.assertEqual(
+            self.timeline_titles(u1), ['mary post 1', 'mary post 0']
+        )
+        u1.unfollow(u3)
+        db.session.commit()
+        self.assertEqual(self.timeline_titles(u1), [])
+
+    def test_timeline_pages_match_fan_out_on_read(self):
+        """."""
+        from app.pagination import paginate_posts
+        self.enable_timelines(fanout_limit=1, max_length=4)
+        u1, u2 = self.setup_users_with_following()
+        u3 = models.User(username='mary', password='tugboat')
+        db.session.add(u3)
+        db.session.commit()
+        u1.follow(u1)
+        u2.follow(u3)
+        u1.follow(u3)
+        db.session.commit()
+        for user in (u1, u2, u3):
+            self.create_posts(user, 3)
+        cursor, stored = None, []
+        while True:
+            page = timelines.page(u1, cursor, 2)
+            stored.extend(page.items)
+            if not page.has_next:
+                break
+            cursor = page.next_cursor
+        self.assertEqual(stored, u1.followed_posts().all())
+        back = timelines.page(u1, page.prev_cursor, 2)
+        expected = paginate_posts(u1.followed_posts(), page.prev_cursor, 2)
+        self.assertEqual(back.items, expected.items)
+
+    def test_sqlite_timeline_store_keeps_bounded_ordered_entries(self):
+        """."""
+        from app.pagination import OLDER
+        from app.timeline import SQLiteTimelineStore
+        with tempfile.TemporaryDirectory() as tmp:
+            store = SQLiteTimelineStore(os.path.join(tmp, 't.db'), 3)
+            utcnow = datetime.utcnow()
+            entries = [(utcnow + timedelta(seconds=i), i, i % 2) for i in range(5)]
+            store.push([1], entries[0])
+            self.assertFalse(store.has(1))
+            store.replace(1, entries[:2])
+            store.extend(1, entries[2:])
+            self.assertEqual(store.size(1), 3)
+            self.assertEqual(store.page(1, limit=2), entries[:2:-1])
+            self.assertEqual(
+                store.page(1, OLDER, entries[3][:2], 5), [entries[2]]
+            )
+            store.remove_author(1, 0)
+            self.assertEqual(store.page(1), [entries[3]])
+
+    def test_sqlite_timeline_store_opens_once_per_process(self):
+        """."""
+        from app.timeline import SQLiteTimelineStore
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, 't.db')
+            store = SQLiteTimelineStore(path)
+            self.assertFalse(os.path.exists(path))
+            store.replace(1, [(datetime.utcnow(), 1, 2)])
+            inherited = store._connection
+            pid = os.fork()
+            if not pid:
+                code = 1
+                try:
+                    reopened = store._connection is None and store.has(1)
+                    if reopened and store._connection is not inherited:
+                        code = 0
+                finally:
+                    os._exit(code)
+            self.assertEqual(os.waitpid(pid, 0)[1], 0)
+            self.assertIs(store._connection, inherited)
+
+    def test_timeline_stores_must_implement_every_method(self):
+        """."""
+        from app.timeline import TimelineStore
+
+        class Partial(TimelineStore):
+            def has(self, user_id):
+                return False
+
+        with self.assertRaises(TypeError):
+            Partial()
+
+    def test_home_page_query_count_does_not_grow_with_posts(self):
+        """."""
+        u1, u2 = self.setup_users_with_following()
+        u3 = models.User(username='mary', password='tugboat')
+        db.session.add(u3)
+        db.session.commit()
+        u1.follow(u3)
+        db.session.commit()
+        self.create_posts(u2, 1)
+        self.authenticate_user(u1)
+        # the newest followed post for the ETag, then the page
+        with self.assert_num_queries(2):
+            self.client.get('/')
+        mary = models.User.query.filter_by(username='mary').first()
+        self.create_posts(mary, 2)
+        with self.assert_num_queries(2):
+            response = self.client.get('/')
+        html = Soup(response.data, 'html.parser')
+        self.assertIn('Author: mary', html.text)
+        self.assertIn('Author: sue', html.text)
+
+    def test_profile_page_query_count_does_not_grow_with_posts(self):
+        """."""
+        user = self.create_user()
+        self.create_posts(user, 1)
+        self.authenticate_user(user)
+        with self.assert_num_queries(2):
+            self.client.get('/profile/flerg')
+        user = models.User.query.filter_by(username='flerg').first()
+        self.create_posts(user, 3, first=1)
+        with self.assert_num_queries(2):
+            self.client.get('/profile/flerg')
+
+    def test_duplicate_follow_rows_are_rejected(self):
+        """."""
+        from sqlalchemy.exc import IntegrityError
+        u1, u2 = self.setup_users_with_following()
+        with self.assertRaises(IntegrityError):
+            db.session.execute(models.followers.insert().values(
+                follower_id=u1.id, followed_id=u2.id
+            ))
+        db.session.rollback()
+
+    def test_is_following_is_answered_from_the_follow_graph_cache(self):
+        """."""
+        u1, u2 = self.setup_users_with_following()
+        for user in (u1, u2):
+            follow_graph.following(user.id)
+            follow_graph.followers(user.id)
+        with self.assert_num_queries(0):
+            self.assertTrue(u1.is_following(u2))
+            self.assertFalse(u2.is_following(u1))
+            self.assertEqual(follow_graph.following_count(u1.id), 1)
+            self.assertEqual(follow_graph.follower_count(u2.id), 1)
+            self.assertEqual(follow_graph.follower_count(u1.id), 0)
+
+    def test_follow_and_unfollow_invalidate_the_follow_graph_cache(self):
+        """."""
+        u1, u2 = self.setup_users_with_following()
+        self.assertEqual(follow_graph.followers(u2.id), {u1.id})
+        u2.follow(u1)
+        db.session.commit()
+        self.assertEqual(follow_graph.followers(u1.id), {u2.id})
+        self.assertTrue(u2.is_following(u1))
+        u1.unfollow(u2)
+        db.session.commit()
+        self.assertEqual(follow_graph.followers(u2.id), frozenset())
+        self.assertEqual(follow_graph.following(u2.id), {u1.id})
+
+    def test_follow_graph_sets_reloaded_before_commit_are_dropped(self):
+        """."""
+        u1, u2 = self.setup_users_with_following()
+        u2.follow(u1)
+        # a concurrent request reloads u2's set before the follow commits
+        follow_graph._sets[('following', u2.id)] = (
+            time.monotonic(), frozenset()
+        )
+        db.session.commit()
+        self.assertEqual(follow_graph.following(u2.id), {u1.id})
+
+        u1.unfollow(u2)
+        self.assertEqual(follow_graph.following(u1.id), frozenset())
+        db.session.rollback()
+        self.assertEqual(follow_graph.following(u1.id), {u2.id})
+
+    def test_following_again_on_a_stale_follow_set_is_not_an_error(self):
+        """."""
+        u1, u2 = self.setup_users_with_following()
+        self.authenticate_user(u1)
+        follow_graph._sets[('following', u1.id)] = (
+            time.monotonic(), frozenset()
+        )
+        response = self.client.get('/follow/sue')
+        self.assertEqual(response.status_code, 302)
+        html = self.client.get('/profile/sue').data
+        self.assertIn(b'You are already following sue.', html)
+        self.assertEqual(
+            models.User.query.filter_by(username='sue').one().follower_count,
+            1
+        )
+
+    def test_follow_graph_cache_evicts_least_recently_used(self):
+        """."""
+        from app.followgraph import FollowGraphCache
+        u1, u2 = self.setup_users_with_following()
+        cache = FollowGraphCache()
+        cache.capacity = 2
+        cache.following(u1.id)
+        cache.followers(u2.id)
+        cache.following(u1.id)
+        cache.following(u2.id)
+        with self.assert_num_queries(1):
+            cache.following(u1.id)
+            cache.followers(u2.id)
+
+    def test_follow_and_unfollow_maintain_counters(self):
+        """."""
+        u1, u2 = self.setup_users_with_following()
+        self.assertEqual((u1.following_count, u1.follower_count), (1, 0))
+        self.assertEqual((u2.following_count, u2.follower_count), (0, 1))
+        u1.follow(u1)
+        u2.follow(u1)
+        db.session.commit()
+        self.assertEqual((u1.following_count, u1.follower_count), (2, 2))
+        u1.unfollow(u2)
+        db.session.commit()
+        self.assertEqual((u1.following_count, u2.follower_count), (1, 0))
+
+    def test_posting_increments_post_count(self):
+        """."""
+        user = self.create_user()
+        self.authenticate_user(user)
+        self.client.post('/', data={
+            'title': 'hello',
+            'body': 'world',
+            'csrf_token': self.get_token('/')
+        })
+        user = models.User.query.filter_by(username='flerg').first()
+        self.assertEqual(user.post_count, 1)
+        self.assertEqual(user.posts.count(), 1)
+
+    @committed
+    def test_reconcile_repairs_drifted_counters(self):
+        """."""
+        from db_reconcile import reconcile_counters
+        u1, u2 = self.setup_users_with_following()
+        self.create_posts(u2, 2)
+        self.assertEqual(reconcile_counters(), 1)
+        u1.follower_count = 7
+        db.session.commit()
+        self.assertEqual(reconcile_counters(), 1)
+        db.session.expire_all()
+        self.assertEqual(
+            (u1.follower_count, u1.following_count, u1.post_count), (0, 1, 0)
+        )
+        self.assertEqual(
+            (u2.follower_count, u2.following_count, u2.post_count), (1, 0, 2)
+        )
+        self.assertEqual(reconcile_counters(), 0)
+
+    def test_committed_posts_are_searchable(self):
+        """."""
+        user = self.create_user()
+        db.session.add(models.Post(
+            title='tugboat races', body='on the sound', user_id=user.id,
+            timestamp=datetime.utcnow()
+        ))
+        db.session.commit()
+        self.assertEqual(len(search_index._pending), 1)
+        ids, total = search_index.search('sound')
+        self.assertEqual(total, 1)
+        self.assertEqual(search_index.search('tugboat')[0], ids)
+        self.assertEqual(search_index.search('ferry'), ([], 0))
+
+    def test_rolled_back_posts_are_not_indexed(self):
+        """."""
+        user = self.create_user()
+        db.session.add(models.Post(title='draft', user_id=user.id))
+        db.session.flush()
+        db.session.rollback()
+        self.assertEqual(search_index._pending, {})
+
+    def test_search_index_commits_in_batches(self):
+        """."""
+        user = self.create_user()
+        search_index.commit_limit = 3
+        self.addCleanup(
+            setattr, search_index, 'commit_limit',
+            app.config['SEARCH_COMMIT_LIMIT']
+        )
+        self.create_posts(user, 2)
+        self.assertEqual(len(search_index._pending), 2)
+        self.create_posts(user, 1, first=2)
+        self.assertEqual(search_index._pending, {})
+        self.assertIsNone(search_index._timer)
+
+    def test_search_changes_are_flushed_by_the_timer_when_idle(self):
+        """."""
+        user = self.create_user()
+        search_index.commit_period = 0.05
+        self.addCleanup(
+            setattr, search_index, 'commit_period',
+            app.config['SEARCH_COMMIT_PERIOD']
+        )
+        self.create_posts(user, 1)
+        search_index._timer.join(5)
+        self.assertEqual(search_index._pending, {})
+        with search_index.index.searcher() as searcher:
+            self.assertEqual(searcher.doc_count(), 1)
+
+    def test_failed_search_index_flush_keeps_changes_for_the_next_write(self):
+        """."""
+        user = self.create_user()
+        search_index.commit_limit = 1
+        self.addCleanup(
+            setattr, search_index, 'commit_limit',
+            app.config['SEARCH_COMMIT_LIMIT']
+        )
+        with mock.patch.object(
+            search_index.index, 'writer', side_effect=RuntimeError('locked')
+        ), mock.patch.object(app.logger, 'exception') as logged:
+            self.create_posts(user, 1)
+        logged.assert_called_once()
+        self.assertEqual(len(search_index._pending), 1)
+        self.create_posts(user, 1, first=1)
+        self.assertEqual(search_index._pending, {})
+        self.assertEqual(search_index.search('flerg', 1, 10)[1], 2)
+
+    def test_search_pages_below_one_are_not_found(self):
+        """."""
+        user = self.create_user()
+        self.authenticate_user(user)
+        for page in (0, -1):
+            response = self.client.get(f'/search?q=body&page={page}')
+            self.assertEqual(response.status_code, 404)
+
+    def test_search_route_pages_results(self):
+        """."""
+        user = self.create_user()
+        self.create_posts(user, 4)
+        self.authenticate_user(user)
+        response = self.client.get('/search?q=body')
+        html = Soup(response.data, 'html.parser')
+        self.assertIn('4 results', html.text)
+        self.assertEqual(html.text.count('Author: flerg'), 3)
+        more = html.find('a', string='>> More results')
+        response = self.client.get(more['href'])
+        html = Soup(response.data, 'html.parser')
+        self.assertEqual(html.text.count('Author: flerg'), 1)
+
+    def test_reindex_rebuilds_from_post_chunks(self):
+        """."""
+        from search_reindex import post_chunks
+        user = self.create_user()
+        self.create_posts(user, 5)
+        search_index.clear()
+        self.assertEqual(search_index.reindex(post_chunks(2)), 5)
+        self.assertEqual(search_index.search('post', 1, 10)[1], 5)
+
+    def test_instrumented_pool_records_checkouts_and_timeouts(self):
+        """."""
+        import sqlite3
+        from app.dbpool import InstrumentedQueuePool, pool_stats
+        from sqlalchemy.exc import TimeoutError
+        pool_stats.reset()
+        pool = InstrumentedQueuePool(
+            lambda: sqlite3.connect(':memory:'),
+            pool_size=1, max_overflow=0, timeout=0.01
+        )
+        connection = pool.connect()
+        stats = pool_stats.snapshot()
+        self.assertEqual(stats['checkouts'], 1)
+        self.assertGreaterEqual(stats['checked_out'], 1)
+        with self.assertRaises(TimeoutError):
+            pool.connect()
+        connection.close()
+        stats = pool_stats.snapshot()
+        self.assertEqual(stats['timeouts'], 1)
+        self.assertEqual(sum(stats['checkout_latency'].values()), 1)
+
+    def test_postgres_engines_get_pool_and_timeout_options(self):
+        """."""
+        from app.dbpool import InstrumentedQueuePool
+        from sqlalchemy.engine.url import make_url
+        options = {'pool_size': 10, 'max_overflow': 20}
+        db.apply_driver_hacks(
+            app, make_url('postgresql://localhost/microblog'), options
+        )
+        self.assertIs(options['poolclass'], InstrumentedQueuePool)
+        self.assertEqual(
+            options['connect_args']['options'],
+            f'-c statement_timeout={config.DATABASE_STATEMENT_TIMEOUT}'
+        )
+        self.assertEqual(options['pool_size'], 10)
+        self.assertNotIn('connect_timeout', options['connect_args'])
+
+    def test_replica_engines_get_a_connect_timeout(self):
+        """."""
+        uri = 'postgresql://replica.example/microblog'
+        app.config['SQLALCHEMY_BINDS'] = {'replica0': uri}
+        options = {}
+        db.apply_driver_hacks(app, make_url(uri), options)
+        self.assertEqual(
+            options['connect_args']['connect_timeout'],
+            config.REPLICA_CONNECT_TIMEOUT
+        )
+
+    def use_internal_token(self) -> dict:
+        """Turn on the /internal endpoints; return the headers to send."""
+        app.config['INTERNAL_TOKEN'] = 'sesame'
+        self.addCleanup(app.config.update, INTERNAL_TOKEN='')
+        return {'X-Internal-Token': 'sesame'}
+
+    def test_internal_pool_stats_need_the_internal_token(self):
+        """."""
+        self.assertEqual(self.client.get('/internal/pool').status_code, 404)
+        headers = self.use_internal_token()
+        response = self.client.get('/internal/pool', headers=headers)
+        self.assertEqual(response.status_code, 200)
+        self.assertIn(b'checked_out', response.data)
+        for sent in ({}, {'X-Internal-Token': 'guess'}):
+            response = self.client.get('/internal/pool', headers=sent)
+            self.assertEqual(response.status_code, 404)
+
+    def enable_profiler(self, slow_ms=500):
+        """Turn on the request profiler for the rest of this test."""
+        from app import profiler
+        self.addCleanup(setattr, profiler, 'slow_ms', profiler.slow_ms)
+        self.addCleanup(profiler.disable)
+        profiler.slow_ms = slow_ms
+        profiler.enable()
+        return profiler
+
+    def test_profiler_is_silent_when_disabled(self):
+        """."""
+        response = self.client.get('/login')
+        self.assertNotIn('Server-Timing', response.headers)
+
+    def test_profiler_reports_server_timing(self):
+        """."""
+        user = self.create_user()
+        self.create_posts(user, 2)
+        self.authenticate_user(user)
+        self.enable_profiler()
+        response = self.client.get('/profile/flerg')
+        timing = response.headers['Server-Timing']
+        self.assertIn('total;dur=', timing)
+        self.assertIn('sql;dur=', timing)
+        self.assertIn('desc="2 queries"', timing)
+        self.assertIn('tpl;dur=', timing)
+
+    def test_profiler_logs_slow_requests(self):
+        """."""
+        user = self.create_user()
+        self.authenticate_user(user)
+        self.enable_profiler(slow_ms=0)
+        with self.assertLogs(app.logger, 'WARNING') as logs:
+            self.client.get('/')
+        self.assertIn('slow request GET / (index)', logs.output[0])
+        self.assertIn('SELECT', logs.output[0])
+
+    def test_datagen_is_deterministic(self):
+        """."""
+        from benchmarks import datagen
+        first = list(datagen.follows(200, mean_follows=10, seed=3))
+        self.assertEqual(first, list(datagen.follows(200, 10, seed=3)))
+        self.assertNotEqual(first, list(datagen.follows(200, 10, seed=4)))
+        self.assertEqual(
+            list(datagen.posts(50, 200, seed=3)),
+            list(datagen.posts(50, 200, seed=3))
+        )
+
+    @committed
+    def test_datagen_loads_a_consistent_graph(self):
+        """."""
+        from benchmarks import datagen
+        loaded = datagen.load(30, 120, mean_follows=5)
+        self.assertEqual(loaded['users'], 30)
+        self.assertEqual(loaded['posts'], 120)
+        self.assertEqual(models.Post.query.count(), 120)
+        self.assertEqual(
+            sum(u.post_count for u in models.User.query), 120
+        )
+        self.assertEqual(
+            sum(u.following_count for u in models.User.query),
+            loaded['follows']
+        )
+
+    @committed
+    def test_load_harness_reports_every_operation(self):
+        """."""
+        from benchmarks import datagen, load, report
+        datagen.load(10, 60, mean_follows=3)
+        samples, errors, seconds = load.run(
+            load.TestClientSession, 10, 40, concurrency=1, seed=1
+        )
+        result = report.build(samples, seconds, {})
+        self.assertEqual(errors, {})
+        self.assertEqual(result['overall']['count'], 41)
+        self.assertEqual(result['operations']['login']['count'], 1)
+        summary = result['operations']['timeline']
+        self.assertLessEqual(summary['p50'], summary['p99'])
+
+    @committed
+    def test_login_benchmark_sweeps_work_factors(self):
+        """."""
+        from benchmarks import datagen, login
+        datagen.load(5, 20, mean_follows=2)
+        result = login.sweep([1000, 2000], 5, 6, concurrency=2)
+        self.assertEqual(result['errors'], {})
+        self.assertEqual(result['operations']['login@1000']['count'], 6)
+        self.assertEqual(result['operations']['login@2000']['count'], 6)
+        self.assertTrue(models.User.query.get(1).password.startswith(
+            'pbkdf2:sha256:2000$'
+        ))
+
+    def test_post_rows_are_served_from_the_fragment_cache(self):
+        """."""
+        user = self.create_user()
+        self.create_posts(user, 1)
+        self.authenticate_user(user)
+        self.client.get('/profile/flerg')
+        key = next(k for k in fragments.backend._entries if k[:5] == 'post:')
+        fragments.backend.set(key, '<tr><td>from cache</td></tr>')
+        response = self.client.get('/profile/flerg')
+        self.assertIn(b'from cache', response.data)
+
+    def test_profile_edits_rerender_post_rows(self):
+        """."""
+        user = self.create_user()
+        self.create_posts(user, 1)
+        self.authenticate_user(user)
+        self.assertIn(b'Author: flerg', self.client.get('/profile/flerg').data)
+        response = self.client.post('/edit_profile', data={
+            'username': 'blerg',
+            'about_me': '',
+            'csrf_token': self.get_token('/edit_profile')
+        })
+        self.assertIn('/profile/blerg', response.location)
+        html = self.client.get('/profile/blerg').data
+        self.assertIn(b'Author: blerg', html)
+        self.assertNotIn(b'Author: flerg', html)
+
+    def test_cached_home_page_skips_the_timeline_query(self):
+        """."""
+        user = self.create_user()
+        user.follow(user)
+        db.session.commit()
+        self.create_posts(user, 2)
+        self.authenticate_user(user)
+        fragments.pages = True
+        self.client.get('/')
+        with self.assert_num_queries(1):
+            response = self.client.get('/')
+        self.assertIn(b'flerg post 1', response.data)
+
+    def test_new_posts_invalidate_followers_cached_pages(self):
+        """."""
+        u1, u2 = self.setup_users_with_following()
+        self.authenticate_user(u1)
+        fragments.pages = True
+        self.assertNotIn(b'fresh', self.client.get('/').data)
+        self.client.get('/logout')
+        u2 = models.User.query.filter_by(username='sue').first()
+        self.authenticate_user(u2)
+        self.assertNotIn(b'fresh', self.client.get('/profile/sue').data)
+        self.client.post('/', data={
+            'title': 'fresh', 'body': 'news',
+            'csrf_token': self.get_token('/')
+        })
+        self.assertIn(b'fresh', self.client.get('/profile/sue').data)
+        self.client.get('/logout')
+        u1 = models.User.query.filter_by(username='john').first()
+        self.authenticate_user(u1, 'johnson')
+        self.assertIn(b'fresh', self.client.get('/').data)
+
+    def test_large_authors_posts_do_not_load_their_followers(self):
+        """."""
+        u1, u2 = self.setup_users_with_following()
+        fragments.pages = True
+        fragments.fanout_limit = 0
+        self.addCleanup(
+            setattr, fragments, 'fanout_limit',
+            app.config['TIMELINE_FANOUT_LIMIT']
+        )
+        home = fragments._generation('home', u1.id)
+        with mock.patch.object(follow_graph, 'followers') as followers:
+            fragments.invalidate_author(u2.id)
+        followers.assert_not_called()
+        self.assertEqual(fragments._generation('home', u1.id), home)
+
+    def test_post_lists_are_not_invalidated_without_page_caching(self):
+        """."""
+        u1, u2 = self.setup_users_with_following()
+        sue_id = u2.id
+        with mock.patch.object(follow_graph, 'followers') as followers:
+            with self.assert_num_queries(0):
+                fragments.invalidate_author(sue_id)
+        followers.assert_not_called()
+
+    def test_follow_invalidates_the_cached_home_page(self):
+        """."""
+        u1, u2 = self.setup_users_with_following()
+        u3 = models.User(username='bob', password='bobbert')
+        db.session.add(u3)
+        db.session.commit()
+        self.create_posts(u3, 1)
+        self.authenticate_user(u1)
+        fragments.pages = True
+        self.assertNotIn(b'bob post 0', self.client.get('/').data)
+        self.client.get('/follow/bob')
+        self.assertIn(b'bob post 0', self.client.get('/').data)
+
+    def test_memory_backend_evicts_least_recently_used_by_size(self):
+        """."""
+        backend = MemoryBackend(max_bytes=600)
+        backend.set('a', 'x' * 100)
+        backend.set('b', 'x' * 100)
+        backend.get('a')
+        backend.set('c', 'x' * 300)
+        self.assertIsNotNone(backend.get('a'))
+        self.assertIsNone(backend.get('b'))
+        self.assertLessEqual(backend.size, 600)
+        backend.set('d', 'x', timeout=-1)
+        self.assertIsNone(backend.get('d'))
+
+    def test_unchanged_home_page_is_not_modified(self):
+        """."""
+        u1, u2 = self.setup_users_with_following()
+        self.create_posts(u2, 2)
+        self.authenticate_user(u1)
+        response = self.client.get('/')
+        etag = response.headers['ETag']
+        self.assertTrue(etag.startswith('W/'))
+        with self.assert_num_queries(1):
+            response = self.client.get('/', headers={'If-None-Match': etag})
+        self.assertEqual(response.status_code, 304)
+        self.assertEqual(response.data, b'')
+
+    def test_new_followed_posts_change_the_home_page_etag(self):
+        """."""
+        u1, u2 = self.setup_users_with_following()
+        self.authenticate_user(u1)
+        etag = self.client.get('/').headers['ETag']
+        self.create_posts(models.User.query.filter_by(username='sue').one(), 1)
+        response = self.client.get('/', headers={'If-None-Match': etag})
+        self.assertEqual(response.status_code, 200)
+        self.assertIn(b'sue post 0', response.data)
+        self.assertNotEqual(response.headers['ETag'], etag)
+
+    def test_follows_change_the_home_page_etag(self):
+        """."""
+        u1, u2 = self.setup_users_with_following()
+        u3 = models.User(username='bob', password='bobbert')
+        db.session.add(u3)
+        db.session.commit()
+        self.authenticate_user(u1)
+        etag = self.client.get('/').headers['ETag']
+        self.client.get('/follow/bob')
+        response = self.client.get('/', headers={'If-None-Match': etag})
+        self.assertEqual(response.status_code, 200)
+
+    def test_home_page_etag_sees_edits_committed_by_other_processes(self):
+        """."""
+        u1, u2 = self.setup_users_with_following()
+        self.authenticate_user(u1)
+        etag = self.client.get('/').headers['ETag']
+        # another server process renames sue: only the database changes
+        models.User.query.filter_by(username='sue').update({
+            'username': 'susan',
+            'profile_version': models.User.profile_version + 1,
+        }, synchronize_session=False)
+        db.session.commit()
+        response = self.client.get('/', headers={'If-None-Match': etag})
+        self.assertEqual(response.status_code, 200)
+        self.assertNotEqual(response.headers['ETag'], etag)
+
+    def test_pages_with_flashed_messages_have_no_etag(self):
+        """."""
+        u1, u2 = self.setup_users_with_following()
+        self.authenticate_user(u1)
+        etag = self.client.get('/').headers['ETag']
+        with self.client.session_transaction() as session:
+            session['_flashes'] = [('message', 'hello')]
+        response = self.client.get('/', headers={'If-None-Match': etag})
+        self.assertEqual(response.status_code, 200)
+        self.assertIn(b'hello', response.data)
+        self.assertNotIn('ETag', response.headers)
+
+    def test_cached_post_lists_have_no_etag(self):
+        """."""
+        u1, u2 = self.setup_users_with_following()
+        self.authenticate_user(u1)
+        fragments.pages = True
+        for url in ('/', '/profile/sue'):
+            self.assertIn('ETag', self.client.get(url).headers)
+            self.assertNotIn('ETag', self.client.get(url).headers)
+
+    def test_home_page_has_no_etag_while_its_fan_out_is_queued(self):
+        """."""
+        from app.timeline import SQLiteTimelineStore
+        path = os.path.join(app.config['WHOOSH_BASE'], 'timelines.db')
+        self.addCleanup(setattr, timelines, 'store', timelines.store)
+        timelines.store = SQLiteTimelineStore(path)
+        self.enable_timelines()
+        u1, u2 = self.setup_users_with_following()
+        self.timeline_titles(u1)
+        self.authenticate_user(u2)
+        self.client.post('/', data={
+            'title': 'queued', 'body': 'post',
+            'csrf_token': self.get_token('/')
+        })
+        self.client.get('/logout')
+        u1 = models.User.query.filter_by(username='john').one()
+        self.authenticate_user(u1, 'johnson')
+        self.assertNotIn('ETag', self.client.get('/').headers)
+        jobs.drain()
+        response = self.client.get('/')
+        self.assertIn(b'queued', response.data)
+        self.assertIn('ETag', response.headers)
+
+    def test_profile_page_is_not_modified_until_a_new_post(self):
+        """."""
+        u1, u2 = self.setup_users_with_following()
+        self.authenticate_user(u1)
+        etag = self.client.get('/profile/sue').headers['ETag']
+        response = self.client.get(
+            '/profile/sue', headers={'If-None-Match': etag}
+        )
+        self.assertEqual(response.status_code, 304)
+        sue = models.User.query.filter_by(username='sue').one()
+        db.session.add(models.Post(
+            title='new', body='post', timestamp=datetime.utcnow(),
+            user_id=sue.id
+        ))
+        sue.increment('post_count')
+        db.session.commit()
+        response = self.client.get(
+            '/profile/sue', headers={'If-None-Match': etag}
+        )
+        self.assertEqual(response.status_code, 200)
+
+    def test_own_profile_is_not_modified_within_the_minute(self):
+        """."""
+        user = self.create_user()
+        self.authenticate_user(user)
+        seen = datetime(2026, 1, 1, 12, 0, 5)
+        self.addCleanup(last_seen_tracker.clear)
+        with mock.patch.object(last_seen_tracker, 'record'):
+            last_seen_tracker._pending[user.id] = seen
+            etag = self.client.get('/profile/flerg').headers['ETag']
+            last_seen_tracker._pending[user.id] = seen + timedelta(seconds=30)
+            response = self.client.get(
+                '/profile/flerg', headers={'If-None-Match': etag}
+            )
+            self.assertEqual(response.status_code, 304)
+            last_seen_tracker._pending[user.id] = seen + timedelta(minutes=1)
+            response = self.client.get(
+                '/profile/flerg', headers={'If-None-Match': etag}
+            )
+        self.assertEqual(response.status_code, 200)
+        self.assertIn(b'2026-01-01 12:01:00', response.data)
+
+    def test_logged_in_user_is_identified_without_a_query(self):
+        """."""
+        user = self.create_user()
+        self.authenticate_user(user)
+        with self.assert_num_queries(0):
+            response = self.client.get('/login')
+        self.assertEqual(response.status_code, 302)
+
+    def test_stale_identity_is_reloaded_from_the_database(self):
+        """."""
+        user = self.create_user()
+        self.authenticate_user(user)
+        user = models.User.query.filter_by(username='flerg').one()
+        user.username = 'renamed'
+        db.session.commit()
+        with self.client.session_transaction() as session:
+            identity = dict(session['identity'])
+            identity['issued'] -= app.config['IDENTITY_TTL']
+            session['identity'] = identity
+        with self.assert_num_queries(1):
+            self.client.get('/login')
+        with self.client.session_transaction() as session:
+            self.assertEqual(session['identity']['username'], 'renamed')
+
+    def test_edit_profile_refreshes_the_session_identity(self):
+        """."""
+        user = self.create_user()
+        self.authenticate_user(user)
+        self.client.post('/edit_profile', data={
+            'username': 'blerg',
+            'about_me': 'hi',
+            'csrf_token': self.get_token('/edit_profile')
+        })
+        with self.client.session_transaction() as session:
+            self.assertEqual(session['identity']['username'], 'blerg')
+        html = self.client.get('/search').data
+        self.assertIn(b'href="/profile/blerg"', html)
+
+    def test_logout_forgets_the_session_identity(self):
+        """."""
+        user = self.create_user()
+        self.authenticate_user(user)
+        self.client.get('/logout')
+        with self.client.session_transaction() as session:
+            self.assertNotIn('identity', session)
+        self.assertEqual(self.client.get('/').status_code, 302)
+
+    def register_handler(self, kind, func, batch=False) -> None:
+        """Register a job handler for the rest of this test."""
+        jobs.handler(kind, batch)(func)
+        self.addCleanup(jobs.handlers.pop, kind)
+
+    def test_jobs_commit_and_roll_back_with_the_session(self):
+        """."""
+        seen = []
+        self.register_handler('test.record', lambda value: seen.append(value))
+        jobs.enqueue('test.record', value=1)
+        db.session.rollback()
+        jobs.enqueue('test.record', value=2)
+        db.session.commit()
+        self.assertEqual(jobs.drain(), 1)
+        self.assertEqual(seen, [2])
+        self.assertEqual(models.Job.query.count(), 0)
+
+    def test_same_kind_jobs_run_in_one_batch(self):
+        """."""
+        batches = []
+        self.register_handler('test.batch', batches.append, batch=True)
+        for value in range(3):
+            jobs.enqueue('test.batch', value=value)
+        db.session.commit()
+        jobs.drain()
+        self.assertEqual(batches, [[{'value': 0}, {'value': 1}, {'value': 2}]])
+
+    def test_failed_jobs_are_retried_with_backoff_then_given_up(self):
+        """."""
+        def fail(**payload):
+            raise RuntimeError('boom')
+        self.register_handler('test.fail', fail)
+        jobs.enqueue('test.fail')
+        db.session.commit()
+        with self.assertLogs(app.logger, 'ERROR'):
+            jobs.drain()
+        job = models.Job.query.one()
+        self.assertEqual((job.state, job.attempts), ('queued', 1))
+        self.assertGreater(job.run_at, datetime.utcnow())
+        self.assertIn('boom', job.last_error)
+        self.assertEqual(jobs.drain(), 0)
+        with self.assertLogs(app.logger, 'ERROR'):
+            for attempt in range(jobs.max_attempts - 1):
+                job.run_at = datetime.utcnow()
+                db.session.commit()
+                jobs.drain()
+                job = models.Job.query.one()
+        self.assertEqual(
+            (job.state, job.attempts), ('failed', jobs.max_attempts)
+        )
+
+    def test_jobs_abandoned_by_a_dead_worker_are_reclaimed(self):
+        """."""
+        seen = []
+        self.register_handler('test.record', lambda value: seen.append(value))
+        job = jobs.enqueue('test.record', value=1)
+        job.state = 'running'
+        job.locked_at = datetime.utcnow()
+        db.session.commit()
+        self.assertEqual(jobs.drain(), 0)
+        job.locked_at -= timedelta(seconds=jobs.lease + 1)
+        db.session.commit()
+        self.assertEqual(jobs.drain(), 1)
+        self.assertEqual(seen, [1])
+
+    def test_new_posts_fan_out_in_a_background_job(self):
+        """."""
+        from app.timeline import SQLiteTimelineStore
+        path = os.path.join(app.config['WHOOSH_BASE'], 'timelines.db')
+        web = SQLiteTimelineStore(path)
+        self.addCleanup(setattr, timelines, 'store', timelines.store)
+        timelines.store = web
+        self.enable_timelines()
+        u1, u2 = self.setup_users_with_following()
+        self.timeline_titles(u1)
+        sue = models.User.query.filter_by(username='sue').one()
+        self.authenticate_user(sue)
+        self.client.post('/', data={
+            'title': 'queued', 'body': 'post',
+            'csrf_token': self.get_token('/')
+        })
+        self.assertEqual(models.Job.query.one().kind, 'timeline.fan_out')
+        john = models.User.query.filter_by(username='john').one()
+        self.assertFalse(web.size(john.id))
+        # the job runs with the worker process's own handle on the store
+        timelines.store = SQLiteTimelineStore(path)
+        jobs.drain()
+        timelines.store = web
+        self.assertEqual(self.timeline_titles(john), ['queued'])
+
+    def test_per_process_timelines_fan_out_in_the_request(self):
+        """."""
+        self.enable_timelines()
+        u1, u2 = self.setup_users_with_following()
+        self.timeline_titles(u1)
+        sue = models.User.query.filter_by(username='sue').one()
+        self.authenticate_user(sue)
+        self.client.post('/', data={
+            'title': 'inline', 'body': 'post',
+            'csrf_token': self.get_token('/')
+        })
+        self.assertEqual(models.Job.query.count(), 0)
+        john = models.User.query.filter_by(username='john').one()
+        self.assertEqual(timelines.store.size(john.id), 1)
+
+    @committed
+    def test_local_workers_run_jobs_after_commit(self):
+        """."""
+        done = threading.Event()
+        self.register_handler('test.signal', lambda: done.set())
+        jobs.workers = 1
+        jobs.enqueue('test.signal')
+        db.session.commit()
+        self.assertTrue(done.wait(5))
+        jobs.stop()
+
+    def test_follow_many_inserts_only_missing_edges(self):
+        """."""
+        u1, u2 = self.setup_users_with_following()
+        others = [
+            models.User(username=f'u{i}', password='pw') for i in range(3)
+        ]
+        db.session.add_all(others)
+        db.session.commit()
+        u1 = models.User.query.filter_by(username='john').one()
+        ids = [u.id for u in others]
+        sue_id = models.User.query.filter_by(username='sue').one().id
+        added = u1.follow_many(ids + [sue_id])
+        db.session.commit()
+        self.assertEqual(added, sorted(ids))
+        u1 = models.User.query.filter_by(username='john').one()
+        self.assertEqual(u1.following_count, 4)
+        self.assertEqual(u1.followed.count(), 4)
+        self.assertEqual(
+            [u.follower_count for u in models.User.query.filter(
+                models.User.id.in_(ids))], [1, 1, 1]
+        )
+        self.assertTrue(u1.is_following(others[0]))
+        removed = u1.unfollow_many(ids[:2] + [ids[:2][0]])
+        db.session.commit()
+        self.assertEqual(removed, sorted(ids[:2]))
+        u1 = models.User.query.filter_by(username='john').one()
+        self.assertEqual(u1.following_count, 2)
+        self.assertFalse(u1.is_following(others[0]))
+
+    def test_bulk_follow_endpoint_resolves_names_and_ids(self):
+        """."""
+        u1, u2 = self.setup_users_with_following()
+        u3 = models.User(username='bob', password='bobbert')
+        db.session.add(u3)
+        db.session.commit()
+        bob_id = u3.id
+        u1 = models.User.query.filter_by(username='john').one()
+        self.authenticate_user(u1)
+        # resolve, load john, existing edges, insert, two counter updates
+        with self.assert_num_queries(6):
+            response = self.client.post(
+                '/follow',
+                data=json.dumps({'users': ['sue', bob_id, 'nobody']}),
+                content_type='application/json'
+            )
+        self.assertEqual(json.loads(response.data), {
+            'changed': [bob_id], 'unchanged': 1, 'unknown': ['nobody']
+        })
+        response = self.client.post(
+            '/unfollow', data=json.dumps({'users': ['bob']}),
+            content_type='application/json'
+        )
+        self.assertEqual(json.loads(response.data)['changed'], [bob_id])
+        response = self.client.post(
+            '/follow', data=json.dumps({'users': 'bob'}),
+            content_type='application/json'
+        )
+        self.assertEqual(response.status_code, 400)
+
+    @committed
+    def test_importer_streams_users_posts_and_follows(self):
+        """."""
+        import db_import
+        with tempfile.TemporaryDirectory() as tmp:
+            users = os.path.join(tmp, 'users.csv')
+            with open(users, 'w') as out:
+                out.write('username,password\nann,pw\nben,pw\ncat,pw\n')
+            posts = os.path.join(tmp, 'posts.jsonl')
+            with open(posts, 'w') as out:
+                for i, author in enumerate(['ann', 'ben', 'ann', 'ghost']):
+                    out.write(json.dumps({
+                        'username': author, 'title': f'imported {i}',
+                        'body': 'searchable words',
+                        'timestamp': f'2017-01-0{i + 1}T12:00:00'
+                    }) + '\n')
+            follows = os.path.join(tmp, 'follows.csv')
+            with open(follows, 'w') as out:
+                out.write('follower,followed\nben,ann\ncat,ann\ncat,ann\n')
+            self.assertEqual(db_import.run('users', users, 2), 3)
+            self.assertEqual(db_import.run('users', users, 2), 3)
+            self.assertEqual(db_import.run('posts', posts, 2), 3)
+            self.assertEqual(db_import.run('follows', follows, 2), 3)
+        self.assertEqual(models.User.query.count(), 3)
+        ann = models.User.query.filter_by(username='ann').one()
+        self.assertEqual(
+            (ann.post_count, ann.follower_count, ann.following_count),
+            (2, 3, 1)
+        )
+        self.assertEqual(search_index.search('searchable')[1], 3)
+
+    def test_api_timeline_pages_by_cursor(self):
+        """."""
+        u1, u2 = self.setup_users_with_following()
+        self.create_posts(models.User.query.filter_by(username='sue').one(), 3)
+        u1 = models.User.query.filter_by(username='john').one()
+        self.authenticate_user(u1)
+        with self.assert_num_queries(1):
+            response = self.client.get('/api/v1/timeline?limit=2')
+        data = json.loads(response.data)
+        self.assertEqual(
+            [p['title'] for p in data['items']], ['sue post 2', 'sue post 1']
+        )
+        self.assertEqual(data['items'][0]['author'], 'sue')
+        self.assertIsNone(data['prev_cursor'])
+        response = self.client.get(
+            f"/api/v1/timeline?limit=2&cursor={data['next_cursor']}"
+        )
+        data = json.loads(response.data)
+        self.assertEqual([p['title'] for p in data['items']], ['sue post 0'])
+        self.assertIsNone(data['next_cursor'])
+        self.assertIsNotNone(data['prev_cursor'])
+
+    def test_api_user_profile_and_posts(self):
+        """."""
+        user = self.create_user()
+        self.create_posts(user, 2)
+        self.authenticate_user(user)
+        data = json.loads(self.client.get('/api/v1/users/flerg').data)
+        self.assertEqual(data['username'], 'flerg')
+        self.assertEqual(data['posts'], 0)
+        self.assertIsNotNone(data['last_seen'])
+        data = json.loads(self.client.get('/api/v1/users/flerg/posts').data)
+        self.assertEqual(
+            [p['title'] for p in data['items']], ['flerg post 1', 'flerg post 0']
+        )
+
+    def test_api_export_streams_every_post(self):
+        """."""
+        user = self.create_user()
+        self.create_posts(user, 5)
+        self.authenticate_user(user)
+        app.config['API_EXPORT_CHUNK'] = 2
+        self.addCleanup(app.config.__setitem__, 'API_EXPORT_CHUNK', 1000)
+        response = self.client.get('/api/v1/users/flerg/posts/export')
+        self.assertEqual(response.mimetype, 'application/x-ndjson')
+        lines = response.get_data(as_text=True).splitlines()
+        self.assertEqual(
+            [json.loads(line)['title'] for line in lines],
+            [f'flerg post {i}' for i in range(4, -1, -1)]
+        )
+
+    def test_api_errors_are_json(self):
+        """."""
+        response = self.client.get('/api/v1/timeline')
+        self.assertEqual(response.status_code, 401)
+        self.assertEqual(json.loads(response.data), {'error': 'Unauthorized'})
+        self.authenticate_user(self.create_user())
+        response = self.client.get('/api/v1/users/nobody')
+        self.assertEqual(response.status_code, 404)
+        self.assertEqual(json.loads(response.data), {'error': 'Not Found'})
+        response = self.client.get('/api/v1/timeline?cursor=bogus')
+        self.assertEqual(response.status_code, 400)
+        response = self.client.get('/api/v1/timeline?limit=1000')
+        self.assertEqual(response.status_code, 400)
+
+    def top_cursor(self, url='/') -> str:
+        """The top-post cursor a page hands to its new-posts poller."""
+        html = Soup(self.client.get(url).data, 'html.parser')
+        return html.find('table', {'class': 'posts'}).get('data-top')
+
+    def test_new_posts_returns_only_the_delta(self):
+        """."""
+        u1, u2 = self.setup_users_with_following()
+        sue = models.User.query.filter_by(username='sue').one()
+        self.create_posts(sue, 2)
+        u1 = models.User.query.filter_by(username='john').one()
+        self.authenticate_user(u1)
+        top = self.top_cursor()
+        self.assertEqual(json.loads(self.client.get(
+            f'/posts/new?since={top}'
+        ).data)['count'], 0)
+        sue = models.User.query.filter_by(username='sue').one()
+        self.create_posts(sue, 2, first=2)
+        data = json.loads(self.client.get(f'/posts/new?since={top}').data)
+        self.assertEqual(data['count'], 2)
+        self.assertFalse(data['more'])
+        rows = Soup(data['html'], 'html.parser').find_all('tr')
+        self.assertEqual(
+            [row.find_all('td')[1].text for row in rows],
+            ['Title: sue post 3', 'Title: sue post 2']
+        )
+        data = json.loads(self.client.get(
+            f"/posts/new?since={data['top_cursor']}&format=json"
+        ).data)
+        self.assertEqual(data['posts'], [])
+
+    def test_new_posts_rejects_older_cursors(self):
+        """."""
+        user = self.create_user()
+        self.create_posts(user, 1)
+        self.authenticate_user(user)
+        post = models.Post.query.one()
+        from app.pagination import OLDER, encode_cursor
+        older = encode_cursor(OLDER, post.timestamp, post.id)
+        response = self.client.get(f'/posts/new?since={older}')
+        self.assertEqual(response.status_code, 400)
+        response = self.client.get('/posts/new/count?since=bogus')
+        self.assertEqual(response.status_code, 400)
+        response = self.client.get(f'/posts/new/count?since={older}')
+        self.assertEqual(response.status_code, 400)
+        with self.assertRaises(ValueError):
+            models.User.query.get(post.user_id).new_posts_count(older)
+
+    def test_new_posts_count_is_capped_and_cheap(self):
+        """."""
+        u1, u2 = self.setup_users_with_following()
+        sue = models.User.query.filter_by(username='sue').one()
+        self.create_posts(sue, 1)
+        u1 = models.User.query.filter_by(username='john').one()
+        self.authenticate_user(u1)
+        top = self.top_cursor()
+        sue = models.User.query.filter_by(username='sue').one()
+        self.create_posts(sue, 4, first=1)
+        app.config['NEW_POSTS_COUNT_CAP'] = 3
+        self.addCleanup(app.config.__setitem__, 'NEW_POSTS_COUNT_CAP', 100)
+        with self.assert_num_queries(1):
+            response = self.client.get(f'/posts/new/count?since={top}')
+        self.assertEqual(
+            json.loads(response.data), {'count': 3, 'capped': True}
+        )
+
+    def test_only_the_first_home_page_polls(self):
+        """."""
+        user = self.create_user()
+        user.follow(user)
+        db.session.commit()
+        self.create_posts(user, 5)
+        self.authenticate_user(user)
+        html = Soup(self.client.get('/').data, 'html.parser')
+        self.assertIsNotNone(html.find('script'))
+        older = html.find('a', text='>> Older posts').get('href')
+        html = Soup(self.client.get(older).data, 'html.parser')
+        self.assertIsNone(html.find('script'))
+
+    def test_register_stores_a_salted_hash(self):
+        """."""
+        self.client.post('/register', data={
+            'username': 'bob', 'password': 'secret', 'password2': 'secret',
+            'csrf_token': self.get_token('/register')
+        })
+        self.client.get('/logout')
+        self.client.post('/register', data={
+            'username': 'amy', 'password': 'secret', 'password2': 'secret',
+            'csrf_token': self.get_token('/register')
+        })
+        bob, amy = [
+            models.User.query.filter_by(username=name).one().password
+            for name in ('bob', 'amy')
+        ]
+        self.assertTrue(bob.startswith('pbkdf2:sha256:1000$'))
+        self.assertNotIn('secret', bob)
+        self.assertNotEqual(bob, amy)
+        self.client.get('/logout')
+        response = self.client.post('/login', data={
+            'username': 'bob', 'password': 'secret',
+            'csrf_token': self.get_token('/login')
+        })
+        self.assertEqual(response.status_code, 302)
+
+    def test_login_rehashes_plain_and_outdated_passwords(self):
+        """."""
+        user = self.create_user()
+        self.authenticate_user(user)
+        stored = models.User.query.filter_by(username='flerg').one().password
+        self.assertTrue(passwords.is_hashed(stored))
+        self.assertFalse(passwords.needs_rehash(stored))
+        self.client.get('/logout')
+        passwords.iterations = 2000
+        self.authenticate_user(user, 'theblerg')
+        self.assertTrue(models.User.query.filter_by(
+            username='flerg'
+        ).one().password.startswith('pbkdf2:sha256:2000$'))
+        self.client.get('/logout')
+        self.authenticate_user(user, 'wrong')
+        self.assertEqual(self.client.get('/').status_code, 302)
+
+    def test_verify_rejects_wrong_and_empty_passwords(self):
+        """."""
+        stored = passwords.hash('right')
+        self.assertTrue(passwords.verify(stored, 'right'))
+        self.assertFalse(passwords.verify(stored, 'wrong'))
+        self.assertFalse(passwords.verify(stored, ''))
+        self.assertFalse(passwords.verify('', ''))
+        self.assertTrue(passwords.verify('plain', 'plain'))
+        self.assertFalse(passwords.verify('plain', stored))
+
+    def test_login_is_refused_with_503_when_hashing_is_backed_up(self):
+        """."""
+        user = self.create_user()
+        user.password = passwords.hash('theblerg')
+        db.session.commit()
+        for _ in range(passwords.max_pending):
+            passwords._slots.acquire()
+            self.addCleanup(passwords._slots.release)
+        response = self.client.post('/login', data={
+            'username': 'flerg', 'password': 'theblerg',
+            'csrf_token': self.get_token('/login')
+        })
+        self.assertEqual(response.status_code, 503)
+        self.assertIn(b'busy', response.data)
+
+    def test_password_jobs_keep_their_slot_after_the_caller_times_out(self):
+        """."""
+        from app.passwords import PasswordsBusy
+        settings = (passwords.timeout, passwords._slots)
+        self.addCleanup(setattr, passwords, '_slots', settings[1])
+        self.addCleanup(setattr, passwords, 'timeout', settings[0])
+        passwords.timeout = 0.01
+        passwords._slots = threading.BoundedSemaphore(1)
+        release = threading.Event()
+        self.addCleanup(release.set)
+        with self.assertRaises(PasswordsBusy):
+            passwords._call(release.wait)
+        # the stuck job is still queued, so there is no room for another
+        with self.assertRaises(PasswordsBusy):
+            passwords._call(len, 'x')
+        release.set()
+        passwords.shutdown()
+        self.assertEqual(passwords._call(len, 'x'), 1)
+
+    def migrator(self, *steps, **kwargs):
+        """A quiet runner whose only migration is steps."""
+        from app.migrator import Migration, Migrator
+        lines = []
+        runner = Migrator(throttle=0, out=lines.append, **kwargs)
+        runner.migrations = lambda: [Migration(1, 'test', 'Test', list(steps))]
+        runner.lines = lines
+        return runner
+
+    @committed
+    def test_backfill_resumes_after_an_interruption(self):
+        """."""
+        from app.migrator import Backfill, DONE
+        db.session.add_all([
+            models.User(username=f'u{i}', password='pw') for i in range(5)
+        ])
+        db.session.commit()
+        seen = []
+
+        def compute(rows):
+            seen.append([row[1] for row in rows])
+            if len(seen) == 2:
+                raise RuntimeError('interrupted')
+            return [{'about_me': f'about {row[1]}'} for row in rows]
+        step = Backfill(
+            'user', 'about_me IS NULL', compute=compute,
+            columns=['username'], chunk_size=2
+        )
+        with self.assertRaises(RuntimeError):
+            self.migrator(step).upgrade()
+        self.assertEqual(
+            models.User.query.filter(models.User.about_me.isnot(None)).count(),
+            2
+        )
+        seen.append(None)
+        runner = self.migrator(step)
+        self.assertEqual(runner.upgrade(), [1])
+        self.assertEqual(seen[-2:], [['u2', 'u3'], ['u4']])
+        self.assertEqual(
+            [u.about_me for u in models.User.query.order_by(models.User.id)],
+            [f'about u{i}' for i in range(5)]
+        )
+        self.assertEqual(runner.state()[(1, 0)][0], DONE)
+        self.assertEqual(runner.state()[(1, 0)][2], 5)
+        self.assertEqual(runner.upgrade(), [])
+
+    @committed
+    def test_dry_run_estimates_without_changing_anything(self):
+        """."""
+        from app.migrator import Backfill, CreateIndex
+        user = self.create_user()
+        self.create_posts(user, 3)
+        runner = self.migrator(
+            CreateIndex('ix_post_body', 'post', ['body']),
+            Backfill('post', "body = 'body'", set="body = 'text'")
+        )
+        self.assertEqual(runner.upgrade(dry_run=True), [1])
+        self.assertIn('  create index ix_post_body on post (body): ~3 rows',
+                      runner.lines)
+        self.assertIn("  backfill post where body = 'body': ~3 rows",
+                      runner.lines)
+        self.assertEqual(
+            models.Post.query.filter_by(body='body').count(), 3
+        )
+        self.assertEqual(len(runner.pending()), 1)
+
+    @committed
+    def test_migration_steps_build_indexes_and_backfill(self):
+        """."""
+        from app.migrator import Backfill, CreateIndex, SQL
+        from sqlalchemy import inspect
+        self.addCleanup(db.engine.execute, 'DROP INDEX IF EXISTS ix_post_body')
+        user = self.create_user()
+        self.create_posts(user, 5)
+        runner = self.migrator(
+            SQL("UPDATE post SET body = 'old' WHERE title LIKE '%0'"),
+            CreateIndex('ix_post_body', 'post', ['body']),
+            Backfill('post', "body = 'body'", set="body = 'new'"),
+            chunk_size=2
+        )
+        runner.upgrade()
+        self.assertIn('ix_post_body', [
+            index['name'] for index in inspect(db.engine).get_indexes('post')
+        ])
+        self.assertEqual(
+            sorted(post.body for post in models.Post.query),
+            ['new', 'new', 'new', 'new', 'old']
+        )
+        self.assertEqual(runner.pending(), [])
+
+    def test_migrations_lift_the_statement_timeout_on_postgres(self):
+        """."""
+        from app.migrator import lift_statement_timeout
+        connection = mock.Mock()
+        connection.dialect.name = 'postgresql'
+        lift_statement_timeout(connection)
+        lift_statement_timeout(connection, local=False)
+        self.assertEqual(
+            [str(call[0][0]) for call in connection.execute.call_args_list],
+            ['SET LOCAL statement_timeout = 0', 'SET statement_timeout = 0']
+        )
+        connection.dialect.name = 'sqlite'
+        lift_statement_timeout(connection)
+        self.assertEqual(connection.execute.call_count, 2)
+
+    def test_migration_steps_must_describe_and_run(self):
+        """."""
+        from app.migrator import Step
+
+        class Partial(Step):
+            def describe(self):
+                return 'nothing'
+
+        with self.assertRaises(TypeError):
+            Partial()
+
+    @committed
+    def test_shipped_migrations_hash_dormant_passwords(self):
+        """."""
+        from app.migrator import Migrator
+        self.create_user()
+        runner = Migrator(throttle=0, out=lambda line: None)
+        self.assertEqual(runner.upgrade(1), [1])
+        stored = models.User.query.filter_by(username='flerg').one().password
+        self.assertTrue(passwords.verify(stored, 'theblerg'))
+        self.assertFalse(passwords.needs_rehash(stored))
+        self.assertEqual(runner.pending(1), [])
+
+    @committed
+    def test_mark_applied_records_every_migration(self):
+        """."""
+        from app.migrator import Migrator
+        runner = Migrator(out=lambda line: None)
+        versions = [m.version for m in runner.migrations()]
+        self.assertEqual(runner.mark_applied(), versions)
+        self.assertEqual(runner.pending(), [])
+        self.assertEqual(runner.upgrade(), [])
+
+    def snapshot_replica(self) -> None:
+        """Serve reads from a copy of the SQLite test database as it is now.
+
+        Whatever is committed afterwards is missing from the copy, like
+        changes a lagging replica hasn't replayed yet.
+        """
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        copy = os.path.join(directory, 'replica.db')
+        shutil.copyfile(db.engine.url.database, copy)
+        app.config['SQLALCHEMY_BINDS'] = {'replica0': f'sqlite:///{copy}'}
+        replicas.init_app(app, db)
+
+    @unittest.skipUnless(config.TEST_DATABASE_URI.startswith('sqlite'),
+                         'replica snapshots copy the SQLite file')
+    @committed
+    def test_reads_go_to_the_replica_until_the_user_writes(self):
+        """."""
+        u1, u2 = self.setup_users_with_following()
+        u1 = models.User.query.filter_by(username='john').one()
+        u1.password = passwords.hash('johnson')
+        sue = models.User.query.filter_by(username='sue').one()
+        self.create_posts(sue, 1)
+        self.snapshot_replica()
+        sue = models.User.query.filter_by(username='sue').one()
+        self.create_posts(sue, 1, first=1)
+
+        self.authenticate_user(u1, 'johnson')
+        html = self.client.get('/profile/sue').data
+        self.assertIn(b'sue post 0', html)
+        self.assertNotIn(b'sue post 1', html)
+
+        self.client.get('/unfollow/sue')
+        html = self.client.get('/profile/sue').data
+        self.assertIn(b'sue post 1', html)
+
+    @unittest.skipUnless(config.TEST_DATABASE_URI.startswith('sqlite'),
+                         'replica snapshots copy the SQLite file')
+    @committed
+    def test_writes_and_form_posts_use_the_primary(self):
+        """."""
+        self.snapshot_replica()
+        with app.test_request_context('/'):
+            read = models.User.query.statement
+            self.assertTrue(db.session.get_bind(
+                clause=read
+            ).url.database.endswith('replica.db'))
+            locked = models.Job.query.with_for_update().statement
+            self.assertIs(db.session.get_bind(clause=locked), db.engine)
+            db.session.add(models.User(username='new', password='pw'))
+            db.session.flush()
+            self.assertIs(db.session.get_bind(clause=read), db.engine)
+            db.session.rollback()
+        with app.test_request_context('/', method='POST'):
+            self.assertIs(db.session.get_bind(clause=read), db.engine)
+
+    @unittest.skipUnless(config.TEST_DATABASE_URI.startswith('sqlite'),
+                         'replica snapshots copy the SQLite file')
+    @committed
+    def test_a_transaction_reads_from_one_replica(self):
+        """."""
+        self.snapshot_replica()
+        binds = dict(app.config['SQLALCHEMY_BINDS'])
+        binds['replica1'] = binds['replica0'].replace(
+            'replica.db', 'replica1.db'
+        )
+        shutil.copyfile(
+            make_url(binds['replica0']).database,
+            make_url(binds['replica1']).database
+        )
+        app.config['SQLALCHEMY_BINDS'] = binds
+        replicas.init_app(app, db)
+        read = models.User.query.statement
+        with app.test_request_context('/'):
+            first = db.session.get_bind(clause=read)
+            self.assertIsNot(first, db.engine)
+            for _ in range(3):
+                self.assertIs(db.session.get_bind(clause=read), first)
+            db.session.rollback()
+            self.assertIsNot(db.session.get_bind(clause=read), first)
+            db.session.remove()
+
+    def test_unreachable_replicas_are_taken_out_of_rotation(self):
+        """."""
+        user = self.create_user()
+        self.authenticate_user(user)
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        missing = os.path.join(directory, 'gone', 'replica.db')
+        app.config['SQLALCHEMY_BINDS'] = {'replica0': f'sqlite:///{missing}'}
+        replicas.init_app(app, db)
+        self.assertEqual(self.client.get('/profile/flerg').status_code, 200)
+        status = json.loads(self.client.get(
+            '/internal/replicas', headers=self.use_internal_token()
+        ).data)
+        self.assertFalse(status['replicas'][0]['healthy'])
+        self.assertIn('unable to open', status['replicas'][0]['error'])
+
+    def use_shards(self, count=2, buckets=2) -> list:
+        """Keep posts on count SQLite shards; return their file paths."""
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        paths = [os.path.join(directory, f'shard{n}.db') for n in range(count)]
+        app.config['SQLALCHEMY_BINDS'] = {
+            f'shard{n}': f'sqlite:///{path}' for n, path in enumerate(paths)
+        }
+        app.config['POST_SHARD_BUCKETS'] = buckets
+        shards.init_app(app, db)
+        shards.create_all()
+        return paths
+
+    def test_api_reads_posts_from_the_shards(self):
+        """."""
+        self.use_shards()
+        john, sue = self.setup_users_with_following()
+        for i in range(3):
+            shards.add_post(f'sue post {i}', 'body', sue.id)
+        app.config['API_EXPORT_CHUNK'] = 2
+        self.addCleanup(app.config.__setitem__, 'API_EXPORT_CHUNK', 1000)
+        self.authenticate_user(john)
+        data = json.loads(self.client.get('/api/v1/timeline?limit=2').data)
+        self.assertEqual(
+            [p['title'] for p in data['items']], ['sue post 2', 'sue post 1']
+        )
+        self.assertEqual(data['items'][0]['author'], 'sue')
+        data = json.loads(self.client.get(
+            f"/api/v1/users/sue/posts?cursor={data['next_cursor']}"
+        ).data)
+        self.assertEqual([p['title'] for p in data['items']], ['sue post 0'])
+        lines = self.client.get(
+            '/api/v1/users/sue/posts/export'
+        ).get_data(as_text=True).splitlines()
+        self.assertEqual(
+            [json.loads(line)['title'] for line in lines],
+            ['sue post 2', 'sue post 1', 'sue post 0']
+        )
+
+    def test_sharded_timelines_merge_posts_from_every_shard(self):
+        """."""
+        self.use_shards()
+        john, sue = self.setup_users_with_following()
+        john.follow(john)
+        db.session.commit()
+        self.assertEqual(shards.shard_for(john.id), 'shard1')
+        self.assertEqual(shards.shard_for(sue.id), 'shard0')
+        for i in range(7):
+            shards.add_post(f'post {i}', 'body', (john, sue)[i % 2].id)
+        self.assertEqual(shards.counts(), {'shard0': 3, 'shard1': 4})
+
+        first = shards.timeline_page(john, None, 3)
+        second = shards.timeline_page(john, first.next_cursor, 3)
+        last = shards.timeline_page(john, second.next_cursor, 3)
+        self.assertEqual([p.title for p in first.items],
+                         ['post 6', 'post 5', 'post 4'])
+        self.assertEqual([p.title for p in second.items],
+                         ['post 3', 'post 2', 'post 1'])
+        self.assertEqual([p.title for p in last.items], ['post 0'])
+        self.assertFalse(last.has_next)
+        back = shards.timeline_page(john, second.prev_cursor, 3)
+        self.assertEqual([p.title for p in back.items],
+                         ['post 6', 'post 5', 'post 4'])
+        self.assertEqual(back.items[0].author.username, 'john')
+
+        self.authenticate_user(john, 'johnson')
+        self.client.post('/', data={
+            'title': 'post 1', 'body': 'taken',
+            'csrf_token': self.get_token('/')
+        })
+        self.client.post('/', data={
+            'title': 'hello', 'body': 'world',
+            'csrf_token': self.get_token('/')
+        })
+        self.assertEqual(shards.counts(), {'shard0': 3, 'shard1': 5})
+        john = models.User.query.filter_by(username='john').one()
+        self.assertEqual(john.post_count, 1)
+        html = self.client.get('/').data
+        self.assertIn(b'hello', html)
+        self.assertIn(b'post 5', html)
+        self.assertEqual(self.client.get('/search?q=hello').status_code, 200)
+        self.assertIn(b'hello', self.client.get('/search?q=hello').data)
+
+    def test_profiles_read_only_their_authors_shard(self):
+        """."""
+        paths = self.use_shards()
+        john, sue = self.setup_users_with_following()
+        for i in range(4):
+            shards.add_post(f'post {i}', 'body', (john, sue)[i % 2].id)
+        touched = set()
+
+        def record(conn, cursor, statement, parameters, context, many):
+            touched.add(conn.engine.url.database)
+        event.listen(Engine, 'before_cursor_execute', record)
+        try:
+            page = shards.user_page(sue, None, 3)
+        finally:
+            event.remove(Engine, 'before_cursor_execute', record)
+        self.assertEqual([p.title for p in page.items], ['post 3', 'post 1'])
+        self.assertIn(paths[0], touched)
+        self.assertNotIn(paths[1], touched)
+
+        self.authenticate_user(john, 'johnson')
+        html = self.client.get('/profile/sue').data
+        self.assertIn(b'post 3', html)
+        self.assertNotIn(b'post 2', html)
+
+    def test_rebalancing_moves_buckets_between_shards(self):
+        """."""
+        self.use_shards()
+        john, sue = self.setup_users_with_following()
+        for i in range(5):
+            shards.add_post(f'post {i}', 'body', (john, sue)[i % 2].id)
+        quiet = {'out': lambda line: None}
+        self.assertEqual(
+            shards.copy_buckets(0, 0, 'shard0', 'shard1', 2, **quiet), 2
+        )
+        self.assertEqual(shards.counts(), {'shard0': 2, 'shard1': 5})
+        with self.assertRaises(ValueError):
+            shards.purge_buckets(0, 0, 'shard0', **quiet)
+
+        # written to the old owner before the map switch reached this process
+        shards.add_post('late', 'body', sue.id)
+        app.config['POST_SHARD_MAP'] = {'shard1': [[0, 1]], 'shard0': []}
+        shards.init_app(app, db)
+        self.assertEqual(
+            shards.copy_buckets(0, 0, 'shard0', 'shard1', 2, **quiet), 3
+        )
+        # written to the old owner by a process still on the old map
+        from app.shards import posts
+        with shards.engine('shard0').begin() as connection:
+            connection.execute(posts.insert(), {
+                'id': shards.next_id(), 'title': 'later', 'body': 'body',
+                'timestamp': datetime.utcnow(), 'user_id': sue.id,
+            })
+        self.assertEqual(shards.purge_buckets(0, 0, 'shard0', 2, **quiet), 4)
+        self.assertEqual(shards.counts(), {'shard0': 0, 'shard1': 7})
+        page = shards.timeline_page(john, None, 3)
+        self.assertEqual([p.title for p in page.items],
+                         ['later', 'late', 'post 3'])
+
+        app.config['POST_SHARD_MAP'] = {'shard0': [[0, 0]]}
+        with self.assertRaises(ValueError):
+            shards.init_app(app, db)
+
+    @committed
+    def test_import_reconcile_and_reindex_use_the_shards(self):
+        """."""
+        import db_import
+        from db_reconcile import reconcile_counters
+        from search_reindex import post_chunks
+        self.use_shards()
+        john, sue = self.setup_users_with_following()
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, 'posts.jsonl')
+            with open(path, 'w') as out:
+                for i, author in enumerate(['john', 'sue', 'sue']):
+                    out.write(json.dumps({
+                        'username': author, 'title': f'imported {i}',
+                        'body': 'searchable words'
+                    }) + '\n')
+            self.assertEqual(db_import.run('posts', path, 2), 3)
+            self.assertEqual(db_import.run('posts', path, 2), 3)
+        self.assertEqual(models.Post.query.count(), 0)
+        self.assertEqual(shards.counts(), {'shard0': 2, 'shard1': 1})
+        self.assertEqual(search_index.search('searchable')[1], 3)
+        sue = models.User.query.filter_by(username='sue').one()
+        self.assertEqual(sue.post_count, 2)
+
+        sue.post_count = 9
+        db.session.commit()
+        self.assertEqual(reconcile_counters(), 1)
+        db.session.expire_all()
+        self.assertEqual(sue.post_count, 2)
+        self.assertEqual(reconcile_counters(), 0)
+
+        search_index.clear()
+        self.assertEqual(search_index.reindex(post_chunks(2)), 3)
+        self.assertEqual(search_index.search('searchable')[1], 3)
+
+    def test_create_app_registers_views_once_and_warms_templates(self):
+        """."""
+        rules = len(list(app.url_map.iter_rules()))
+        app.jinja_env.cache.clear()
+        self.assertIs(create_app(warm=True), app)
+        self.assertIs(create_app(), app)
+        self.assertEqual(len(list(app.url_map.iter_rules())), rules)
+        compiled = {name for _, name in app.jinja_env.cache.keys()}
+        self.assertTrue(set(app.jinja_env.list_templates()) <= compiled)
+        self.assertEqual(self.client.get('/login').status_code, 200)
+
+    def test_templates_compile_into_the_bytecode_cache(self):
+        """."""
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        self.addCleanup(
+            setattr, app.jinja_env, 'bytecode_cache',
+            app.jinja_env.bytecode_cache
+        )
+        self.addCleanup(app.jinja_env.cache.clear)
+        app.jinja_env.bytecode_cache = AtomicBytecodeCache(directory)
+        app.jinja_env.cache.clear()
+        names = compile_templates(app)
+        self.assertEqual(len(os.listdir(directory)), len(names))
+
+        app.jinja_env.cache.clear()
+        # nothing is compiled again, so nothing is written
+        with mock.patch.object(
+            app.jinja_env.bytecode_cache, 'dump_bytecode'
+        ) as dump:
+            self.assertEqual(compile_templates(app), names)
+            self.assertEqual(self.client.get('/login').status_code, 200)
+        dump.assert_not_called()
+
+    def test_post_rows_render_escaped_from_the_macro(self):
+        """."""
+        user = self.create_user()
+        post = models.Post(title='<b>loud</b>', body='a & b', user_id=user.id,
+                           timestamp=datetime.utcnow())
+        db.session.add(post)
+        db.session.commit()
+        rendered = fragments.render_posts([post])
+        cached = fragments.render_posts([post])
+        self.assertEqual(rendered, cached)
+        self.assertEqual(
+            str(rendered[0]),
+            '<tr>\n    <td>Author: flerg</td>\n'
+            '    <td>Title: &lt;b&gt;loud&lt;/b&gt;</td>\n'
+            '    <td>Body: a &amp; b</td>\n</tr>'
+        )
+
+
 if __name__ == '__main__':
     unittest.main()
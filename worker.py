@@ -0,0 +1,20 @@
+#!flask/bin/python
+"""Run queued background jobs until interrupted."""
+from app import app, jobs, timelines
+import sys
+import time
+
+if timelines.enabled and not timelines.fans_out_in_jobs:
+    app.logger.warning(
+        'the %s timeline store is not shared between processes; new posts '
+        'are fanned out by the web processes instead',
+        app.config['TIMELINE_BACKEND']
+    )
+workers = int(sys.argv[1]) if len(sys.argv) > 1 else 4
+jobs.start(workers)
+app.logger.info('job worker started with %d threads', workers)
+try:
+    while True:
+        time.sleep(60)
+except KeyboardInterrupt:
+    jobs.stop()